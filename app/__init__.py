@@ -41,10 +41,15 @@ def create_app(config_name):
     bootstrap.init_app(app)
     mail.init_app(app)
     db.init_app(app)
+    cache.init_app(app)
     migrate.init_app(app, db)
     login_manager.init_app(app)
     rq.init_app(app)
 
+    # Before any other request hooks, so their queries are counted too
+    from . import query_stats
+    query_stats.init_app(app)
+
     if app.config.get('SSLIFY_ENABLE'):
         app.logger.info("Using SSLify")
         from flask_sslify import SSLify
@@ -113,6 +118,13 @@ def create_app(config_name):
     from .admin import admin_bp
     app.register_blueprint(admin_bp)
 
+    from .email import rendering
+    rendering.init_app(app)
+
+    # Roles and ride requests memoized on the current user (see models.py)
+    from .models import forget_request_memos
+    app.teardown_request(forget_request_memos)
+
     @app.before_request
     def block_handling():
         """ Log out a user that's blocked and send them to the index page. """
@@ -0,0 +1,152 @@
+import os
+from flask import Response, send_file, stream_with_context
+from .. import db
+from ..models import ExportChunk
+
+
+class DatabaseExportStore(object):
+    """
+    Keeps export files in the database, as a chunk per batch written. The
+    worker writes exports and the web app sends them, and on Heroku they
+    don't share a disk, but they do share the database.
+
+    Chunks are added in the session's transaction, so a batch and the
+    export job's record of it are committed together.
+    """
+
+    def __init__(self, app):
+        pass
+
+    def open(self, name, offset):
+        """
+        Opens an export file for appending at `offset` bytes, dropping
+        anything after that which a previous attempt left behind. Raises
+        ValueError if the file is shorter than `offset`.
+        """
+        ExportChunk.query.\
+            filter(ExportChunk.name == name).\
+            filter(ExportChunk.position >= offset).\
+            delete(synchronize_session=False)
+
+        if self.size(name) != offset:
+            raise ValueError("{} is shorter than {} bytes".format(name, offset))
+
+        return _ChunkWriter(name, offset)
+
+    def size(self, name):
+        """ Returns the size of an export file in bytes, 0 if there isn't one. """
+        return db.session.query(
+            db.func.coalesce(db.func.sum(db.func.length(ExportChunk.data)), 0)).\
+            filter(ExportChunk.name == name).\
+            scalar()
+
+    def exists(self, name):
+        return db.session.query(
+            ExportChunk.query.filter(ExportChunk.name == name).exists()).\
+            scalar()
+
+    def send(self, name, download_name):
+        """ Returns a response that streams the export file a chunk at a time. """
+        positions = [row.position for row in db.session.query(ExportChunk.position).
+                     filter(ExportChunk.name == name).
+                     order_by(ExportChunk.position)]
+
+        def chunks():
+            for position in positions:
+                yield db.session.query(ExportChunk.data).\
+                    filter_by(name=name, position=position).\
+                    scalar()
+
+        return Response(
+            stream_with_context(chunks()),
+            mimetype='text/csv',
+            headers={
+                'Content-disposition': 'attachment; filename={}'.format(download_name)
+            }
+        )
+
+    def delete(self, name):
+        """ Deletes an export file in the session's transaction. """
+        ExportChunk.query.\
+            filter(ExportChunk.name == name).\
+            delete(synchronize_session=False)
+
+
+class _ChunkWriter(object):
+    """ The file-like object DatabaseExportStore.open returns. """
+
+    def __init__(self, name, offset):
+        self.name = name
+        self.offset = offset
+
+    def write(self, data):
+        db.session.add(ExportChunk(name=self.name, position=self.offset, data=data))
+        self.offset += len(data)
+
+    def flush(self):
+        db.session.flush()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if not exc_info[0]:
+            self.close()
+
+
+class LocalExportStore(object):
+    """
+    Keeps export files in a local directory (`EXPORT_DIR`). The web app
+    and the worker must both see that directory (docker-compose shares
+    one between them), otherwise downloads of exports the worker wrote
+    404. Don't use it with RQ_ENABLED on Heroku, where dynos each have
+    their own disk.
+    """
+
+    def __init__(self, app):
+        self.directory = app.config.get('EXPORT_DIR')
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def open(self, name, offset):
+        """
+        Opens an export file for appending at `offset` bytes, dropping
+        anything after that which a previous attempt left behind. The
+        file is never extended: if it's shorter than `offset` (or gone)
+        this raises ValueError, and the export has to start over.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+
+        if offset and self.size(name) < offset:
+            raise ValueError("{} is shorter than {} bytes".format(name, offset))
+
+        out = open(self.path(name), 'ab')
+        out.truncate(offset)
+        return out
+
+    def size(self, name):
+        """ Returns the size of an export file in bytes, 0 if there isn't one. """
+        try:
+            return os.path.getsize(self.path(name))
+        except OSError:
+            return 0
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def send(self, name, download_name):
+        """ Returns a response that downloads the export file. """
+        return send_file(
+            self.path(name),
+            mimetype='text/csv',
+            as_attachment=True,
+            attachment_filename=download_name,
+        )
+
+    def delete(self, name):
+        if self.exists(name):
+            os.remove(self.path(name))
@@ -0,0 +1,322 @@
+import csv
+import datetime
+import io
+from flask import current_app
+from werkzeug.utils import import_string
+from .. import db, rq
+from ..models import Carpool, ExportJob
+
+# Rows are written to the response in chunks of this many
+CSV_CHUNK_ROWS = 500
+
+# Background exports are written this many carpools at a time
+EXPORT_BATCH_CARPOOLS = 500
+
+USERS_QUERY = '''
+    select cp.id carpool_id, d.name destination, cp.leave_time leave_time,
+        cp.return_time return_time, 'rider' as rider_driver,
+        p.name person_name, p.email email, p.phone_number phone,
+        p.preferred_contact_method contact
+    from carpools cp, destinations d, people p, riders r
+    where cp.destination_id=d.id and cp.id=r.carpool_id and
+        r.status='approved' and r.person_id=p.id {filters}
+    union
+    select cp.id carpool_id, d.name destination, cp.leave_time leave_time,
+        cp.return_time returntime, 'driver' as rider_driver,
+        p.name person_name, p.email email, p.phone_number phone,
+        p.preferred_contact_method contact
+    from carpools cp, destinations d, people p
+    where cp.destination_id=d.id and cp.driver_id=p.id {filters}
+    order by {order_by}
+'''
+
+CARPOOLS_QUERY = '''
+    select cp.from_place as from_place, st_x(cp.from_point) as from_lon, st_y(cp.from_point) as from_lat,
+           d.name as destination, st_x(d.point) as destination_lon, st_y(d.point) as destination_lat,
+           d.address as destination_address,
+           cp.leave_time as leave_time,
+           cp.return_time as return_time,
+           dp.name as driver_name, dp.email as driver_email,
+           cp.max_riders as max_riders,
+           cp.canceled as canceled,
+           cp.cancel_reason as cancel_reason,
+           coalesce(r.request_count, 0) as request_count,
+           coalesce(r.approved_count, 0) as approved_count
+    from carpools cp
+    full outer join destinations d on (cp.destination_id=d.id)
+    inner join people dp on (dp.id=cp.driver_id)
+    left outer join (
+        select carpool_id,
+               count(*) as request_count,
+               count(*) filter (where status='approved') as approved_count
+        from riders
+        group by carpool_id
+    ) r on (r.carpool_id=cp.id)
+    where true {filters}
+    order by {order_by}
+'''
+
+
+def stream_query(query, params=None):
+    """
+    Yields the rows of a SQL query using a server-side cursor, so rows
+    are fetched from the database in batches instead of all at once.
+    """
+    with db.engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).\
+            execute(db.text(query), params or {})
+        for row in result:
+            yield row
+
+
+USERS_TITLE = ['Nomad carpool drivers and riders']
+USERS_HEADER = ['carpool_id', 'destination', 'carpool leave time',
+                'carpool return time', 'driver/rider', 'name', 'email',
+                'phone', 'preferred contact method']
+
+
+def format_user_row(row):
+    return [
+        row.carpool_id,
+        row.destination,
+        row.leave_time.strftime('%x %X'),
+        row.return_time.strftime('%x %X'),
+        row.rider_driver,
+        row.person_name,
+        row.email,
+        row.phone,
+        row.contact
+    ]
+
+
+CARPOOLS_TITLE = ['Nomad carpools']
+CARPOOLS_HEADER = ['from', 'from lat/lon',
+                   'destination', 'destination lat/lon', 'destination address',
+                   'leave time', 'return time',
+                   'driver name', 'drive email',
+                   'max riders', 'ride requests', 'approved riders',
+                   'status', 'reason for cancellation'
+                   ]
+
+
+def format_carpool_row(row):
+    return [
+        row.from_place,
+        ','.join(map(str, [row.from_lat, row.from_lon])),
+        row.destination,
+        ','.join(map(str, [row.destination_lat, row.destination_lon])),
+        row.destination_address,
+        row.leave_time.strftime('%x %X'),
+        row.return_time.strftime('%x %X'),
+        row.driver_name,
+        row.driver_email,
+        row.max_riders,
+        row.request_count,
+        row.approved_count,
+        "Canceled" if row.canceled else 'Active',
+        row.cancel_reason,
+    ]
+
+
+def user_rows():
+    """ Yields the rows of the drivers and riders CSV export. """
+    yield USERS_TITLE
+    yield USERS_HEADER
+
+    query = USERS_QUERY.format(
+        filters='', order_by='destination, leave_time, person_name')
+    for row in stream_query(query):
+        yield format_user_row(row)
+
+
+def carpool_rows():
+    """ Yields the rows of the carpools CSV export. """
+    yield CARPOOLS_TITLE
+    yield CARPOOLS_HEADER
+
+    query = CARPOOLS_QUERY.format(filters='', order_by='cp.id')
+    for row in stream_query(query):
+        yield format_carpool_row(row)
+
+
+def csv_chunks(rows):
+    """
+    Encodes rows as CSV, yielding the text a chunk of rows at a time so
+    only one chunk is ever held in memory.
+    """
+    output = io.StringIO()
+    writer = csv.writer(output)
+
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if count % CSV_CHUNK_ROWS == 0:
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate()
+
+    if output.tell():
+        yield output.getvalue()
+
+
+# Background exports. Each kind is written in carpool id order, so the
+# id of the last carpool written is enough to carry on from.
+EXPORTS = {
+    'users': {
+        'title': USERS_TITLE,
+        'header': USERS_HEADER,
+        'query': USERS_QUERY,
+        'order_by': 'carpool_id, rider_driver, person_name',
+        'format_row': format_user_row,
+        'filename': 'nomad_users.csv',
+    },
+    'carpools': {
+        'title': CARPOOLS_TITLE,
+        'header': CARPOOLS_HEADER,
+        'query': CARPOOLS_QUERY,
+        'order_by': 'cp.id',
+        'format_row': format_carpool_row,
+        'filename': 'nomad_carpools.csv',
+    },
+}
+
+
+def get_export_store():
+    """ Returns the store configured with `EXPORT_STORE` for export files. """
+    store_class = import_string(current_app.config.get('EXPORT_STORE'))
+    return store_class(current_app)
+
+
+def start_export(kind, requested_by):
+    """
+    Creates an export job of the given kind and runs it on the RQ worker,
+    or right away if RQ isn't enabled. Exports past their retention are
+    deleted first.
+    """
+    delete_old_exports()
+
+    job = ExportJob(kind=kind, requested_by=requested_by)
+    db.session.add(job)
+    db.session.commit()
+
+    queue_export(job)
+
+    return job
+
+
+def delete_exports(jobs):
+    """ Deletes export jobs and their files. """
+    store = get_export_store()
+    for job in jobs:
+        store.delete(job.filename)
+        db.session.delete(job)
+    db.session.commit()
+
+
+def delete_old_exports():
+    """
+    Deletes the complete and failed exports that haven't changed for
+    EXPORT_RETENTION_HOURS. They hold people's names, emails and phone
+    numbers, so they aren't kept any longer than they're needed.
+    Returns how many were deleted.
+    """
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(
+        hours=current_app.config.get('EXPORT_RETENTION_HOURS'))
+    old = ExportJob.query.\
+        filter(ExportJob.status.in_([ExportJob.STATUS_COMPLETE,
+                                     ExportJob.STATUS_FAILED])).\
+        filter(ExportJob.updated_at < cutoff).\
+        all()
+    delete_exports(old)
+    return len(old)
+
+
+def queue_export(job):
+    if current_app.config.get('RQ_ENABLED'):
+        run_export.queue(str(job.uuid))
+    else:
+        run_export(str(job.uuid))
+
+
+@rq.job(timeout=3600)
+def run_export(job_uuid):
+    """
+    Writes an export a batch of carpools at a time, appending each batch
+    to the export file and then recording how far it got. If the worker
+    is stopped part way, running the job again drops anything written
+    after the last recorded batch and carries on from there. If the file
+    has lost some of what was recorded, the job starts over instead.
+    """
+    job = ExportJob.first_by_uuid(job_uuid)
+    if not job or job.status == ExportJob.STATUS_COMPLETE:
+        return
+
+    export = EXPORTS[job.kind]
+    store = get_export_store()
+
+    job.status = ExportJob.STATUS_RUNNING
+    if job.carpools_total is None:
+        job.carpools_total = Carpool.query.count()
+    if store.size(job.filename) < job.bytes_written:
+        # The file was lost, e.g. on a new container, so start over
+        current_app.logger.warning(
+            "Export %s file is missing or short, starting it over", job.uuid)
+        job.restart()
+    db.session.commit()
+
+    try:
+        with store.open(job.filename, job.bytes_written) as out:
+            if not job.bytes_written:
+                _write_batch(job, out, [export['title'], export['header']])
+
+            while True:
+                carpool_ids = [row.id for row in db.session.execute(
+                    'select id from carpools where id > :after '
+                    'order by id limit :limit',
+                    {'after': job.last_key, 'limit': EXPORT_BATCH_CARPOOLS})]
+                if not carpool_ids:
+                    break
+
+                query = export['query'].format(
+                    filters='and cp.id > :after and cp.id <= :upto',
+                    order_by=export['order_by'])
+                rows = stream_query(query, {
+                    'after': job.last_key,
+                    'upto': carpool_ids[-1],
+                })
+                _write_batch(job, out, map(export['format_row'], rows),
+                             carpools=carpool_ids)
+
+        job.status = ExportJob.STATUS_COMPLETE
+        job.finished_at = datetime.datetime.utcnow()
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.exception("Export %s failed", job.uuid)
+        job.status = ExportJob.STATUS_FAILED
+        job.error = str(e)
+        db.session.commit()
+        raise
+
+
+def _write_batch(job, out, rows, carpools=()):
+    """
+    Appends rows to the export file, makes sure they're written, and
+    then records them on the job.
+    """
+    output = io.StringIO()
+    writer = csv.writer(output)
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+
+    data = output.getvalue().encode('utf-8')
+    out.write(data)
+    out.flush()
+
+    job.bytes_written += len(data)
+    if carpools:
+        job.rows_written += count
+        job.carpools_written += len(carpools)
+        job.last_key = carpools[-1]
+    db.session.commit()
@@ -0,0 +1,28 @@
+import os
+from app import create_app
+from app.admin.exports import delete_old_exports, queue_export
+from app.models import ExportJob
+
+app = create_app(os.environ.get('CARPOOL_ENV', 'default'))
+
+
+@app.cli.command()
+def resume_export_jobs():
+    """ Queue every export that stopped part way to carry on from where it was. """
+    unfinished = ExportJob.query.filter(
+        ExportJob.status != ExportJob.STATUS_COMPLETE)
+
+    for job in unfinished:
+        if not job.is_stalled:
+            continue
+
+        app.logger.info("Resuming %s export %s after carpool %s",
+                        job.kind, job.uuid, job.last_key)
+        queue_export(job)
+
+
+@app.cli.command()
+def delete_old_export_jobs():
+    """ Delete the finished exports that are past EXPORT_RETENTION_HOURS. """
+    deleted = delete_old_exports()
+    app.logger.info("Deleted %s old exports", deleted)
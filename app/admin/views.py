@@ -1,25 +1,39 @@
-import csv
-import io
+import datetime
 from flask import (
     current_app,
     flash,
     redirect,
     render_template,
     request,
+    abort,
+    jsonify,
     Response,
+    stream_with_context,
     url_for,
 )
 from flask_login import current_user
 from . import admin_bp
+from .exports import (
+    carpool_rows,
+    csv_chunks,
+    EXPORTS,
+    delete_exports,
+    get_export_store,
+    queue_export,
+    start_export,
+    user_rows,
+)
 from .forms import (
     CancelCarpoolAdminForm,
     DeleteDestinationForm,
     DestinationForm,
     ProfilePurgeForm,
 )
-from geoalchemy2.shape import to_shape
 from .. import db
-from ..email import send_email
+from ..email.fanout import destination_deleted_snapshot, send_fanout_email
+from ..email.rendering import render_email_template, render_time_stats
+from ..carpool.search import invalidate_search_cache
+from ..destination.cache import invalidate_visible_destinations
 from ..carpool.views import (
     cancel_carpool,
     email_driver_rider_cancelled_request,
@@ -27,6 +41,8 @@ from ..carpool.views import (
 from ..models import (
     Carpool,
     Destination,
+    ExportJob,
+    LonLat,
     Person,
     Role,
     PersonRole,
@@ -102,6 +118,7 @@ def user_purge(uuid):
                 current_app.logger.info("Deleting user %s", user.id)
                 db.session.delete(user)
                 db.session.commit()
+                invalidate_search_cache()
             except:
                 db.session.rollback()
                 current_app.logger.exception("Problem deleting user account")
@@ -157,83 +174,90 @@ def user_list():
     )
 
 
+DRIVERS_AND_RIDERS_QUERY = '''
+    select d.name destination, cp.leave_time leave_time,
+        cp.return_time return_time, 'rider' as rider_driver,
+        p.name person_name, p.email email, p.phone_number phone,
+        p.preferred_contact_method contact, p.uuid uuid
+    from carpools cp, destinations d, people p, riders r
+    where cp.destination_id=d.id and cp.id=r.carpool_id and
+        r.status='approved' and r.person_id=p.id {filters}
+    union
+    select d.name destination, cp.leave_time leave_time,
+        cp.return_time returntime, 'driver' as rider_driver,
+        p.name person_name, p.email email, p.phone_number phone,
+        p.preferred_contact_method contact, p.uuid uuid
+    from carpools cp, destinations d, people p
+    where cp.destination_id=d.id and cp.driver_id=p.id {filters}
+    order by destination, leave_time, person_name, rider_driver, uuid
+    limit :limit offset :offset
+'''
+
+
+def parse_date_arg(name):
+    value = request.args.get(name)
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        return None
+
+
 @admin_bp.route('/admin/drivers_and_riders')
 def driver_and_rider_list():
-    page = request.args.get('page')
-    page = int(page) if page is not None else 1
+    page = request.args.get('page', 1, type=int)
+    page = max(page, 1)
     per_page = 15
 
-    query = '''
-        select d.name destination, cp.leave_time leave_time,
-            cp.return_time return_time, 'rider' as rider_driver,
-            p.name person_name, p.email email, p.phone_number phone,
-            p.preferred_contact_method contact, p.uuid uuid
-        from carpools cp, destinations d, people p, riders r
-        where cp.destination_id=d.id and cp.id=r.carpool_id and
-            r.status='approved' and r.person_id=p.id
-        union
-        select d.name destination, cp.leave_time leave_time,
-            cp.return_time returntime, 'driver' as rider_driver,
-            p.name person_name, p.email email, p.phone_number phone,
-            p.preferred_contact_method contact, p.uuid uuid
-        from carpools cp, destinations d, people p
-        where cp.destination_id=d.id and cp.driver_id=p.id
-        order by destination, leave_time, person_name
-    '''
-    result = list(db.engine.execute(query))
-    if per_page * page > len(result):
-        paginated_result = result[per_page * (page - 1):]
-    else:
-        paginated_result = result[per_page * (page - 1):per_page * page]
+    # Filters are applied inside both halves of the union, so only the
+    # matching carpools are ever read.
+    destination = None
+    destination_uuid = request.args.get('destination')
+    if destination_uuid and Destination.validate_uuid_format(destination_uuid):
+        destination = Destination.first_by_uuid(destination_uuid)
+    leave_after = parse_date_arg('leave_after')
+    leave_before = parse_date_arg('leave_before')
+
+    filters = []
+    params = {
+        # Fetch one extra row to find out whether there's a next page
+        # without counting every driver and rider
+        'limit': per_page + 1,
+        'offset': per_page * (page - 1),
+    }
+    if destination:
+        filters.append('cp.destination_id = :destination_id')
+        params['destination_id'] = destination.id
+    if leave_after:
+        filters.append('cp.leave_time >= :leave_after')
+        params['leave_after'] = leave_after
+    if leave_before:
+        filters.append('cp.leave_time < :leave_before')
+        params['leave_before'] = leave_before + datetime.timedelta(days=1)
+
+    query = DRIVERS_AND_RIDERS_QUERY.format(
+        filters=''.join(' and ' + f for f in filters))
+    result = db.session.execute(query, params).fetchall()
+
+    filter_args = {
+        'destination': destination.uuid if destination else None,
+        'leave_after': leave_after.isoformat() if leave_after else None,
+        'leave_before': leave_before.isoformat() if leave_before else None,
+    }
     return render_template(
         'admin/users/drivers_and_riders.html',
-        drivers_and_riders=paginated_result,
+        drivers_and_riders=result[:per_page],
+        destinations=Destination.query.order_by(Destination.name).all(),
+        filter_args=filter_args,
         page=page,
-        not_last=(per_page * page) < len(result),
+        not_last=len(result) > per_page,
         not_first=(page > 1)
     )
 
 
 @admin_bp.route('/admin/users.csv')
 def user_list_csv():
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['Nomad carpool drivers and riders'])
-    writer.writerow(['carpool_id', 'destination', 'carpool leave time', 'carpool return time',
-                     'driver/rider', 'name', 'email', 'phone', 'preferred contact method'])
-
-    query = '''
-        select cp.id carpool_id, d.name destination, cp.leave_time leave_time,
-            cp.return_time return_time, 'rider' as rider_driver,
-            p.name person_name, p.email email, p.phone_number phone,
-            p.preferred_contact_method contact
-        from carpools cp, destinations d, people p, riders r
-        where cp.destination_id=d.id and cp.id=r.carpool_id and
-            r.status='approved' and r.person_id=p.id
-        union
-        select cp.id carpool_id, d.name destination, cp.leave_time leave_time,
-            cp.return_time returntime, 'driver' as rider_driver,
-            p.name person_name, p.email email, p.phone_number phone,
-            p.preferred_contact_method contact
-        from carpools cp, destinations d, people p
-        where cp.destination_id=d.id and cp.driver_id=p.id
-        order by destination, leave_time, person_name
-    '''
-    for row in db.engine.execute(query):
-        writer.writerow([
-            row.carpool_id,
-            row.destination,
-            row.leave_time.strftime('%x %X'),
-            row.return_time.strftime('%x %X'),
-            row.rider_driver,
-            row.person_name,
-            row.email,
-            row.phone,
-            row.contact
-        ])
-
     return Response(
-        output.getvalue(),
+        stream_with_context(csv_chunks(user_rows())),
         mimetype='text/csv',
         headers={
             'Content-disposition': 'attachment; filename=nomad_users.csv'
@@ -256,53 +280,8 @@ def carpool_list():
 
 @admin_bp.route('/admin/carpools.csv')
 def carpool_list_csv():
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['Nomad carpools'])
-    writer.writerow(['from', 'from lat/lon',
-                     'destination', 'destination lat/lon', 'destination address',
-                     'leave time', 'return time',
-                     'driver name', 'drive email',
-                     'max riders', 'ride requests', 'approved riders',
-                     'status', 'reason for cancellation'
-                     ])
-
-    query = '''
-        select cp.from_place as from_place, st_x(cp.from_point) as from_lon, st_y(cp.from_point) as from_lat,
-               d.name as destination, st_x(d.point) as destination_lon, st_y(d.point) as destination_lat,
-               d.address as destination_address,
-               cp.leave_time as leave_time,
-               cp.return_time as return_time,
-               dp.name as driver_name, dp.email as driver_email,
-               cp.max_riders as max_riders,
-               cp.canceled as canceled,
-               cp.cancel_reason as cancel_reason,
-               (select count(*) from riders where carpool_id=cp.id) as request_count,
-               (select count(*) from riders where carpool_id=cp.id and status='approved') as approved_count
-        from carpools cp
-        full outer join destinations d on (cp.destination_id=d.id)
-        inner join people dp on (dp.id=cp.driver_id)
-    '''
-    for row in db.engine.execute(query):
-        writer.writerow([
-            row.from_place,
-            ','.join(map(str, [row.from_lat, row.from_lon])),
-            row.destination,
-            ','.join(map(str, [row.destination_lat, row.destination_lon])),
-            row.destination_address,
-            row.leave_time.strftime('%x %X'),
-            row.return_time.strftime('%x %X'),
-            row.driver_name,
-            row.driver_email,
-            row.max_riders,
-            row.request_count,
-            row.approved_count,
-            "Canceled" if row.canceled else 'Active',
-            row.cancel_reason,
-        ])
-
     return Response(
-        output.getvalue(),
+        stream_with_context(csv_chunks(carpool_rows())),
         mimetype='text/csv',
         headers={
             'Content-disposition': 'attachment; filename=nomad_carpools.csv'
@@ -310,6 +289,84 @@ def carpool_list_csv():
     )
 
 
+@admin_bp.route('/admin/exports')
+def export_list():
+    jobs = ExportJob.query.\
+        order_by(ExportJob.created_at.desc()).\
+        limit(20)
+
+    return render_template(
+        'admin/exports/list.html',
+        jobs=jobs,
+        kinds=sorted(EXPORTS),
+    )
+
+
+@admin_bp.route('/admin/exports/<kind>/start', methods=['POST'])
+def export_start(kind):
+    if kind not in EXPORTS:
+        abort(404)
+
+    job = start_export(kind, Person.query.get(current_user.id))
+
+    return redirect(url_for('admin.export_show', uuid=job.uuid))
+
+
+@admin_bp.route('/admin/exports/<uuid>')
+def export_show(uuid):
+    job = ExportJob.uuid_or_404(uuid)
+
+    return render_template(
+        'admin/exports/show.html',
+        job=job,
+    )
+
+
+@admin_bp.route('/admin/exports/<uuid>/status.json')
+def export_status(uuid):
+    job = ExportJob.uuid_or_404(uuid)
+
+    return jsonify(job.as_json())
+
+
+@admin_bp.route('/admin/exports/<uuid>/resume', methods=['POST'])
+def export_resume(uuid):
+    job = ExportJob.uuid_or_404(uuid)
+
+    if job.is_stalled:
+        job.status = ExportJob.STATUS_QUEUED
+        job.error = None
+        db.session.commit()
+        queue_export(job)
+        flash("The export was restarted from where it stopped", 'success')
+
+    return redirect(url_for('admin.export_show', uuid=job.uuid))
+
+
+@admin_bp.route('/admin/exports/<uuid>/delete', methods=['POST'])
+def export_delete(uuid):
+    job = ExportJob.uuid_or_404(uuid)
+
+    if job.status == ExportJob.STATUS_COMPLETE or job.is_stalled:
+        delete_exports([job])
+        flash("The export was deleted", 'success')
+        return redirect(url_for('admin.export_list'))
+
+    flash("The export can't be deleted while it's running", 'error')
+    return redirect(url_for('admin.export_show', uuid=job.uuid))
+
+
+@admin_bp.route('/admin/exports/<uuid>/download')
+def export_download(uuid):
+    job = ExportJob.uuid_or_404(uuid)
+    store = get_export_store()
+
+    if job.status != ExportJob.STATUS_COMPLETE or not store.exists(job.filename):
+        abort(404)
+
+    return store.send(job.filename, EXPORTS[job.kind]['filename'])
+
+
 @admin_bp.route('/admin/destinations')
 def destinations_list():
     page = request.args.get('page')
@@ -339,6 +396,7 @@ def destinations_add():
         )
         db.session.add(destination)
         db.session.commit()
+        invalidate_visible_destinations()
 
         flash("You added a destination.", 'success')
 
@@ -356,12 +414,12 @@ def destinations_add():
 def destinations_show(uuid):
     dest = Destination.uuid_or_404(uuid)
 
-    point = to_shape(dest.point)
+    point = LonLat.from_element(dest.point)
     edit_form = DestinationForm(
         name=dest.name,
         address=dest.address,
-        destination_lat=point.y,
-        destination_lon=point.x,
+        destination_lat=point.lat,
+        destination_lon=point.lon,
     )
 
     if edit_form.validate_on_submit():
@@ -372,9 +430,11 @@ def destinations_show(uuid):
             edit_form.destination_lat.data
         )
 
-        _send_destination_action_email(dest, 'modified', 'modified')
-
         db.session.commit()
+        invalidate_search_cache()
+        invalidate_visible_destinations()
+
+        send_fanout_email('destination_modified', destination_id=dest.id)
         flash("Your destination was updated", 'success')
         return redirect(url_for('admin.destinations_show', uuid=uuid))
 
@@ -392,9 +452,12 @@ def destinations_delete(uuid):
     delete_form = DeleteDestinationForm()
     if delete_form.validate_on_submit():
         if delete_form.submit.data:
-            _send_destination_action_email(dest, 'cancelled', 'deleted')
+            send_fanout_email('destination_deleted',
+                              **destination_deleted_snapshot(dest))
             db.session.delete(dest)
             db.session.commit()
+            invalidate_search_cache()
+            invalidate_visible_destinations()
 
             flash("Your destination was deleted", 'success')
             return redirect(url_for('admin.destinations_list'))
@@ -408,35 +471,6 @@ def destinations_delete(uuid):
     )
 
 
-def _send_destination_action_email(destination, verb, template_base):
-    for carpool in destination.carpools:
-        subject = 'Carpool on {} {}'.format(
-            carpool.leave_time_formatted,
-            verb
-        )
-
-        # For carpool riders
-        for ride_request in carpool.ride_requests:
-            send_email(
-                'admin_destination_{}'.format(template_base),
-                ride_request.person.email,
-                subject,
-                destination=destination,
-                carpool=carpool,
-                person=ride_request.person,
-            )
-
-        # For carpool driver
-        send_email(
-            'admin_destination_{}'.format(template_base),
-            carpool.driver.email,
-            subject,
-            destination=destination,
-            carpool=carpool,
-            person=carpool.driver,
-        )
-
-
 @admin_bp.route('/admin/destinations/<uuid>/togglehidden', methods=['POST'])
 def destinations_toggle_hidden(uuid):
     dest = Destination.uuid_or_404(uuid)
@@ -444,6 +478,8 @@ def destinations_toggle_hidden(uuid):
     dest.hidden = not dest.hidden
     db.session.add(dest)
     db.session.commit()
+    invalidate_search_cache()
+    invalidate_visible_destinations()
 
     if dest.hidden:
         flash("Your destination was hidden", 'success')
@@ -466,10 +502,15 @@ def email_preview(template):
         'ride_request': RideRequest.query.first(),
         'reason': 'Placeholder reason'
     }
-    text = render_template('email/{}.txt'.format(template), **data)
-    html = render_template('email/{}.html'.format(template), **data)
-
-    return render_template('admin/emailpreview.html', template=template, text=text, html=html)
+    text = render_email_template('email/{}.txt'.format(template), **data)
+    html = render_email_template('email/{}.html'.format(template), **data)
+    stats = [
+        render_time_stats('email/{}.txt'.format(template)),
+        render_time_stats('email/{}.html'.format(template)),
+    ]
+
+    return render_template('admin/emailpreview.html', template=template,
+                           text=text, html=html, stats=stats)
 
 
 @admin_bp.route('/admin/<uuid>/cancel', methods=['GET', 'POST'])
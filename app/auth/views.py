@@ -6,6 +6,7 @@ from six.moves.urllib.parse import urljoin, urlparse
 
 from . import auth_bp
 from .. import db, sentry
+from ..carpool.search import invalidate_search_cache
 from ..carpool.views import (cancel_carpool,
                              email_driver_rider_cancelled_request)
 from ..models import Person
@@ -130,14 +131,15 @@ def profile():
     )
 
     if profile_form.validate_on_submit():
-        current_user.name = profile_form.name.data.strip()
-        current_user.gender = profile_form.gender.data
-        current_user.gender_self_describe = \
+        person = Person.query.get(current_user.id)
+        person.name = profile_form.name.data.strip()
+        person.gender = profile_form.gender.data
+        person.gender_self_describe = \
             profile_form.gender_self_describe.data.strip()
-        current_user.phone_number = profile_form.phone_number.data
-        current_user.preferred_contact_method = \
+        person.phone_number = profile_form.phone_number.data
+        person.preferred_contact_method = \
             profile_form.preferred_contact.data
-        db.session.add(current_user)
+        db.session.add(person)
         db.session.commit()
 
         flash("You updated your profile.", 'success')
@@ -184,6 +186,7 @@ def profile_delete():
             user = Person.query.get(current_user.id)
             db.session.delete(user)
             db.session.commit()
+            invalidate_search_cache()
 
             logout_user()
         except:
@@ -0,0 +1,143 @@
+"""
+Loads large numbers of rows with COPY FROM STDIN instead of the ORM, for
+seeding big synthetic datasets (see benchmarks/data.py). Rows are dicts
+of column values, streamed to Postgres as they're generated.
+"""
+import contextlib
+import datetime
+import itertools
+import struct
+
+from . import db
+
+# EWKB geometry type of a point with an SRID
+EWKB_POINT_WITH_SRID = 0x20000001
+
+
+def ewkb_point(lat, lon, srid=4326):
+    """ Returns a point as hex EWKB, which PostGIS reads straight into geometry columns. """
+    return struct.pack('<BIIdd', 1, EWKB_POINT_WITH_SRID, srid, lon, lat).hex()
+
+
+def _copy_value(value):
+    """ Formats a value for COPY's text format. """
+    if value is None:
+        return '\\N'
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+
+    return str(value).\
+        replace('\\', '\\\\').\
+        replace('\t', '\\t').\
+        replace('\n', '\\n').\
+        replace('\r', '\\r')
+
+
+class _CopyStream(object):
+    """ A file-like object that reads lines from an iterator as COPY asks for them. """
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.buffer = ''
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        for line in self.lines:
+            chunks.append(line)
+            length += len(line)
+            if 0 <= size <= length:
+                break
+
+        data = ''.join(chunks)
+        if size < 0:
+            size = len(data)
+        self.buffer = data[size:]
+        return data[:size]
+
+
+def copy_rows(table, rows):
+    """
+    Streams `rows`, dicts that all have the same keys, into `table` with
+    COPY FROM STDIN in the session's transaction. Geometry columns take
+    EWKB (see ewkb_point) or EWKT strings. Returns the number of rows.
+    """
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is None:
+        return 0
+
+    columns = list(first)
+    copied = 0
+
+    def lines():
+        nonlocal copied
+        for row in itertools.chain([first], rows):
+            copied += 1
+            yield '\t'.join(_copy_value(row[column]) for column in columns) + '\n'
+
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert(
+        'COPY {} ({}) FROM STDIN'.format(table.name, ', '.join(columns)),
+        _CopyStream(lines()),
+    )
+    cursor.close()
+
+    return copied
+
+
+def drop_indexes(table):
+    """
+    Drops the indexes of `table` that don't back a constraint (primary
+    keys and unique constraints stay), and returns their definitions.
+    """
+    indexes = db.session.execute('''
+        select indexname, indexdef
+        from pg_indexes
+        where schemaname = current_schema()
+          and tablename = :table
+          and indexname not in (select conname from pg_constraint)
+    ''', {'table': table.name}).fetchall()
+
+    for name, _ in indexes:
+        db.session.execute('drop index {}'.format(name))
+
+    return [definition for _, definition in indexes]
+
+
+def reset_sequences(*tables):
+    """ Moves the tables' id sequences past ids that were loaded explicitly. """
+    for table in tables:
+        db.session.execute(
+            "select setval(pg_get_serial_sequence('{0}', 'id'), "
+            "coalesce((select max(id) from {0}), 0) + 1, false)".format(table.name))
+
+
+@contextlib.contextmanager
+def bulk_loading(*tables):
+    """
+    Drops the tables' indexes while the block loads them, so they're built
+    once at the end instead of updated row by row, then resets their id
+    sequences, commits and ANALYZEs them so the planner knows their new
+    size. The tables are locked until then, so only use this on
+    databases nobody else is using. If the block raises, the rollback
+    puts the indexes back.
+    """
+    definitions = []
+    for table in tables:
+        definitions.extend(drop_indexes(table))
+
+    yield
+
+    for definition in definitions:
+        db.session.execute(definition)
+    reset_sequences(*tables)
+    db.session.commit()
+
+    for table in tables:
+        db.session.execute('analyze {}'.format(table.name))
+    db.session.commit()
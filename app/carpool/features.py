@@ -0,0 +1,137 @@
+"""
+Caches each carpool's search result GeoJSON Feature as an encoded JSON
+fragment, so searches don't format, escape and encode the same carpools
+over and over. Only what differs between requests is encoded per
+request: the scheme and host of the feature's URL, the start point, which
+may be approximated for the viewer, and the seats available.
+
+A carpool's fragment is dropped when a commit changes the carpool, one of
+its ride requests' status, its destination or its driver.
+"""
+import json
+from flask import current_app, escape, has_app_context, request, url_for
+from sqlalchemy import event, inspect
+from ..models import Carpool, Destination, Person, RideRequest
+from .. import cache, db
+
+# The parts of a feature that change between requests: the URL root put
+# before a fragment, which starts with the rest of the feature's URL, and
+# what's appended to the fragment's still open properties object
+FEATURE_HEAD = '{{"type":"Feature","id":"{}'
+FEATURE_TAIL = ',"seats_available":{},"is_approximate_location":{}}},"geometry":{}}}'
+
+
+def _feature_cache_key(carpool_id):
+    return 'carpool-feature:{}'.format(carpool_id)
+
+
+def encode_feature_fragment(pool):
+    """
+    Returns the GeoJSON Feature for a search result row, starting with
+    its URL's path and with its properties object left open, for
+    `render_feature` to finish. The URL's scheme and host depend on the
+    request, so they aren't cached.
+    """
+    dt_format = current_app.config.get('DATE_FORMAT')
+    properties = json.dumps({
+        'from_place': escape(pool.from_place),
+        'to_place': escape(pool.destination_name),
+        'leave_time': pool.leave_time.isoformat(),
+        'return_time': pool.return_time.isoformat(),
+        'leave_time_human': pool.leave_time.strftime(dt_format),
+        'return_time_human': pool.return_time.strftime(dt_format),
+        'driver_gender': escape(pool.driver_gender),
+        'hidden': pool.destination_hidden,
+    }, separators=(',', ':'))
+
+    return '{}","properties":{}'.format(
+        json.dumps(url_for('carpool.details', uuid=pool.uuid))[1:-1],
+        properties[:-1],
+    )
+
+
+def feature_fragments(pools):
+    """
+    Returns the encoded feature fragment of each search result row in
+    `pools`, from the cache when possible, in one cache round trip.
+    """
+    if not pools:
+        return []
+
+    keys = [_feature_cache_key(pool.id) for pool in pools]
+    fragments = cache.get_many(*keys)
+
+    missing = {}
+    for i, pool in enumerate(pools):
+        if fragments[i] is None:
+            fragments[i] = missing[keys[i]] = encode_feature_fragment(pool)
+
+    if missing:
+        cache.set_many(missing,
+                       timeout=current_app.config.get('CARPOOL_FEATURE_CACHE_TIMEOUT'))
+    return fragments
+
+
+def render_feature(fragment, seats_available, from_point, is_approximate_location):
+    """ Finishes a feature fragment with the parts that vary per request. """
+    url_root = json.dumps(request.host_url.rstrip('/'))[1:-1]
+    return FEATURE_HEAD.format(url_root) + fragment + FEATURE_TAIL.format(
+        int(seats_available),
+        'true' if is_approximate_location else 'false',
+        json.dumps(from_point.as_geojson(), separators=(',', ':')),
+    )
+
+
+def feature_collection_response(features):
+    """ Returns a GeoJSON FeatureCollection response of rendered features. """
+    return current_app.response_class(
+        '{"type":"FeatureCollection","features":[' + ','.join(features) + ']}',
+        mimetype=current_app.config['JSONIFY_MIMETYPE'],
+    )
+
+
+def invalidate_carpool_features(*carpool_ids):
+    """ Forgets the cached feature fragments of the given carpools. """
+    if carpool_ids:
+        cache.delete_many(*[_feature_cache_key(i) for i in carpool_ids])
+
+
+def _changed(obj, *attrs):
+    state = inspect(obj)
+    return any(state.attrs[attr].history.has_changes() for attr in attrs)
+
+
+@event.listens_for(db.session, 'before_flush')
+def collect_changed_carpool_features(session, flush_context, instances):
+    """
+    Notes the carpools whose feature fragments the flush makes stale, so
+    they can be dropped once the transaction commits.
+    """
+    changed = session.info.setdefault('changed_carpool_features', set())
+
+    for obj in session.dirty | session.deleted:
+        if isinstance(obj, Carpool):
+            changed.add(obj.id)
+        elif isinstance(obj, RideRequest):
+            if obj in session.deleted or _changed(obj, 'status'):
+                changed.add(obj.carpool_id)
+        elif isinstance(obj, Destination):
+            if obj in session.deleted or _changed(obj, 'name', 'hidden'):
+                changed.update(c.id for c in session.query(Carpool.id).
+                               filter(Carpool.destination_id == obj.id))
+        elif isinstance(obj, Person):
+            if obj in session.deleted or _changed(obj, 'gender'):
+                changed.update(c.id for c in session.query(Carpool.id).
+                               filter(Carpool.driver_id == obj.id))
+
+
+@event.listens_for(db.session, 'after_commit')
+def invalidate_changed_carpool_features(session):
+    changed = session.info.pop('changed_carpool_features', None)
+    if changed and has_app_context():
+        invalidate_carpool_features(*(i for i in changed if i is not None))
+
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_changed_carpool_features(session):
+    session.info.pop('changed_carpool_features', None)
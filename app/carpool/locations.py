@@ -0,0 +1,75 @@
+"""
+Approximates carpool start locations for people who shouldn't see exactly
+where a driver is leaving from: everyone but the driver and the riders
+they've approved.
+
+A page of search results is fuzzed in one pass. Each carpool's jitter is
+drawn from a seed derived from the app's secret key, the carpool and the
+day, so a carpool shows up in the same approximate place all day. That
+keeps the approximate location cacheable, and means it can't be averaged
+back to the real one by reloading the page.
+"""
+import datetime
+import hashlib
+import hmac
+import struct
+from flask import current_app
+from ..models import LonLat
+
+# Start points are rounded to this many decimal places (about a kilometer)
+APPROXIMATE_PLACES = 2
+# and then moved up to this many degrees in each direction
+APPROXIMATE_JITTER = .005
+
+_MAX_SEED = 0xffffffff
+
+
+def _secret_key():
+    key = current_app.secret_key
+    return key.encode() if isinstance(key, str) else key
+
+
+def approximate_coordinates(carpool_ids, coordinates, day=None):
+    """
+    Returns the approximate locations of the carpools in `carpool_ids`,
+    given their exact `coordinates` as (lon, lat) pairs, on `day` (today
+    in UTC by default).
+    """
+    day = (day or datetime.datetime.utcnow().date()).isoformat()
+    key = _secret_key()
+    scale = 2 * APPROXIMATE_JITTER / _MAX_SEED
+
+    approximate = []
+    for carpool_id, (lon, lat) in zip(carpool_ids, coordinates):
+        seed = hmac.new(key, '{}:{}'.format(carpool_id, day).encode(),
+                        hashlib.sha256).digest()
+        lon_seed, lat_seed = struct.unpack_from('<II', seed)
+        approximate.append(LonLat(
+            round(lon, APPROXIMATE_PLACES) + lon_seed * scale - APPROXIMATE_JITTER,
+            round(lat, APPROXIMATE_PLACES) + lat_seed * scale - APPROXIMATE_JITTER,
+        ))
+    return approximate
+
+
+def locate_results(results, exact_carpool_ids, day=None):
+    """
+    Returns a (coordinates, is_approximate) pair for each search result:
+    the exact start point for carpools in `exact_carpool_ids`, and an
+    approximate one (see `approximate_coordinates`) for the rest.
+    """
+    fuzzed = [r for r in results if r['carpool_id'] not in exact_carpool_ids]
+    approximate = dict(zip(
+        (r['carpool_id'] for r in fuzzed),
+        approximate_coordinates(
+            [r['carpool_id'] for r in fuzzed],
+            [r['from_point'] for r in fuzzed],
+            day,
+        ),
+    ))
+
+    return [
+        (approximate[r['carpool_id']], True)
+        if r['carpool_id'] in approximate
+        else (r['from_point'], False)
+        for r in results
+    ]
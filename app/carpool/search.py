@@ -0,0 +1,93 @@
+import datetime
+from uuid import uuid4
+from flask import current_app
+from geoalchemy2 import func
+from ..models import Carpool, Destination, Person, as_geography
+from .. import cache, db
+
+# 50 miles in meters
+MAX_SEARCH_DISTANCE = 80467
+
+SEARCH_CACHE_VERSION_KEY = 'carpool-search-version'
+
+
+def search_carpools_near(lat, lon, ignore_prior=True, limit=None):
+    """
+    Returns the carpools starting near the given point, closest first.
+
+    Both the radius filter (ST_DWithin) and the ordering (<->) can be
+    answered from the GiST index on the start point as geography.
+
+    Every property needed to build a search result (seats available,
+    destination name and hidden flag, driver gender, start coordinates) comes
+    back in a single SQL statement, so building the response never lazy
+    loads a relationship.
+    """
+    search_point = func.ST_GeogFromText('SRID=4326;POINT(%s %s)' % (lon, lat))
+    from_point = as_geography(Carpool.from_point)
+
+    pools = db.session.query(
+        Carpool.id,
+        Carpool.uuid,
+        Carpool.driver_id,
+        Carpool.from_place,
+        func.ST_X(Carpool.from_point).label('from_lon'),
+        func.ST_Y(Carpool.from_point).label('from_lat'),
+        Carpool.leave_time,
+        Carpool.return_time,
+        (Carpool.max_riders - Carpool.approved_count).label('seats_available'),
+        Destination.name.label('destination_name'),
+        Destination.hidden.label('destination_hidden'),
+        Person.gender.label('driver_gender'),
+    ).\
+        join(Destination, Carpool.destination_id == Destination.id).\
+        join(Person, Carpool.driver_id == Person.id).\
+        filter(Carpool.canceled == False).\
+        filter(Carpool.from_point.isnot(None)).\
+        filter(Destination.hidden.isnot(True)).\
+        filter(Carpool.approved_count < Carpool.max_riders).\
+        filter(func.ST_DWithin(from_point, search_point, MAX_SEARCH_DISTANCE))
+
+    if ignore_prior:
+        pools = pools.filter(Carpool.leave_time >= datetime.datetime.utcnow())
+
+    # <-> orders by distance using the start point index (KNN search)
+    pools = pools.order_by(from_point.op('<->')(search_point))
+
+    if limit:
+        pools = pools.limit(limit)
+
+    return pools.all()
+
+
+def snap_to_grid(lat, lon):
+    """
+    Snaps a search point to the nearest point on the cache grid, so that
+    every search starting in the same tile shares one cached result.
+    """
+    grid = current_app.config.get('SEARCH_CACHE_GRID')
+    return round(round(lat / grid) * grid, 6), round(round(lon / grid) * grid, 6)
+
+
+def search_cache_key(lat, lon, ignore_prior):
+    """
+    Returns the cache key for searches near the given (snapped) point.
+
+    Keys embed the current search cache version, so bumping the version
+    with `invalidate_search_cache()` orphans every cached search at once.
+    """
+    version = cache.get(SEARCH_CACHE_VERSION_KEY)
+    if version is None:
+        version = uuid4().hex
+        cache.set(SEARCH_CACHE_VERSION_KEY, version, timeout=0)
+
+    return 'carpool-search:{}:{}:{}:{}'.format(version, lat, lon, ignore_prior)
+
+
+def invalidate_search_cache():
+    """
+    Forgets every cached search. Call this after committing any change
+    that could alter a search result: a carpool being created, edited or
+    cancelled, a ride request changing status, or a destination changing.
+    """
+    cache.set(SEARCH_CACHE_VERSION_KEY, uuid4().hex, timeout=0)
@@ -0,0 +1,14 @@
+import os
+from app import create_app
+from app.models import Carpool
+
+app = create_app(os.environ.get('CARPOOL_ENV', 'default'))
+
+
+@app.cli.command()
+def reconcile_approved_counts():
+    """ Recompute every carpool's approved rider count from its riders. """
+    corrected = Carpool.reconcile_approved_counts()
+
+    app.logger.info("Corrected the approved rider count of %s carpools",
+                    corrected)
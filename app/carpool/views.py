@@ -1,12 +1,9 @@
 import datetime
-import random
 from dateutil import tz
 from flask import (
     abort,
     current_app,
-    escape,
     flash,
-    jsonify,
     make_response,
     redirect,
     render_template,
@@ -15,18 +12,31 @@ from flask import (
     url_for,
 )
 from flask_login import current_user, login_required
-from geoalchemy2 import func
-from geoalchemy2.shape import to_shape, from_shape
-from shapely.geometry import mapping, Point
+from sqlalchemy.orm import joinedload, selectinload
 from . import pool_bp
+from ..destination.cache import visible_destination, visible_destinations
 from ..email import send_email
+from ..email.fanout import carpool_cancelled_snapshot, send_fanout_email
+from .features import (
+    feature_collection_response,
+    feature_fragments,
+    render_feature,
+)
+from .locations import locate_results
+from .search import (
+    invalidate_search_cache,
+    search_cache_key,
+    search_carpools_near,
+    snap_to_grid,
+)
 from .forms import (
     CancelCarpoolDriverForm,
     DriverForm,
     RiderForm,
 )
-from ..models import Carpool, Destination, RideRequest
-from .. import db
+from ..models import Carpool, LonLat, RideRequest
+from ..query_stats import query_budget
+from .. import cache, db
 
 
 @pool_bp.route('/robots.txt')
@@ -60,22 +70,39 @@ def find():
     )
 
 
-def approximate_location(geometry):
-    # 'coordinates': [-121.88632860000001, 37.3382082]
-    coord = geometry['coordinates']
-    geometry['coordinates'] = [
-        round(coord[0], 2) + random.uniform(-.005, .005),
-        round(coord[1], 2) + random.uniform(-.005, .005),
+def _search_results(lat, lon, ignore_prior):
+    """
+    Returns the viewer-independent part of the search results near the
+    given point, from the search cache when possible.
+    """
+    lat, lon = snap_to_grid(lat, lon)
+    key = search_cache_key(lat, lon, ignore_prior)
+
+    results = cache.get(key)
+    if results is not None:
+        return results
+
+    pools = search_carpools_near(lat, lon, ignore_prior=ignore_prior)
+    results = [
+        {
+            'carpool_id': pool.id,
+            'driver_id': pool.driver_id,
+            'from_point': LonLat(pool.from_lon, pool.from_lat),
+            'seats_available': pool.seats_available,
+            'feature': fragment,
+        }
+        for pool, fragment in zip(pools, feature_fragments(pools))
     ]
-    return geometry
+
+    cache.set(key, results,
+              timeout=current_app.config.get('SEARCH_CACHE_TIMEOUT'))
+    return results
 
 
 @pool_bp.route('/carpools/starts.geojson')
+@query_budget(8)
 def start_geojson():
-    pools = Carpool.query.filter(Carpool.canceled == False)
-
-    if request.args.get('ignore_prior') != 'false':
-        pools = pools.filter(Carpool.leave_time >= datetime.datetime.utcnow())
+    ignore_prior = request.args.get('ignore_prior') != 'false'
 
     try:
         near_lat = request.args.get('near.lat', type=float)
@@ -83,94 +110,70 @@ def start_geojson():
     except ValueError:
         abort(400, "Invalid lat/lon format")
 
-    max_distance = 80467  # 50 miles in meters
-    search_point = 'POINT(%s %s)' % (near_lon, near_lat)
-
-    # ST_DistanceSphere returns minimum distance in meters between two lon/lat geometries
-    pools = pools.filter(
-        func.ST_DistanceSphere(Carpool.from_point, search_point) <= max_distance
-    )
-    pools = pools.order_by(func.ST_DistanceSphere(Carpool.from_point, search_point))
-
-    riders = db.session.query(RideRequest.carpool_id,
-                              func.count(RideRequest.id).label('pax')).\
-        filter(RideRequest.status == 'approved').\
-        group_by(RideRequest.carpool_id).\
-        subquery('riders')
-
-    pools = pools.filter(Carpool.from_point.isnot(None)).\
-        filter(Carpool.destination_id == Destination.id).\
-        filter(Destination.hidden.isnot(True)).\
-        outerjoin(riders, Carpool.id == riders.c.carpool_id).\
-        filter(riders.c.pax.is_(None) | (riders.c.pax < Carpool.max_riders))
+    if near_lat is None or near_lon is None:
+        abort(400, "Invalid lat/lon format")
 
-    features = []
-    dt_format = current_app.config.get('DATE_FORMAT')
+    results = _search_results(near_lat, near_lon, ignore_prior)
 
-    # get the current user's confirmed carpools
-    confirmed_carpools = []
+    # show real location to driver and confirmed passenger
+    exact_carpool_ids = set()
     if not current_user.is_anonymous:
-        rides = RideRequest.query.filter(RideRequest.status == 'approved').\
+        rides = db.session.query(RideRequest.carpool_id).\
+            filter(RideRequest.status == 'approved').\
             filter(RideRequest.person_id == current_user.id)
-        for ride in rides:
-            confirmed_carpools.append(ride.carpool_id)
+        exact_carpool_ids.update(ride.carpool_id for ride in rides)
+        exact_carpool_ids.update(
+            r['carpool_id'] for r in results
+            if r['driver_id'] == current_user.id)
     else:
         # anonymous user can only see 3 results
-        pools = pools.limit(3)
-
-    for pool in pools:
-        # show real location to driver and confirmed passenger
-        geometry = mapping(to_shape(pool.from_point))
-        if not current_user.is_anonymous and \
-            (pool.driver_id == current_user.id or pool.id in confirmed_carpools):
-            is_approximate_location = False
-        else:
-            is_approximate_location = True
-            geometry = approximate_location(geometry)
-
-        features.append({
-            'type': 'Feature',
-            'geometry': geometry,
-            'id': url_for('carpool.details', uuid=pool.uuid, _external=True),
-            'properties': {
-                'from_place': escape(pool.from_place),
-                'to_place': escape(pool.destination.name),
-                'seats_available': pool.seats_available,
-                'leave_time': pool.leave_time.isoformat(),
-                'return_time': pool.return_time.isoformat(),
-                'leave_time_human': pool.leave_time.strftime(dt_format),
-                'return_time_human': pool.return_time.strftime(dt_format),
-                'driver_gender': escape(pool.driver.gender),
-                'is_approximate_location': is_approximate_location,
-                'hidden': pool.destination.hidden
-            },
-        })
-
-    feature_collection = {
-        'type': 'FeatureCollection',
-        'features': features
-    }
-
-    return jsonify(feature_collection)
+        results = results[:3]
+
+    locations = locate_results(results, exact_carpool_ids)
+    features = [
+        render_feature(result['feature'], result['seats_available'],
+                       from_point, is_approximate_location)
+        for result, (from_point, is_approximate_location)
+        in zip(results, locations)
+    ]
+
+    return feature_collection_response(features)
 
 
 @pool_bp.route('/carpools/mine', methods=['GET', 'POST'])
+@query_budget(7)
 @login_required
 def mine():
     carpools = {'future': [], 'past': []}
     # Start with carpools you're driving in
-    for carpool in current_user.get_driving_carpools():
+    driving_carpools = current_user.get_driving_carpools().options(
+        joinedload(Carpool.destination),
+        joinedload(Carpool.driver),
+        selectinload(Carpool.ride_requests).joinedload(RideRequest.person),
+    )
+    for carpool in driving_carpools:
         carpools['future' if carpool.future else 'past'].append(carpool)
 
     # Add in carpools you have ride requests for
-    for req in current_user.get_ride_requests_query():
+    ride_requests = current_user.get_ride_requests_query().options(
+        joinedload(RideRequest.carpool).joinedload(Carpool.destination),
+        joinedload(RideRequest.carpool).joinedload(Carpool.driver),
+        joinedload(RideRequest.carpool).
+            selectinload(Carpool.ride_requests).
+            joinedload(RideRequest.person),
+    ).all()
+    for req in ride_requests:
         carpools['future' if req.carpool.future else 'past'].append(req.carpool)
 
     # Then sort by departure date
     carpools['future'].sort(key=lambda c: c.leave_time)
     carpools['past'].sort(key=lambda c: c.leave_time)
 
-    return render_template('carpools/mine.html', carpools=carpools)
+    return render_template(
+        'carpools/mine.html',
+        carpools=carpools,
+        ride_requests={req.carpool_id: req for req in ride_requests},
+    )
 
 
 @pool_bp.route('/carpools/new', methods=['GET', 'POST'])
@@ -190,13 +193,12 @@ def new():
 
     desired_destination_id = request.args.get('destination_id')
     if desired_destination_id:
-        desired_destination = Destination.find_all_visible().filter_by(uuid=desired_destination_id).first()
-        if not desired_destination:
+        if not visible_destination(desired_destination_id):
             desired_destination_id = None
 
-    visible_destinations = Destination.find_all_visible().all()
+    destinations = visible_destinations()
     driver_form.destination.choices = [
-        (str(r.uuid), r.name) for r in visible_destinations
+        (r.uuid, r.name) for r in destinations
     ]
 
     if desired_destination_id:
@@ -205,7 +207,7 @@ def new():
         driver_form.destination.choices.insert(0, ('', "Select one..."))
 
     if driver_form.validate_on_submit():
-        dest = Destination.first_by_uuid(driver_form.destination.data)
+        dest = visible_destination(driver_form.destination.data)
 
         c = Carpool(
             from_place=driver_form.departure_name.data,
@@ -223,6 +225,7 @@ def new():
         )
         db.session.add(c)
         db.session.commit()
+        invalidate_search_cache()
 
         flash("Thank you for offering space in your carpool! When nearby volunteers request a ride, you'll be notified automatically to accept or reject them.", 'success')
 
@@ -234,16 +237,28 @@ def new():
     return render_template(
         'carpools/add_driver.html',
         form=driver_form,
-        destinations=visible_destinations,
+        destinations=destinations,
     )
 
 
 @pool_bp.route('/carpools/<uuid>', methods=['GET', 'POST'])
+@query_budget(8)
 @login_required
 def details(uuid):
     carpool = Carpool.uuid_or_404(uuid)
 
-    return render_template('carpools/show.html', pool=carpool)
+    # the driver sees every request, with who made it
+    ride_requests = []
+    if current_user.is_driver(carpool):
+        ride_requests = carpool.get_ride_requests_query().\
+            options(joinedload(RideRequest.person)).\
+            all()
+
+    return render_template(
+        'carpools/show.html',
+        pool=carpool,
+        ride_requests=ride_requests,
+    )
 
 
 @pool_bp.route('/carpools/<uuid>/edit', methods=['GET', 'POST'])
@@ -259,12 +274,12 @@ def edit(uuid):
         flash("You cannot edit a carpool you didn't create.", 'error')
         return redirect(url_for('carpool.details', uuid=carpool.uuid))
 
-    geometry = mapping(to_shape(carpool.from_point))
+    from_point = LonLat.from_element(carpool.from_point)
 
     driver_form = DriverForm(
         destination=carpool.destination.uuid,
-        departure_lat=geometry['coordinates'][1],
-        departure_lon=geometry['coordinates'][0],
+        departure_lat=from_point.lat,
+        departure_lon=from_point.lon,
         departure_name=carpool.from_place,
         departure_date=carpool.leave_time.date(),
         departure_hour=carpool.leave_time.time().hour,
@@ -276,15 +291,15 @@ def edit(uuid):
         departure_seed=carpool.from_seed,
     )
 
-    visible_destinations = Destination.find_all_visible().all()
+    destinations = visible_destinations()
 
     driver_form.destination.choices = [
-        (str(r.uuid), r.name) for r in visible_destinations
+        (r.uuid, r.name) for r in destinations
     ]
     driver_form.destination.choices.insert(0, ('', "Select one..."))
 
     if driver_form.validate_on_submit():
-        dest = Destination.first_by_uuid(driver_form.destination.data)
+        dest = visible_destination(driver_form.destination.data)
 
         carpool.from_place = driver_form.departure_name.data
         carpool.from_point = 'SRID=4326;POINT({} {})'.format(
@@ -299,6 +314,7 @@ def edit(uuid):
         carpool.driver_id = current_user.id
         db.session.add(carpool)
         db.session.commit()
+        invalidate_search_cache()
 
         flash("Your carpool has been updated.", 'success')
 
@@ -307,7 +323,7 @@ def edit(uuid):
     return render_template(
         'carpools/edit.html',
         form=driver_form,
-        destinations=visible_destinations,
+        destinations=destinations,
     )
 
 
@@ -350,6 +366,10 @@ def new_rider(carpool_uuid):
 
     rider_form = RiderForm()
     if rider_form.validate_on_submit():
+        # Hold the carpool row until the request is saved, so a double
+        # submit can't slip two requests past the checks below.
+        carpool = carpool.lock()
+
         if carpool.seats_available < 1:
             flash("There isn't enough space for you on "
                   "this ride. Try another one?", 'error')
@@ -416,12 +436,13 @@ def modify_ride_request(carpool_uuid, request_uuid, action):
             if not user_is_driver:
                 flash("That's not your carpool", 'error')
                 return redirect(url_for('carpool.details', uuid=carpool.uuid))
-            if not request.carpool.seats_available:
+            if not request.approve():
+                db.session.rollback()
                 flash("No seats available", 'error')
                 return redirect(url_for('carpool.details', uuid=carpool.uuid))
-            request.status = 'approved'
             db.session.add(request)
             db.session.commit()
+            invalidate_search_cache()
             flash("You approved their ride request.", 'success')
             _email_ride_approved(request)
         elif action == 'deny':
@@ -432,6 +453,7 @@ def modify_ride_request(carpool_uuid, request_uuid, action):
             request.status = 'denied'
             db.session.add(request)
             db.session.commit()
+            invalidate_search_cache()
             flash("You denied their ride request.", 'success')
             _email_ride_denied(request)
         elif action == 'cancel':
@@ -441,6 +463,7 @@ def modify_ride_request(carpool_uuid, request_uuid, action):
 
             db.session.delete(request)
             db.session.commit()
+            invalidate_search_cache()
             flash("You cancelled your ride request.", 'success')
             email_driver_rider_cancelled_request(request, carpool,
                                                  current_user)
@@ -451,9 +474,13 @@ def modify_ride_request(carpool_uuid, request_uuid, action):
                 flash("That's not your carpool", 'error')
                 return redirect(url_for('carpool.details', uuid=carpool.uuid))
 
-            request.status = 'approved'
+            if not request.approve():
+                db.session.rollback()
+                flash("No seats available", 'error')
+                return redirect(url_for('carpool.details', uuid=carpool.uuid))
             db.session.add(request)
             db.session.commit()
+            invalidate_search_cache()
             flash("You approved their ride request.", 'success')
             _email_ride_approved(request)
         elif action == 'cancel':
@@ -463,6 +490,7 @@ def modify_ride_request(carpool_uuid, request_uuid, action):
 
             db.session.delete(request)
             db.session.commit()
+            invalidate_search_cache()
             flash("You cancelled your ride request.", 'success')
 
     elif request.status == 'approved':
@@ -474,6 +502,7 @@ def modify_ride_request(carpool_uuid, request_uuid, action):
             request.status = 'denied'
             db.session.add(request)
             db.session.commit()
+            invalidate_search_cache()
             flash("You denied their ride request.", 'success')
             _email_ride_denied(request)
         elif action == 'cancel':
@@ -483,6 +512,7 @@ def modify_ride_request(carpool_uuid, request_uuid, action):
 
             db.session.delete(request)
             db.session.commit()
+            invalidate_search_cache()
             flash("You withdrew from the carpool.", 'success')
             email_driver_rider_cancelled_request(request, carpool,
                                                  current_user)
@@ -522,44 +552,19 @@ def cancel(uuid):
 
 
 def cancel_carpool(carpool, reason=None, notify_driver=False):
-    _email_carpool_cancelled(carpool, reason, notify_driver)
     carpool.canceled = True
     carpool.cancel_reason = reason
     db.session.add(carpool)
     db.session.commit()
+    invalidate_search_cache()
+    _email_carpool_cancelled(carpool, reason, notify_driver)
 
 
 def _email_carpool_cancelled(carpool, reason, notify_driver):
-    driver = carpool.driver
-    riders = carpool.riders_and_potential_riders
-
-    if not reason:
-        reason = '<reason not given>'
-
-    subject = 'Carpool session on {} cancelled'.format(
-        carpool.leave_time_formatted)
-
-    for rider in riders:
-        send_email(
-            'carpool_cancelled',
-            rider.email,
-            subject,
-            driver=driver,
-            rider=rider,
-            carpool=carpool,
-            reason=reason,
-        )
-
-    if notify_driver:
-        send_email(
-            'carpool_cancelled',
-            driver.email,
-            subject,
-            driver=driver,
-            carpool=carpool,
-            reason=reason,
-            is_driver=True
-        )
+    send_fanout_email(
+        'carpool_cancelled',
+        **carpool_cancelled_snapshot(carpool, reason, notify_driver)
+    )
 
 
 def _email_driver(carpool, current_user, subject, template_name_specifier, ride_request=None):
@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 import raven
 
@@ -30,8 +31,25 @@ class Config:
         'DATABASE_URL', 'postgresql://localhost/carpools')
     CACHE_TYPE = os.environ.get('CACHE_TYPE', 'simple')
     CACHE_REDIS_URL = os.environ.get('REDIS_URL')
+    # Carpool searches are cached per grid tile of this many degrees
+    SEARCH_CACHE_GRID = float(os.environ.get('SEARCH_CACHE_GRID') or 0.05)
+    SEARCH_CACHE_TIMEOUT = int_env('SEARCH_CACHE_TIMEOUT', 60)
+    # Encoded search result features are cached per carpool, and dropped
+    # when the carpool changes (app/carpool/features.py)
+    CARPOOL_FEATURE_CACHE_TIMEOUT = int_env('CARPOOL_FEATURE_CACHE_TIMEOUT', 24 * 60 * 60)
+    # Seconds the logged in person's name, email, gender and roles are
+    # cached between requests. Role changes, like being blocked, take
+    # effect within this long. 0 turns the cache off.
+    PRINCIPAL_CACHE_TIMEOUT = int_env('PRINCIPAL_CACHE_TIMEOUT', 30)
     DEBUG = os.environ.get('FLASK_DEBUG', False)
     VERBOSE_SQLALCHEMY = False
+    # Add X-DB-Queries and X-DB-Time headers to responses (app/query_stats.py)
+    QUERY_STATS_HEADERS = os.environ.get('QUERY_STATS_HEADERS') == 'true'
+    # Requests slower than this are logged with their slowest statements
+    SLOW_REQUEST_MS = int_env('SLOW_REQUEST_MS', 1000)
+    SLOW_REQUEST_TOP_STATEMENTS = int_env('SLOW_REQUEST_TOP_STATEMENTS', 5)
+    # Raise instead of logging when a view goes over its @query_budget
+    QUERY_BUDGET_ENFORCE = False
     SSLIFY_ENABLE = False
     SENTRY_ENABLE = os.environ.get('SENTRY_ENABLE')
     GOOGLE_MAPS_API_KEY = os.environ.get('GOOGLE_MAPS_API_KEY')
@@ -43,7 +61,35 @@ class Config:
     SERVER_NAME = os.environ.get('SERVER_NAME')
     RQ_ENABLED = os.environ.get('RQ_ENABLED', False)
     RQ_REDIS_URL = os.environ.get('REDIS_URL')
+    # rq.worker.Worker forks a process per job. rq.worker.SimpleWorker runs
+    # jobs in one process, so its SMTP connection is reused between jobs.
+    RQ_WORKER_CLASS = os.environ.get('RQ_WORKER_CLASS', 'rq.worker.Worker')
+    # Where background CSV exports are written, see app/admin/export_store.py.
+    # The worker writes them and the web app sends them, so both have to be
+    # able to reach the store: LocalExportStore only works if they share
+    # EXPORT_DIR.
+    EXPORT_STORE = os.environ.get(
+        'EXPORT_STORE', 'app.admin.export_store.DatabaseExportStore')
+    EXPORT_DIR = os.environ.get(
+        'EXPORT_DIR', os.path.join(tempfile.gettempdir(), 'nomad-exports'))
+    # Exports that haven't moved for this long can be resumed
+    EXPORT_STALLED_MINUTES = int_env('EXPORT_STALLED_MINUTES', 10)
+    # Finished exports are deleted this long after they last changed
+    EXPORT_RETENTION_HOURS = int_env('EXPORT_RETENTION_HOURS', 24)
     MAIL_LOG_ONLY = os.environ.get('MAIL_LOG_ONLY', 'true') == 'true'
+    # Render emails when they're queued instead of in the worker, so the
+    # worker only sends them and never touches the database. Like the
+    # worker, commands that send email then need SERVER_NAME set.
+    MAIL_PRERENDER = os.environ.get('MAIL_PRERENDER', 'false') == 'true'
+    # Keep compiled templates on disk, so forked RQ workers don't have to
+    # compile them again for every job. They go in Jinja's own private,
+    # per-user directory under the system temp dir.
+    TEMPLATE_BYTECODE_CACHE = \
+        os.environ.get('TEMPLATE_BYTECODE_CACHE', 'false') == 'true'
+    # Share of email renders timed in the admin email preview histogram.
+    # Worker renders only show up there if the cache is shared (redis).
+    EMAIL_RENDER_STATS_SAMPLE_RATE = float(
+        os.environ.get('EMAIL_RENDER_STATS_SAMPLE_RATE') or 0.1)
     MAIL_SERVER = os.environ.get('MAIL_SERVER', 'localhost')
     MAIL_PORT = int_env('MAIL_PORT', 25)
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
@@ -52,6 +98,14 @@ class Config:
     MAIL_USE_SSL = os.environ.get('MAIL_USE_SSL', 'false') == 'true'
     MAIL_DEFAULT_SENDER = os.environ.get(
         'MAIL_DEFAULT_SENDER', 'from@example.com')
+    # Fan-out emails (app/email/fanout.py) are sent this many at a time,
+    # each batch over one SMTP connection
+    MAIL_FANOUT_BATCH_SIZE = int_env('MAIL_FANOUT_BATCH_SIZE', 100)
+    # SMTP connections are kept open and replaced after this many messages
+    MAIL_MAX_MESSAGES_PER_CONNECTION = int_env(
+        'MAIL_MAX_MESSAGES_PER_CONNECTION', 100)
+    # ...or once they've been idle this long
+    MAIL_POOL_IDLE_SECONDS = int_env('MAIL_POOL_IDLE_SECONDS', 60)
     PREFERRED_URL_SCHEME = 'https'
 
     REMEMBER_COOKIE_SECURE = True
@@ -117,6 +171,7 @@ class Config:
 class DevelopmentConfig(Config):
     SECRET_KEY = os.environ.get('SECRET_KEY', os.urandom(24))
     DEBUG = os.environ.get('FLASK_DEBUG', True)
+    QUERY_STATS_HEADERS = os.environ.get('QUERY_STATS_HEADERS', 'true') == 'true'
 
     # Set this environment variable if you're using
     # Ngrok for local testing
@@ -144,6 +199,8 @@ class DevelopmentConfig(Config):
 class TestingConfig(Config):
     SQLALCHEMY_DATABASE_URI = 'postgresql://localhost/circle_test'
     TESTING = True
+    QUERY_STATS_HEADERS = True
+    QUERY_BUDGET_ENFORCE = True
 
 
 class HerokuConfig(Config):
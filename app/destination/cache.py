@@ -0,0 +1,75 @@
+from collections import namedtuple
+from uuid import uuid4
+from flask import current_app
+from .. import cache, db
+from ..models import Destination
+
+VISIBLE_DESTINATIONS_VERSION_KEY = 'visible-destinations-version'
+
+VisibleDestination = namedtuple(
+    'VisibleDestination', ['uuid', 'id', 'name', 'address', 'lat', 'lon'])
+
+
+def _load_visible_destinations():
+    rows = db.session.query(
+        Destination.uuid,
+        Destination.id,
+        Destination.name,
+        Destination.address,
+        db.func.ST_Y(Destination.point),
+        db.func.ST_X(Destination.point),
+    ).\
+        filter(Destination.hidden == False).\
+        order_by(Destination.name)
+
+    return [
+        VisibleDestination(str(row[0]), *row[1:])
+        for row in rows
+    ]
+
+
+def _visible_destinations_by_uuid():
+    """
+    Returns the visible destinations, ordered by name, keyed by uuid.
+
+    They're kept in this process and in the shared cache under the
+    current version, so a request usually costs one cache read to check
+    the version. `invalidate_visible_destinations()` bumps the version,
+    which makes every process load them again.
+    """
+    version = cache.get(VISIBLE_DESTINATIONS_VERSION_KEY)
+    if version is None:
+        version = uuid4().hex
+        cache.set(VISIBLE_DESTINATIONS_VERSION_KEY, version, timeout=0)
+
+    local = current_app.extensions.get('visible_destinations')
+    if local and local[0] == version:
+        return local[1]
+
+    key = 'visible-destinations:{}'.format(version)
+    destinations = cache.get(key)
+    if destinations is None:
+        destinations = _load_visible_destinations()
+        cache.set(key, destinations, timeout=0)
+
+    by_uuid = {d.uuid: d for d in destinations}
+    current_app.extensions['visible_destinations'] = (version, by_uuid)
+    return by_uuid
+
+
+def visible_destinations():
+    """ Returns the destinations that aren't hidden, ordered by name. """
+    return list(_visible_destinations_by_uuid().values())
+
+
+def visible_destination(uuid):
+    """ Returns the visible destination with this uuid, or None. """
+    return _visible_destinations_by_uuid().get(str(uuid))
+
+
+def invalidate_visible_destinations():
+    """
+    Forgets the cached visible destinations. Call this after committing
+    a destination being added, edited, deleted, hidden or unhidden.
+    """
+    cache.set(VISIBLE_DESTINATIONS_VERSION_KEY, uuid4().hex, timeout=0)
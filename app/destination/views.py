@@ -4,6 +4,7 @@ from flask import (
     abort,
     render_template,
 )
+from flask_login import current_user
 
 
 @dest_bp.route('/destinations/<uuid>')
@@ -13,7 +14,11 @@ def page(uuid):
     if not destination:
         abort(404)
 
+    carpools = destination.future_carpools.all()
+
     return render_template(
         'destinations/show.html',
         destination=destination,
+        carpools=carpools,
+        ride_requests=current_user.get_ride_requests_in_carpools(carpools),
     )
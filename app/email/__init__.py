@@ -1,34 +1,99 @@
-from flask import current_app, render_template
+import smtplib
+import threading
+import time
+from flask import current_app
 from flask_mail import Message
 from werkzeug.local import LocalProxy
 
-from ..models import UuidMixin
+from ..models import PersonSnapshot, UuidMixin
 from .. import mail, rq
+from .rendering import render_email_template
 
 
-def send_email(template, recipient, subject, **kwargs):
+def _serialize_kwargs(kwargs):
     # Convert database model instances to serializable dicts
     new_kwargs = {}
     for k, v in kwargs.items():
+        if isinstance(v, LocalProxy):
+            v = v._get_current_object()
+        if isinstance(v, PersonSnapshot):
+            v = v.person
+
         if isinstance(v, UuidMixin):
             new_kwargs[k] = {
                 'clz': type(v).__name__,
                 'uuid': v.uuid,
             }
-        elif isinstance(v, LocalProxy) and isinstance(v._get_current_object(), UuidMixin):
-            new_kwargs[k] = {
-                'clz': type(v._get_current_object()).__name__,
-                'uuid': v.uuid,
-            }
         else:
             new_kwargs[k] = v
+    return new_kwargs
+
+
+def _email_job(template, recipient, subject, kwargs):
+    """
+    Returns the job function and arguments that send one message. With
+    MAIL_PRERENDER the message is rendered now, while its models are at
+    hand, so the worker only has to send it. Otherwise the worker loads
+    the models and renders the message itself.
+    """
+    if current_app.config.get('MAIL_PRERENDER'):
+        return send_rendered_email_queued, (
+            recipient,
+            subject,
+            render_email_template('email/{}.txt'.format(template), **kwargs),
+            render_email_template('email/{}.html'.format(template), **kwargs),
+        ), {}
+
+    return send_email_queued, (template, recipient, subject), \
+        _serialize_kwargs(kwargs)
+
+
+def send_email(template, recipient, subject, **kwargs):
+    job, args, job_kwargs = _email_job(template, recipient, subject, kwargs)
 
     if current_app.config.get('RQ_ENABLED'):
         # Enqueue the message to send by the RQ worker
-        send_email_queued.queue(template, recipient, subject, **new_kwargs)
+        job.queue(*args, **job_kwargs)
     else:
         # Do the work during the request
-        send_email_queued(template, recipient, subject, **new_kwargs)
+        job(*args, **job_kwargs)
+
+
+def send_emails(messages, pipeline=None):
+    """
+    Sends many messages, each a (template, recipient, subject, kwargs)
+    tuple, like `send_email`. With RQ enabled every message is enqueued
+    in one Redis pipeline, which runs as a single MULTI/EXEC so either
+    all of the messages are queued or none are.
+
+    Pass a pipeline to add the messages to it without executing it.
+    """
+    jobs = [
+        _email_job(template, recipient, subject, kwargs)
+        for template, recipient, subject, kwargs in messages
+    ]
+
+    if not current_app.config.get('RQ_ENABLED'):
+        for job, args, job_kwargs in jobs:
+            job(*args, **job_kwargs)
+        return
+
+    pipe = pipeline if pipeline is not None else rq.connection.pipeline()
+
+    for job, args, job_kwargs in jobs:
+        queue = rq.get_queue(job.helper.queue_name)
+        queue.enqueue_job(queue.job_class.create(
+            job,
+            args=args,
+            kwargs=job_kwargs,
+            connection=queue.connection,
+            timeout=job.helper.timeout,
+            result_ttl=job.helper.result_ttl,
+            ttl=job.helper.ttl,
+        ), pipeline=pipe)
+
+    if pipeline is None:
+        pipe.execute()
 
 
 @rq.job
@@ -56,13 +121,111 @@ def send_email_queued(template, recipient, subject, **kwargs):
         else:
             new_kwargs[k] = v
 
+    _send_message(render_message(template, recipient, subject, **new_kwargs))
+
+
+def render_message(template, recipient, subject, **kwargs):
+    """ Renders the text and HTML versions of an email template into a Message. """
+    return Message(
+        recipients=[recipient],
+        body=render_email_template('email/{}.txt'.format(template), **kwargs),
+        html=render_email_template('email/{}.html'.format(template), **kwargs),
+        subject=subject
+    )
+
+
+@rq.job
+def send_rendered_email_queued(recipient, subject, body, html):
+    """ Sends a message rendered by `send_email` with MAIL_PRERENDER. """
     message = Message(
         recipients=[recipient],
-        body=render_template('email/{}.txt'.format(template), **new_kwargs),
-        html=render_template('email/{}.html'.format(template), **new_kwargs),
+        body=body,
+        html=html,
         subject=subject
     )
 
+    _send_message(message)
+
+
+class PooledConnection(threading.local):
+    """
+    An SMTP connection that stays open from one message to the next, so a
+    worker sending many messages doesn't connect and log in for each one.
+    It's closed after MAIL_MAX_MESSAGES_PER_CONNECTION messages, or once
+    it's been idle for MAIL_POOL_IDLE_SECONDS, before the server is likely
+    to have given up on it. A connection the server has dropped anyway is
+    replaced and the message retried.
+    """
+
+    def __init__(self):
+        self.connection = None
+        self.sent = 0
+        self.last_used = None
+
+    def send(self, message):
+        max_messages = current_app.config.get('MAIL_MAX_MESSAGES_PER_CONNECTION')
+        idle_seconds = current_app.config.get('MAIL_POOL_IDLE_SECONDS')
+
+        if self.connection is not None and idle_seconds and \
+                time.monotonic() - self.last_used > idle_seconds:
+            self.close()
+
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = mail.connect().__enter__()
+                self.sent = 0
+
+            try:
+                self.connection.send(message)
+            except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+                error = e
+            except smtplib.SMTPResponseException as e:
+                # 421: the server is closing the connection
+                if e.smtp_code != 421:
+                    raise
+                error = e
+            else:
+                self.sent += 1
+                self.last_used = time.monotonic()
+                if max_messages and self.sent >= max_messages:
+                    self.close()
+                return
+
+            current_app.logger.info("SMTP connection lost (%s), reconnecting",
+                                    error)
+            self.close()
+
+        raise error
+
+    def close(self):
+        if self.connection is None:
+            return
+
+        try:
+            self.connection.__exit__(None, None, None)
+        except (smtplib.SMTPException, OSError):
+            pass
+        self.connection = None
+
+
+smtp_connection = PooledConnection()
+
+
+def send_messages(messages):
+    """
+    Sends a batch of messages over one SMTP connection, then closes it,
+    so a large fan-out doesn't hold a connection open between batches.
+    A batch longer than MAIL_MAX_MESSAGES_PER_CONNECTION still gets a new
+    connection part way.
+    """
+    try:
+        for message in messages:
+            _send_message(message)
+    finally:
+        smtp_connection.close()
+
+
+def _send_message(message):
     current_app.logger.info(
         'Email to "%s", subject "%s", body: "%s"',
         message.recipients,
@@ -73,13 +236,12 @@ def send_email_queued(template, recipient, subject, **kwargs):
     if current_app.config.get('MAIL_LOG_ONLY'):
         return
 
-    with mail.connect() as conn:
-        try:
-            conn.send(message)
-        except Exception:
-            current_app.logger.exception(
-                'Failed to send message to %s with subject %s and body %s'.
-                message.recipients,
-                message.subject,
-                message.body,
-            )
+    try:
+        smtp_connection.send(message)
+    except Exception:
+        current_app.logger.exception(
+            'Failed to send message to %s with subject %s and body %s',
+            message.recipients,
+            message.subject,
+            message.body,
+        )
@@ -0,0 +1,193 @@
+"""
+Fan-out emails: one job that expands to an email for each person
+involved in a carpool or destination. The request queues a single job
+with an id, or with a snapshot of the recipients when they may be
+deleted before the worker gets to them, and the worker sends the emails
+a batch at a time, each batch over one SMTP connection.
+"""
+from flask import current_app
+from sqlalchemy.orm import joinedload, selectinload
+
+from . import render_message, send_messages
+from .. import db, rq
+from ..models import Carpool, Destination, Person, RideRequest
+
+
+def send_fanout_email(name, **params):
+    """ Sends the emails of the fan-out called `name` (see FANOUTS). """
+    if current_app.config.get('RQ_ENABLED'):
+        send_fanout_email_queued.queue(name, **params)
+    else:
+        send_fanout_email_queued(name, **params)
+
+
+@rq.job(timeout=1800)
+def send_fanout_email_queued(name, **params):
+    batch_size = current_app.config.get('MAIL_FANOUT_BATCH_SIZE')
+    batch = []
+
+    for message in FANOUTS[name](**params):
+        batch.append(message)
+        if len(batch) >= batch_size:
+            _send_batch(name, batch)
+            batch = []
+
+    if batch:
+        _send_batch(name, batch)
+
+
+def _send_batch(name, batch):
+    current_app.logger.info("Sending %s %s emails", len(batch), name)
+
+    send_messages([
+        render_message(template, recipient, subject, **kwargs)
+        for template, recipient, subject, kwargs in batch
+    ])
+
+
+def carpool_cancelled_snapshot(carpool, reason=None, notify_driver=False):
+    """
+    Returns what the carpool cancelled emails need to know, as plain
+    values. Deleting a person or their profile cancels their carpools and
+    then deletes them in the same request, so the worker can't look them
+    up later.
+    """
+    driver = carpool.driver
+    riders = db.session.query(Person.name, Person.email).\
+        join(RideRequest, RideRequest.person_id == Person.id).\
+        filter(RideRequest.carpool_id == carpool.id).\
+        filter(RideRequest.status.in_(['approved', 'requested'])).\
+        order_by(RideRequest.id)
+
+    return {
+        'carpool': {
+            'from_place': carpool.from_place,
+            'leave_time': carpool.leave_time,
+            'leave_time_formatted': carpool.leave_time_formatted,
+            'destination': {'name': carpool.destination.name}
+            if carpool.destination else None,
+        },
+        'driver': {
+            'name': driver.name,
+            'email': driver.email,
+            'phone_number': driver.phone_number,
+            'preferred_contact_method': driver.preferred_contact_method,
+        },
+        'riders': [{'name': row[0], 'email': row[1]} for row in riders],
+        'reason': reason,
+        'notify_driver': notify_driver,
+    }
+
+
+def carpool_cancelled(carpool, driver, riders, reason=None, notify_driver=False):
+    """ Tells a cancelled carpool's riders, and maybe its driver. """
+    if not reason:
+        reason = '<reason not given>'
+
+    subject = 'Carpool session on {} cancelled'.format(
+        carpool['leave_time_formatted'])
+
+    for rider in riders:
+        yield ('carpool_cancelled', rider['email'], subject, dict(
+            driver=driver,
+            rider=rider,
+            carpool=carpool,
+            reason=reason,
+        ))
+
+    if notify_driver:
+        yield ('carpool_cancelled', driver['email'], subject, dict(
+            driver=driver,
+            carpool=carpool,
+            reason=reason,
+            is_driver=True,
+        ))
+
+
+def destination_modified(destination_id):
+    """ Tells everyone in a destination's carpools that it has changed. """
+    destination = Destination.query.get(destination_id)
+    if not destination:
+        current_app.logger.error("Could not find destination %s to email "
+                                 "about its changes", destination_id)
+        return
+
+    batch_size = current_app.config.get('MAIL_FANOUT_BATCH_SIZE')
+    last_id = 0
+
+    while True:
+        carpools = Carpool.query.\
+            options(joinedload(Carpool.driver),
+                    selectinload(Carpool.ride_requests).
+                    joinedload(RideRequest.person)).\
+            filter(Carpool.destination_id == destination.id).\
+            filter(Carpool.id > last_id).\
+            order_by(Carpool.id).\
+            limit(batch_size).\
+            all()
+        if not carpools:
+            break
+        last_id = carpools[-1].id
+
+        for carpool in carpools:
+            subject = 'Carpool on {} modified'.format(
+                carpool.leave_time_formatted)
+            people = [r.person for r in carpool.ride_requests] + \
+                [carpool.driver]
+
+            for person in people:
+                yield ('admin_destination_modified', person.email, subject,
+                       dict(destination=destination, carpool=carpool,
+                            person=person))
+
+
+def destination_deleted_snapshot(destination):
+    """
+    Returns what the destination deleted emails need to know, as plain
+    values. The destination and its carpools are deleted in the same
+    request, so the worker can't look them up later.
+    """
+    columns = [
+        Person.id, Person.name, Person.email,
+        Carpool.leave_time, Carpool.from_place, Carpool.driver_id,
+    ]
+    riders = db.session.query(*columns).\
+        select_from(RideRequest).\
+        join(Person, RideRequest.person_id == Person.id).\
+        join(Carpool, RideRequest.carpool_id == Carpool.id).\
+        filter(Carpool.destination_id == destination.id)
+    drivers = db.session.query(*columns).\
+        join(Carpool, Carpool.driver_id == Person.id).\
+        filter(Carpool.destination_id == destination.id)
+
+    return {
+        'destination': {'name': destination.name},
+        'people': [
+            {
+                'person': {'id': row[0], 'name': row[1], 'email': row[2]},
+                'carpool': {'leave_time': row[3], 'from_place': row[4],
+                            'driver_id': row[5]},
+            }
+            for row in riders.union_all(drivers)
+        ],
+    }
+
+
+def destination_deleted(destination, people):
+    """ Tells everyone in a deleted destination's carpools. """
+    date_format = current_app.config.get('DATE_FORMAT_SHORT')
+
+    for entry in people:
+        subject = 'Carpool on {} cancelled'.format(
+            entry['carpool']['leave_time'].strftime(date_format))
+
+        yield ('admin_destination_deleted', entry['person']['email'], subject,
+               dict(destination=destination, carpool=entry['carpool'],
+                    person=entry['person']))
+
+
+FANOUTS = {
+    'carpool_cancelled': carpool_cancelled,
+    'destination_modified': destination_modified,
+    'destination_deleted': destination_deleted,
+}
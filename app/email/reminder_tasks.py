@@ -1,14 +1,20 @@
 import datetime
 import os
+import click
+from sqlalchemy.orm import joinedload, selectinload
 from app import create_app, db
-from app.models import Carpool
-from app.email import send_email
+from app.models import Carpool, RideRequest
+from app.email import send_email, send_emails
 
 app = create_app(os.environ.get('CARPOOL_ENV', 'default'))
 
+REMINDER_SUBJECT = 'Your carpool is coming up!'
+
 
 @app.cli.command()
-def enqueue_scheduled_emails():
+@click.option('--batch-size', type=int, default=None,
+              help='Send reminders for this many carpools at a time.')
+def enqueue_scheduled_emails(batch_size):
     search_hours = app.config.get('TRIP_REMINDER_HOURS')
 
     now = datetime.datetime.now()
@@ -27,7 +33,16 @@ def enqueue_scheduled_emails():
                     future,
                     search_hours)
 
-    for pool in upcoming_pools:
+    if batch_size:
+        enqueue_reminders_in_batches(now, future, batch_size)
+        return
+
+    while True:
+        pools = claim_reminders(now, future, 1)
+        if not pools:
+            break
+        pool = pools[0]
+
         app.logger.info("Emailing driver %s about carpool %s",
                         pool.driver.uuid,
                         pool.uuid)
@@ -35,7 +50,7 @@ def enqueue_scheduled_emails():
         send_email(
             'driver_reminder',
             pool.driver.email,
-            'Your carpool is coming up!',
+            REMINDER_SUBJECT,
             carpool=pool,
         )
 
@@ -47,11 +62,92 @@ def enqueue_scheduled_emails():
             send_email(
                 'rider_reminder',
                 rider.email,
-                'Your carpool is coming up!',
+                REMINDER_SUBJECT,
                 rider=rider,
                 carpool=pool,
             )
 
-        pool.reminder_email_sent_at = datetime.datetime.now()
-        db.session.add(pool)
-        db.session.commit()
+
+def claim_reminders(now, future, limit):
+    """
+    Claims up to `limit` carpools leaving between `now` and `future` that
+    haven't been reminded, by stamping their reminder_email_sent_at, and
+    returns them with their drivers and riders loaded.
+
+    Carpools another process has claimed but not yet committed are
+    skipped (FOR UPDATE SKIP LOCKED), so several schedulers can share the
+    work without two of them reminding the same carpool. The claims are
+    committed before the carpools are returned, so a failure while their
+    reminders are sent can't have them sent again by a later run: each
+    reminder is sent at most once.
+    """
+    carpools = Carpool.__table__
+
+    claimable = db.select([carpools.c.id]).\
+        where(carpools.c.leave_time.between(now, future)).\
+        where(carpools.c.reminder_email_sent_at == None).\
+        order_by(carpools.c.id).\
+        limit(limit).\
+        with_for_update(skip_locked=True)
+
+    claimed = [row.id for row in db.session.execute(
+        carpools.update().
+        where(carpools.c.id.in_(claimable)).
+        values(reminder_email_sent_at=db.func.now()).
+        returning(carpools.c.id)
+    )]
+    db.session.commit()
+    if not claimed:
+        return []
+
+    return Carpool.query.\
+        options(joinedload(Carpool.driver),
+                selectinload(Carpool.ride_requests).
+                joinedload(RideRequest.person)).\
+        filter(Carpool.id.in_(claimed)).\
+        order_by(Carpool.id).\
+        all()
+
+
+def enqueue_reminders_in_batches(now, future, batch_size):
+    """
+    Sends the reminders a page of carpools at a time: each page is claimed
+    with one UPDATE and committed (see claim_reminders), and then its
+    emails are queued with one Redis pipeline.
+
+    Committing the claims first means reminders are sent at most once. If
+    queueing a page fails, its carpools stay claimed and are logged, and
+    a re-run won't remind them again rather than risk reminding them
+    twice.
+    """
+    while True:
+        pools = claim_reminders(now, future, batch_size)
+        if not pools:
+            break
+
+        messages = []
+        for pool in pools:
+            messages.append((
+                'driver_reminder',
+                pool.driver.email,
+                REMINDER_SUBJECT,
+                dict(carpool=pool),
+            ))
+
+            for rider in pool.riders:
+                messages.append((
+                    'rider_reminder',
+                    rider.email,
+                    REMINDER_SUBJECT,
+                    dict(rider=rider, carpool=pool),
+                ))
+
+        app.logger.info("Emailing %s people about %s carpools",
+                        len(messages), len(pools))
+
+        try:
+            send_emails(messages)
+        except Exception:
+            app.logger.exception("Could not send the reminders for carpools %s",
+                                 [pool.id for pool in pools])
+            raise
@@ -0,0 +1,110 @@
+"""
+Email template rendering: compiled templates can be kept in a bytecode
+cache, static fragments are rendered once, and a sample of renders'
+durations is recorded in a per-template histogram (shown in the admin
+email preview).
+"""
+import random
+import time
+from flask import current_app, render_template
+from jinja2 import FileSystemBytecodeCache, contextfunction
+from .. import cache
+
+# Upper bounds, in milliseconds, of the render time histogram buckets
+RENDER_TIME_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+def init_app(app):
+    app.add_template_global(static_fragment)
+
+    # The RQ worker forks a new process for each job, and each process
+    # would otherwise compile the templates it renders from scratch. With
+    # no directory given, Jinja uses one only the current user can write.
+    if app.config.get('TEMPLATE_BYTECODE_CACHE'):
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+
+
+@contextfunction
+def static_fragment(context, name, caller):
+    """
+    Renders the body of a `{% call static_fragment(name) %}` block once
+    and reuses it after that. Only use it around text that depends on
+    nothing but the app config, like signatures and safety tips.
+    """
+    if context.get('config') is not current_app.config:
+        # Rendered with different settings, e.g. in a test
+        return caller()
+
+    fragments = current_app.extensions.setdefault('email_fragments', {})
+    if name not in fragments:
+        fragments[name] = caller()
+    return fragments[name]
+
+
+def render_email_template(name, **context):
+    """ Renders a template like `render_template` and records how long it took. """
+    start = time.perf_counter()
+    rendered = render_template(name, **context)
+    record_render_time(name, time.perf_counter() - start)
+    return rendered
+
+
+def _bucket_label(bucket):
+    if bucket is None:
+        return '> {} ms'.format(RENDER_TIME_BUCKETS[-1])
+    return '<= {} ms'.format(bucket)
+
+
+def _stats_key(name, field):
+    return 'email-render:{}:{}'.format(name, field)
+
+
+def record_render_time(name, seconds):
+    """
+    Counts a sample of the renders of `name` in its histogram, so most
+    renders don't touch the cache at all. Counts never expire, but they
+    are only shared between the web app and the RQ worker if the app
+    cache is (CACHE_TYPE=redis): with the default simple cache each
+    process keeps its own.
+
+    Processes add to the counts without a lock, so concurrent samples
+    can occasionally be lost. That's fine for a histogram.
+    """
+    if random.random() >= current_app.config.get('EMAIL_RENDER_STATS_SAMPLE_RATE'):
+        return
+
+    ms = seconds * 1000
+    bucket = next((b for b in RENDER_TIME_BUCKETS if ms <= b), None)
+    count_key, total_key = _stats_key(name, bucket), _stats_key(name, 'us')
+
+    try:
+        count, total_us = cache.get_many(count_key, total_key)
+        cache.set_many({
+            count_key: (count or 0) + 1,
+            total_key: (total_us or 0) + int(seconds * 1000000),
+        }, timeout=0)
+    except Exception:
+        current_app.logger.exception("Couldn't record render time of %s", name)
+
+
+def render_time_stats(name):
+    """
+    Returns the render time histogram and mean render time of a
+    template, over the renders that were sampled.
+    """
+    buckets = RENDER_TIME_BUCKETS + (None,)
+    counts = cache.get_many(*[_stats_key(name, b) for b in buckets])
+    total_us = cache.get(_stats_key(name, 'us')) or 0
+
+    histogram = [
+        (_bucket_label(bucket), count or 0)
+        for bucket, count in zip(buckets, counts)
+    ]
+    renders = sum(count for _, count in histogram)
+
+    return {
+        'template': name,
+        'histogram': histogram,
+        'renders': renders,
+        'mean_ms': total_us / renders / 1000 if renders else None,
+    }
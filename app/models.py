@@ -1,16 +1,61 @@
+import collections
 import datetime
+import struct
 import uuid
 from dateutil import tz
-from flask import abort, current_app
+from flask import abort, current_app, g, has_app_context, has_request_context
 from flask_login import AnonymousUserMixin, UserMixin
-from geoalchemy2 import Geometry
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from geoalchemy2 import Geography, Geometry
 from geoalchemy2.elements import WKBElement
-from geoalchemy2.shape import to_shape
-from shapely.geometry import mapping
 from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy import event, inspect
 from sqlalchemy.orm import relationship
+from sqlalchemy.orm.util import identity_key
 from uuid import uuid4
-from . import db, login_manager
+from . import cache, db, login_manager
+
+
+def as_geography(expression):
+    """
+    Casts a lon/lat geometry expression to geography, so distances are in
+    meters. Carpool start points are indexed on exactly this expression.
+    """
+    return db.cast(expression, Geography(geometry_type=None))
+
+
+# Flag set on an (E)WKB geometry type when an SRID follows it
+WKB_SRID_FLAG = 0x20000000
+WKB_POINT = 1
+
+
+class LonLat(collections.namedtuple('LonLat', ['lon', 'lat'])):
+    """
+    A point's coordinates, in GeoJSON (lon, lat) order. Reading them
+    straight out of (E)WKB, or selecting ST_X/ST_Y, is much cheaper than
+    building a Shapely geometry for every point we serialize.
+    """
+
+    @classmethod
+    def from_element(cls, element):
+        """ Returns the coordinates of a WKBElement point column value. """
+        data = element.data
+        if isinstance(data, str):
+            data = bytes.fromhex(data)
+        else:
+            data = bytes(data)
+
+        byte_order = '<' if data[0] == 1 else '>'
+        geometry_type, = struct.unpack_from(byte_order + 'I', data, 1)
+        if geometry_type & 0xff != WKB_POINT:
+            raise ValueError("Not a point: geometry type {}".format(geometry_type))
+
+        offset = 9 if geometry_type & WKB_SRID_FLAG else 5
+        return cls(*struct.unpack_from(byte_order + 'dd', data, offset))
+
+    def as_geojson(self):
+        """ Returns a GeoJSON Point geometry at these coordinates. """
+        return {'type': 'Point', 'coordinates': [self.lon, self.lat]}
 
 
 class UuidMixin(object):
@@ -38,6 +83,9 @@ class UuidMixin(object):
 
 class RideRequest(db.Model, UuidMixin):
     __tablename__ = 'riders'
+    __table_args__ = (
+        db.Index('ix_riders_carpool_id_status', 'carpool_id', 'status'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     person_id = db.Column(db.Integer, db.ForeignKey('people.id'))
@@ -46,9 +94,25 @@ class RideRequest(db.Model, UuidMixin):
     carpool = db.relationship("Carpool")
     created_at = db.Column(db.DateTime(timezone=True),
                            default=datetime.datetime.utcnow)
-    status = db.Column(db.String(120))
+    # active_history so the approved rider count knows the previous status
+    status = db.column_property(db.Column(db.String(120)), active_history=True)
     notes = db.Column(db.Text)
 
+    def approve(self):
+        """
+        Approves this request if its carpool still has a free seat, and
+        returns whether it did. The carpool row stays locked until the
+        caller commits or rolls back, so concurrent approvals can't both
+        take the last seat.
+        """
+        carpool = self.carpool.lock()
+
+        if carpool.seats_available < 1:
+            return False
+
+        self.status = 'approved'
+        return True
+
 
 class Role(db.Model):
     __tablename__ = 'roles'
@@ -76,13 +140,40 @@ class PersonRole(db.Model):
     role_id = db.Column(db.Integer, db.ForeignKey('roles.id'))
 
 
+def _request_memo(person):
+    """
+    Returns a dict for remembering lookups about `person` until the end
+    of the current request (see forget_request_memos), or None outside
+    of a request.
+    """
+    if not has_request_context():
+        return None
+    return g.setdefault('person_memos', {}).setdefault(person.id, {})
+
+
+def forget_request_memos(*args):
+    g.pop('person_memos', None)
+
+
+@event.listens_for(db.session, 'after_commit')
+def forget_request_memos_after_commit(session):
+    """ A commit may have changed roles or ride requests, so look them up again. """
+    if has_request_context():
+        forget_request_memos()
+
+
 class AnonymousUser(AnonymousUserMixin):
+    role_names = frozenset()
+
     def has_roles(self, *roles):
         return False
 
     def get_ride_request_in_carpool(self, carpool):
         return None
 
+    def get_ride_requests_in_carpools(self, carpools):
+        return {carpool.id: None for carpool in carpools}
+
     def is_driver(self, carpool):
         return False
 
@@ -130,7 +221,28 @@ class Person(UserMixin, db.Model, UuidMixin):
         return query
 
     def get_ride_request_in_carpool(self, carpool):
-        return self.get_ride_requests_query().filter_by(carpool_id=carpool.id).first()
+        return self.get_ride_requests_in_carpools([carpool])[carpool.id]
+
+    def get_ride_requests_in_carpools(self, carpools):
+        """
+        Returns {carpool id: this person's ride request or None} for each
+        of `carpools`. Carpools that haven't been asked about yet in this
+        request are looked up together in one query.
+        """
+        memo = _request_memo(self)
+        known = memo.setdefault('ride_requests', {}) if memo is not None else {}
+
+        missing = {carpool.id for carpool in carpools} - set(known)
+        if missing:
+            requests = self.get_ride_requests_query().\
+                filter(RideRequest.carpool_id.in_(missing)).\
+                order_by(RideRequest.id)
+            for ride_request in requests:
+                known.setdefault(ride_request.carpool_id, ride_request)
+            for carpool_id in missing:
+                known.setdefault(carpool_id, None)
+
+        return {carpool.id: known[carpool.id] for carpool in carpools}
 
     def is_driver(self, carpool):
         return self.id == carpool.driver_id
@@ -140,19 +252,146 @@ class Person(UserMixin, db.Model, UuidMixin):
 
         return query
 
+    @property
+    def role_names(self):
+        """ The names of this person's roles, loaded once per request. """
+        memo = _request_memo(self)
+        if memo is None:
+            return frozenset(role.name for role in self.roles)
+
+        if 'role_names' not in memo:
+            memo['role_names'] = frozenset(role.name for role in self.roles)
+        return memo['role_names']
+
     def has_roles(self, *roles):
-        requested_role_set = set(roles)
-        our_role_set = set(role.name for role in self.roles)
+        return self.role_names.issuperset(roles)
+
+    def __str__(self):
+        return self.name + " (" + self.email + ")"
+
 
-        return requested_role_set.issubset(our_role_set)
+class PersonSnapshot(UserMixin):
+    """
+    The logged in person as cached by load_user: the fields most pages
+    need, without a query. Anything else is read from the Person, which
+    is only loaded from the database when it's first needed. Views that
+    change the person or hand it to the ORM should use `.person`.
+    """
+
+    def __init__(self, snapshot):
+        self._snapshot = snapshot
+        self._person = None
+
+    id = property(lambda self: self._snapshot['id'])
+    uuid = property(lambda self: uuid.UUID(self._snapshot['uuid']))
+    name = property(lambda self: self._snapshot['name'])
+    email = property(lambda self: self._snapshot['email'])
+    gender = property(lambda self: self._snapshot['gender'])
+    role_names = property(lambda self: frozenset(self._snapshot['roles']))
+
+    @property
+    def person(self):
+        if self._person is None:
+            self._person = Person.query.get(self.id)
+        return self._person
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.person, name)
+
+    def get_id(self):
+        return self.uuid
+
+    def has_roles(self, *roles):
+        return self.role_names.issuperset(roles)
+
+    def is_driver(self, carpool):
+        return self.id == carpool.driver_id
 
     def __str__(self):
         return self.name + " (" + self.email + ")"
 
 
+def _principal_cache_key(uuid):
+    return 'principal:{}'.format(uuid)
+
+
+def _principal_serializer():
+    return URLSafeTimedSerializer(current_app.secret_key, salt='principal')
+
+
+@event.listens_for(db.session, 'before_flush')
+def collect_changed_principals(session, flush_context, instances):
+    """
+    Notes the people whose cached snapshots the flush makes stale: a change
+    to their name, email, gender or roles, or deleting them. Their
+    snapshots are dropped as soon as the transaction commits.
+    """
+    changed = session.info.setdefault('changed_principals', set())
+
+    for obj in session.dirty | session.deleted:
+        if isinstance(obj, Person):
+            state = inspect(obj)
+            if obj in session.deleted or any(
+                    state.attrs[attr].history.has_changes()
+                    for attr in ('name', 'email', 'gender', 'roles')):
+                changed.add(obj.uuid)
+
+    for obj in session.new | session.deleted:
+        if isinstance(obj, PersonRole) and obj.person_id is not None:
+            changed.update(p.uuid for p in session.query(Person.uuid).
+                           filter(Person.id == obj.person_id))
+
+
+@event.listens_for(db.session, 'after_commit')
+def invalidate_changed_principals(session):
+    changed = session.info.pop('changed_principals', None)
+    if changed and has_app_context():
+        cache.delete_many(*[_principal_cache_key(u) for u in changed])
+
+
+@event.listens_for(db.session, 'after_rollback')
+def forget_changed_principals(session):
+    session.info.pop('changed_principals', None)
+
+
 @login_manager.user_loader
 def load_user(id):
-    return Person.first_by_uuid(id)
+    """
+    Loads the logged in person from a snapshot cached for
+    PRINCIPAL_CACHE_TIMEOUT seconds when there is one. Snapshots are
+    signed, so a tampered cache can't log anyone in as someone else, and
+    expire even if the cache keeps them longer. Commits that change the
+    person drop their snapshot right away (see collect_changed_principals).
+    """
+    timeout = current_app.config.get('PRINCIPAL_CACHE_TIMEOUT')
+    key = _principal_cache_key(id)
+
+    if timeout:
+        signed = cache.get(key)
+        if signed:
+            try:
+                snapshot = _principal_serializer().loads(signed, max_age=timeout)
+            except BadSignature:
+                snapshot = None
+            if snapshot and snapshot['uuid'] == str(id):
+                return PersonSnapshot(snapshot)
+
+    person = Person.first_by_uuid(id)
+
+    if person and timeout:
+        snapshot = {
+            'id': person.id,
+            'uuid': str(person.uuid),
+            'name': person.name,
+            'email': person.email,
+            'gender': person.gender,
+            'roles': sorted(person.role_names),
+        }
+        cache.set(key, _principal_serializer().dumps(snapshot), timeout=timeout)
+
+    return person
 
 
 class Carpool(db.Model, UuidMixin):
@@ -176,11 +415,26 @@ class Carpool(db.Model, UuidMixin):
     destination_id = db.Column(db.Integer, db.ForeignKey('destinations.id'))
     canceled = db.Column(db.Boolean, default=False)
     cancel_reason = db.Column(db.String, nullable=True)
+    # Denormalized count of approved ride requests, kept in step by
+    # update_approved_counts() below
+    approved_count = db.Column(db.Integer, nullable=False, default=0,
+                               server_default='0')
 
     ride_requests = relationship("RideRequest", cascade="all, delete-orphan")
     destination = relationship("Destination")
     driver = relationship("Person")
 
+    def lock(self):
+        """
+        Locks this carpool's row (SELECT ... FOR UPDATE) until the end of
+        the transaction and refreshes it from the database. Use this
+        before checking seats and then changing ride requests.
+        """
+        return Carpool.query.filter_by(id=self.id).\
+            with_for_update().\
+            populate_existing().\
+            one()
+
     def get_ride_requests_query(self, statuses=None):
         query = RideRequest.query.filter_by(carpool_id=self.id)
 
@@ -189,7 +443,20 @@ class Carpool(db.Model, UuidMixin):
 
         return query
 
+    @property
+    def ride_requests_loaded(self):
+        """
+        True if this carpool's ride requests were eager loaded, e.g. with
+        `selectinload(Carpool.ride_requests)`, so they can be used without
+        another query.
+        """
+        return 'ride_requests' not in inspect(self).unloaded
+
     def get_riders(self, statuses):
+        if self.ride_requests_loaded:
+            return [r.person for r in self.ride_requests
+                    if r.status in statuses]
+
         requests = self.get_ride_requests_query(statuses).all()
 
         if not requests:
@@ -205,11 +472,8 @@ class Carpool(db.Model, UuidMixin):
         e.g., "38.518, -97.328"
         """
         if isinstance(self.from_point, WKBElement):
-            # Shapely's Point class can extract lat and long from the geometry data type
-            pt = to_shape(self.from_point)
-            lat = pt.y
-            lng = pt.x
-            return "{}, {}".format(lat, lng)
+            point = LonLat.from_element(self.from_point)
+            return "{}, {}".format(point.lat, point.lon)
 
         # some functional tests don't populate this property, so we need a default
         # value in case it's not a valid geometry object.
@@ -225,8 +489,27 @@ class Carpool(db.Model, UuidMixin):
 
     @property
     def seats_available(self):
-        return self.max_riders - \
-               self.get_ride_requests_query(['approved']).count()
+        return self.max_riders - self.approved_count
+
+    @classmethod
+    def reconcile_approved_counts(cls):
+        """
+        Recomputes approved_count from the riders table for every carpool
+        where it has drifted. Returns the number of carpools corrected.
+        """
+        approved = db.select([db.func.count(RideRequest.id)]).\
+            where(RideRequest.carpool_id == cls.id).\
+            where(RideRequest.status == 'approved').\
+            as_scalar()
+
+        corrected = db.session.execute(
+            cls.__table__.update().
+            where(cls.approved_count != approved).
+            values(approved_count=approved)
+        ).rowcount
+        db.session.commit()
+
+        return corrected
 
     @property
     def future(self):
@@ -242,6 +525,171 @@ class Carpool(db.Model, UuidMixin):
         return self.leave_time.strftime(current_app.config.get('DATE_FORMAT_SHORT'))
 
 
+db.Index('ix_carpools_from_point_geography',
+         as_geography(Carpool.from_point),
+         postgresql_using='gist')
+
+# Answers "active carpools with seats left" without touching riders
+db.Index('ix_carpools_leave_time_has_seats',
+         Carpool.leave_time,
+         postgresql_where=db.and_(db.not_(Carpool.canceled),
+                                  Carpool.approved_count < Carpool.max_riders))
+
+
+@event.listens_for(db.session, 'before_flush')
+def collect_approved_count_changes(session, flush_context, instances):
+    """
+    Notes how each ride request about to be flushed changes its carpool's
+    approved rider count. New requests don't know their carpool id until
+    they're inserted, so they're resolved after the flush.
+    """
+    changes = session.info['approved_count_changes'] = []
+
+    for obj in session.new:
+        if isinstance(obj, RideRequest) and obj.status == 'approved':
+            changes.append((obj, 1))
+
+    for obj in session.dirty:
+        if isinstance(obj, RideRequest):
+            history = inspect(obj).attrs.status.history
+            was_approved = 'approved' in history.deleted
+            is_approved = obj.status == 'approved'
+            if history.has_changes() and was_approved != is_approved:
+                changes.append((obj.carpool_id, 1 if is_approved else -1))
+
+    for obj in session.deleted:
+        if isinstance(obj, RideRequest) and \
+                inspect(obj).committed_state.get('status', obj.status) == 'approved':
+            changes.append((obj.carpool_id, -1))
+
+
+@event.listens_for(db.session, 'after_flush_postexec')
+def update_approved_counts(session, flush_context):
+    """
+    Applies the approved rider count changes noted before the flush as
+    relative UPDATEs in the same transaction, so concurrent changes to a
+    carpool's riders can't overwrite each other's counts.
+    """
+    changes = session.info.pop('approved_count_changes', None)
+    if not changes:
+        return
+
+    deltas = collections.Counter()
+    for carpool, delta in changes:
+        if isinstance(carpool, RideRequest):
+            carpool = carpool.carpool_id
+        deltas[carpool] += delta
+
+    carpools = Carpool.__table__
+    for carpool_id, delta in deltas.items():
+        if carpool_id is None or not delta:
+            continue
+        session.execute(
+            carpools.update().
+            where(carpools.c.id == carpool_id).
+            values(approved_count=carpools.c.approved_count + delta)
+        )
+
+        # Reload the count the next time a loaded carpool is asked for it
+        carpool = session.identity_map.get(identity_key(Carpool, carpool_id))
+        if carpool is not None:
+            session.expire(carpool, ['approved_count'])
+
+
+class ExportJob(db.Model, UuidMixin):
+    """
+    A CSV export written in the background, see app/admin/exports.py.
+    Carpools are exported in id order and `last_key` is the id of the
+    last carpool written, so an interrupted export can carry on from it.
+    """
+    __tablename__ = 'export_jobs'
+
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_COMPLETE = 'complete'
+    STATUS_FAILED = 'failed'
+
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime(timezone=True),
+                           default=datetime.datetime.utcnow)
+    updated_at = db.Column(db.DateTime(timezone=True),
+                           default=datetime.datetime.utcnow,
+                           onupdate=datetime.datetime.utcnow)
+    finished_at = db.Column(db.DateTime(timezone=True), nullable=True)
+    requested_by_id = db.Column(db.Integer,
+                                db.ForeignKey('people.id', ondelete='SET NULL'))
+    kind = db.Column(db.String(24), nullable=False)
+    status = db.Column(db.String(24), nullable=False, default=STATUS_QUEUED)
+    last_key = db.Column(db.Integer, nullable=False, default=0)
+    bytes_written = db.Column(db.BigInteger, nullable=False, default=0)
+    rows_written = db.Column(db.Integer, nullable=False, default=0)
+    carpools_written = db.Column(db.Integer, nullable=False, default=0)
+    carpools_total = db.Column(db.Integer, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+
+    requested_by = relationship("Person")
+
+    @property
+    def filename(self):
+        return '{}-{}.csv'.format(self.kind, self.uuid)
+
+    @property
+    def progress(self):
+        """ Percentage of the carpools exported so far. """
+        if self.status == self.STATUS_COMPLETE:
+            return 100
+        if not self.carpools_total:
+            return 0
+        return min(100, 100 * self.carpools_written // self.carpools_total)
+
+    def restart(self):
+        """ Forgets how far the export got, so it's written from the start. """
+        self.last_key = 0
+        self.bytes_written = 0
+        self.rows_written = 0
+        self.carpools_written = 0
+
+    @property
+    def is_stalled(self):
+        """
+        True if the job stopped part way, either by failing or because its
+        worker went away without finishing it.
+        """
+        if self.status == self.STATUS_FAILED:
+            return True
+
+        stalled_after = datetime.timedelta(
+            minutes=current_app.config.get('EXPORT_STALLED_MINUTES'))
+        updated_at = self.updated_at or self.created_at
+        if updated_at.tzinfo is None:
+            updated_at = updated_at.replace(tzinfo=tz.gettz('UTC'))
+        now = datetime.datetime.now().replace(tzinfo=tz.gettz('UTC'))
+        return self.status != self.STATUS_COMPLETE and \
+            updated_at < now - stalled_after
+
+    def as_json(self):
+        return {
+            'id': str(self.uuid),
+            'kind': self.kind,
+            'status': self.status,
+            'progress': self.progress,
+            'rows_written': self.rows_written,
+            'stalled': self.is_stalled,
+        }
+
+
+class ExportChunk(db.Model):
+    """
+    A piece of an export file kept in the database, see
+    DatabaseExportStore in app/admin/export_store.py.
+    """
+    __tablename__ = 'export_chunks'
+
+    name = db.Column(db.String(80), primary_key=True)
+    position = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+
+
 class Destination(db.Model, UuidMixin):
     __tablename__ = 'destinations'
 
@@ -271,5 +719,5 @@ class Destination(db.Model, UuidMixin):
                 "name": self.name,
                 "address": self.address,
             },
-            "geometry": mapping(to_shape(self.point))
+            "geometry": LonLat.from_element(self.point).as_geojson()
         }
@@ -0,0 +1,151 @@
+"""
+Counts and times the SQL statements each request sends, using
+SQLAlchemy engine events. The totals are added to the response as
+`X-DB-Queries` and `X-DB-Time` headers (milliseconds), slow requests
+are logged with the statements that took the longest, and views can
+declare a query budget with `@query_budget(n)`.
+"""
+import functools
+import time
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryStats(object):
+    """ The statements sent while handling one request. """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.count = 0
+        self.seconds = 0.0
+        # statement -> [times sent, total seconds]
+        self.statements = {}
+
+    def record(self, statement, seconds):
+        self.count += 1
+        self.seconds += seconds
+
+        totals = self.statements.setdefault(statement, [0, 0.0])
+        totals[0] += 1
+        totals[1] += seconds
+
+    def top_statements(self, limit):
+        """ Returns (statement, times sent, total seconds), slowest first. """
+        ranked = sorted(self.statements.items(),
+                        key=lambda item: item[1][1], reverse=True)
+        return [
+            (statement, count, seconds)
+            for statement, (count, seconds) in ranked[:limit]
+        ]
+
+
+def query_budget(max_queries):
+    """
+    Declares the most SQL statements a view should send. Going over is
+    logged, or raises QueryBudgetExceeded when QUERY_BUDGET_ENFORCE is set
+    (as it is in the tests), so N+1 queries fail the test suite.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def decorated_function(*args, **kwargs):
+            return f(*args, **kwargs)
+
+        decorated_function.query_budget = max_queries
+        return decorated_function
+    return decorator
+
+
+def _current_stats():
+    if has_request_context():
+        return g.get('query_stats')
+    return None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    started = conn.info['query_start_time'].pop()
+
+    stats = _current_stats()
+    if stats is not None:
+        stats.record(statement, time.perf_counter() - started)
+
+
+def _handle_error(context):
+    # after_cursor_execute isn't called for statements that fail
+    if context.connection is None:
+        return
+    started = context.connection.info.get('query_start_time')
+    if started:
+        started.pop()
+
+
+def _start_request():
+    g.query_stats = QueryStats()
+
+
+def _finish_request(response):
+    stats = _current_stats()
+    if stats is None:
+        return response
+
+    app = current_app._get_current_object()
+
+    if app.config.get('QUERY_STATS_HEADERS'):
+        response.headers['X-DB-Queries'] = str(stats.count)
+        response.headers['X-DB-Time'] = '{:.1f}'.format(stats.seconds * 1000)
+
+    elapsed_ms = (time.perf_counter() - stats.started_at) * 1000
+    slow_ms = app.config.get('SLOW_REQUEST_MS')
+    if slow_ms is not None and elapsed_ms >= slow_ms:
+        app.logger.warning(
+            "Slow request %s %s took %.1f ms, %s queries took %.1f ms:\n%s",
+            request.method,
+            request.path,
+            elapsed_ms,
+            stats.count,
+            stats.seconds * 1000,
+            '\n'.join(
+                "  %sx %.1f ms: %s" % (count, seconds * 1000, statement)
+                for statement, count, seconds in stats.top_statements(
+                    app.config.get('SLOW_REQUEST_TOP_STATEMENTS'))
+            ),
+        )
+
+    view = app.view_functions.get(request.endpoint)
+    budget = getattr(view, 'query_budget', None)
+    if budget is not None and stats.count > budget:
+        message = "{} sent {} queries, over its budget of {}".format(
+            request.endpoint, stats.count, budget)
+        if app.config.get('QUERY_BUDGET_ENFORCE'):
+            raise QueryBudgetExceeded(message)
+        app.logger.warning(message)
+
+    return response
+
+
+def _teardown_request(exc):
+    g.pop('query_stats', None)
+
+
+def init_app(app):
+    # The listeners are global, so every engine is counted, but only
+    # statements sent while handling a request are recorded
+    if not event.contains(Engine, 'before_cursor_execute',
+                          _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.teardown_request(_teardown_request)
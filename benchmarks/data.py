@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+Generates a synthetic dataset of people, destinations, carpools and ride
+requests, spread around US metro areas, for the benchmarks.
+
+Run it against a scratch PostGIS database, never a real one. Rows are
+added to whatever is already there, with COPY (see app/bulk_load.py):
+
+    BENCHMARK_DATABASE_URL=postgresql://localhost/nomad_bench \
+        python -m benchmarks.data --people 100000
+
+or load the database the app is configured with:
+
+    FLASK_APP=benchmarks/tasks.py flask load_synthetic_data --people 1000000
+"""
+import argparse
+import datetime
+import itertools
+import os
+import random
+import time
+import uuid
+
+from app import create_app, db
+from app.bulk_load import bulk_loading, copy_rows, ewkb_point
+from app.models import Carpool, Destination, Person, RideRequest, Role
+
+# (lat, lon) of the metro areas carpools and destinations cluster around
+METROS = [
+    (40.71, -74.01),   # New York
+    (34.05, -118.24),  # Los Angeles
+    (41.88, -87.63),   # Chicago
+    (29.76, -95.37),   # Houston
+    (33.45, -112.07),  # Phoenix
+    (39.95, -75.17),   # Philadelphia
+    (29.42, -98.49),   # San Antonio
+    (32.72, -117.16),  # San Diego
+    (32.78, -96.80),   # Dallas
+    (37.77, -122.42),  # San Francisco
+    (30.27, -97.74),   # Austin
+    (39.74, -104.99),  # Denver
+    (47.61, -122.33),  # Seattle
+    (42.36, -71.06),   # Boston
+    (33.75, -84.39),   # Atlanta
+    (25.76, -80.19),   # Miami
+    (44.98, -93.27),   # Minneapolis
+    (35.23, -80.84),   # Charlotte
+    (38.91, -77.04),   # Washington
+    (36.17, -115.14),  # Las Vegas
+]
+# Standard deviation, in degrees, of points around their metro
+METRO_SPREAD = 0.3
+
+# The gender choices of the profile form (app/auth/forms.py)
+GENDERS = ['Female', 'Male', 'Non-binary / third gender', 'Self-described',
+           'Prefer not to say']
+# Ride request states, weighted roughly like production
+STATUSES = ['requested'] * 3 + ['approved'] * 5 + ['denied']
+
+BENCHMARK_SOCIAL_ID = 'benchmark-user'
+# Carpools are copied in, followed by their ride requests, this many at a time
+COPY_BATCH_SIZE = 50000
+
+
+def dataset_sizes(people):
+    """ Returns how many of each kind of row to generate for `people` people. """
+    return {
+        'people': people,
+        'destinations': max(10, people // 2000),
+        'carpools': max(10, people // 5),
+    }
+
+
+def ewkt_point(lat, lon):
+    return 'SRID=4326;POINT({:.6f} {:.6f})'.format(lon, lat)
+
+
+def near_metro(rng):
+    lat, lon = rng.choice(METROS)
+    return rng.gauss(lat, METRO_SPREAD), rng.gauss(lon, METRO_SPREAD)
+
+
+def next_id(model):
+    return (db.session.query(db.func.max(model.id)).scalar() or 0) + 1
+
+
+def generate_people(rng, first_id, count):
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    for person_id in range(first_id, first_id + count):
+        gender = rng.choice(GENDERS)
+        yield {
+            'id': person_id,
+            'uuid': uuid.UUID(int=rng.getrandbits(128), version=4),
+            'created_at': now,
+            'social_id': 'synthetic-{}'.format(person_id),
+            'email': 'person{}@example.com'.format(person_id),
+            'phone_number': '555{:07d}'.format(person_id % 10000000),
+            'name': 'Person {}'.format(person_id),
+            'gender': gender,
+            'gender_self_describe':
+                'Genderqueer' if gender == 'Self-described' else None,
+            'preferred_contact_method': 'email',
+        }
+
+
+def generate_destinations(rng, first_id, count):
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    for destination_id in range(first_id, first_id + count):
+        lat, lon = near_metro(rng)
+        yield {
+            'id': destination_id,
+            'uuid': uuid.UUID(int=rng.getrandbits(128), version=4),
+            'created_at': now,
+            'hidden': rng.random() < 0.05,
+            'point': ewkb_point(lat, lon),
+            'name': 'Destination {}'.format(destination_id),
+            'address': '{} Main Street'.format(destination_id),
+        }
+
+
+def generate_carpools(rng, first_id, count, people_ids, destination_ids,
+                      first_ride_request_id):
+    """
+    Yields ('carpools', row) and ('riders', row) pairs: each carpool is
+    followed by its ride requests, so its approved_count can be set
+    without the session events that normally keep it up to date.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    ride_request_ids = itertools.count(first_ride_request_id)
+
+    for carpool_id in range(first_id, first_id + count):
+        lat, lon = near_metro(rng)
+        # Most carpools are upcoming, some have already left
+        leave_time = now + datetime.timedelta(hours=rng.uniform(-30 * 24, 60 * 24))
+        max_riders = rng.randint(1, 6)
+        driver_id = rng.choice(people_ids)
+        canceled = rng.random() < 0.03
+
+        ride_requests = []
+        approved = 0
+        for person_id in rng.sample(people_ids, rng.randint(0, max_riders + 2)):
+            if person_id == driver_id:
+                continue
+            status = rng.choice(STATUSES)
+            if status == 'approved':
+                if approved == max_riders:
+                    status = 'requested'
+                else:
+                    approved += 1
+            ride_requests.append({
+                'id': next(ride_request_ids),
+                'uuid': uuid.UUID(int=rng.getrandbits(128), version=4),
+                'created_at': now,
+                'person_id': person_id,
+                'carpool_id': carpool_id,
+                'status': status,
+                'notes': None,
+            })
+
+        yield 'carpools', {
+            'id': carpool_id,
+            'uuid': uuid.UUID(int=rng.getrandbits(128), version=4),
+            'created_at': now,
+            'from_place': 'Start {}'.format(carpool_id),
+            'from_point': ewkb_point(lat, lon),
+            'leave_time': leave_time,
+            'return_time': leave_time + datetime.timedelta(hours=rng.randint(4, 12)),
+            'max_riders': max_riders,
+            'driver_id': driver_id,
+            'destination_id': rng.choice(destination_ids),
+            'canceled': canceled,
+            'cancel_reason': 'Synthetic cancellation' if canceled else None,
+            'approved_count': approved,
+            'vehicle_description': 'Blue hatchback',
+        }
+
+        for ride_request in ride_requests:
+            yield 'riders', ride_request
+
+
+def batches(rows, size=COPY_BATCH_SIZE):
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def populate(people, seed=None):
+    """
+    Adds a dataset of `people` people and proportionate numbers of
+    destinations, carpools and ride requests, with COPY (see
+    app/bulk_load.py). Returns the row counts.
+    """
+    rng = random.Random(seed)
+    sizes = dataset_sizes(people)
+    counts = {'carpools': 0, 'riders': 0}
+
+    with bulk_loading(Person.__table__, Destination.__table__,
+                      Carpool.__table__, RideRequest.__table__):
+        first_person_id = next_id(Person)
+        copy_rows(Person.__table__,
+                  generate_people(rng, first_person_id, sizes['people']))
+        people_ids = list(range(first_person_id,
+                                first_person_id + sizes['people']))
+
+        first_destination_id = next_id(Destination)
+        copy_rows(Destination.__table__,
+                  generate_destinations(rng, first_destination_id,
+                                        sizes['destinations']))
+        destination_ids = list(range(first_destination_id,
+                                     first_destination_id + sizes['destinations']))
+
+        rows = generate_carpools(rng, next_id(Carpool), sizes['carpools'],
+                                 people_ids, destination_ids,
+                                 next_id(RideRequest))
+        for batch in batches(rows):
+            # Each batch's carpools go in before the ride requests that refer to them
+            for kind in ('carpools', 'riders'):
+                counts[kind] += copy_rows(
+                    db.metadata.tables[kind],
+                    (row for row_kind, row in batch if row_kind == kind))
+
+    return dict(sizes, **counts)
+
+
+def ensure_benchmark_user():
+    """
+    Returns the admin the benchmarks log in as, who drives a few
+    upcoming carpools near New York and has asked to join a few more.
+    """
+    person = Person.query.filter_by(social_id=BENCHMARK_SOCIAL_ID).first()
+    if person:
+        return person
+
+    person = Person(social_id=BENCHMARK_SOCIAL_ID, name='Benchmark User',
+                    email='benchmark@example.com', gender='Female')
+    admin = Role.query.filter_by(name='admin').first() or Role(name='admin')
+    person.roles.append(admin)
+    db.session.add(person)
+    db.session.flush()
+
+    destination = Destination.query.filter_by(hidden=False).first()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    for days in (2, 7, 14):
+        db.session.add(Carpool(
+            from_place='Benchmark start',
+            from_point=ewkt_point(40.7128, -74.0060),
+            leave_time=now + datetime.timedelta(days=days),
+            return_time=now + datetime.timedelta(days=days, hours=8),
+            max_riders=4,
+            driver=person,
+            destination=destination,
+        ))
+
+    nearby = Carpool.query.\
+        filter(Carpool.leave_time > now).\
+        filter(Carpool.driver_id != person.id).\
+        filter(Carpool.approved_count < Carpool.max_riders).\
+        order_by(Carpool.id).\
+        limit(5)
+    for n, carpool in enumerate(nearby):
+        db.session.add(RideRequest(
+            person=person,
+            carpool=carpool,
+            status='approved' if n == 0 else 'requested',
+        ))
+
+    db.session.commit()
+    return person
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--people', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--database-url',
+                        default=os.environ.get('BENCHMARK_DATABASE_URL'))
+    args = parser.parse_args()
+
+    if not args.database_url:
+        parser.error('set BENCHMARK_DATABASE_URL or pass --database-url '
+                     'with a scratch database')
+
+    app = create_app('default')
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database_url
+
+    with app.app_context():
+        db.session.execute('create extension if not exists postgis')
+        db.session.commit()
+        db.create_all()
+
+        start = time.perf_counter()
+        counts = populate(args.people, args.seed)
+        ensure_benchmark_user()
+        elapsed = time.perf_counter() - start
+
+        print(', '.join('{} {}'.format(count, kind)
+                        for kind, count in counts.items()))
+        print('Loaded in {:.1f} s'.format(elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+Times the busiest endpoints and the reminder email command against a
+synthetic dataset, and writes the results to a JSON file that can be
+compared across commits.
+
+Run it against a scratch PostGIS database, never a real one. Unless
+--no-populate is given, it first grows the dataset to --people people
+(see benchmarks/data.py):
+
+    BENCHMARK_DATABASE_URL=postgresql://localhost/nomad_bench \
+        python -m benchmarks.endpoints --people 100000 \
+        --output benchmark-results.json
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import statistics
+import subprocess
+import time
+
+from click.testing import CliRunner
+from flask.cli import ScriptInfo
+
+from app import create_app, db
+from app.carpool.search import invalidate_search_cache
+from app.models import Carpool, Destination, Person
+from . import data
+
+# The search points starts.geojson is timed with, around the metros
+# carpools are generated near
+SEARCH_POINTS = 20
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(timings, queries=None):
+    """ Returns the median, 95th percentile and slowest of `timings` (ms). """
+    timings = sorted(timings)
+    return {
+        'runs': len(timings),
+        'median_ms': round(statistics.median(timings), 2),
+        'p95_ms': round(timings[max(0, int(len(timings) * 0.95) - 1)], 2),
+        'max_ms': round(timings[-1], 2),
+        'queries': queries,
+    }
+
+
+def timed_gets(client, urls):
+    """
+    GETs each of `urls`, reading the whole body so streamed responses are
+    timed to their last byte. Returns the timings and the most queries
+    any of the requests made.
+    """
+    timings = []
+    queries = 0
+    for url in urls:
+        start = time.perf_counter()
+        res = client.get(url)
+        res.get_data()
+        timings.append((time.perf_counter() - start) * 1000)
+        if res.status_code != 200:
+            raise RuntimeError('{} returned {}'.format(url, res.status_code))
+        queries = max(queries, int(res.headers.get('X-DB-Queries', 0)))
+    return timings, queries
+
+
+def time_requests(client, urls, repeat):
+    """ Times a GET of each of `urls`, `repeat` times over. """
+    timings = []
+    queries = 0
+    for _ in range(repeat):
+        run_timings, run_queries = timed_gets(client, urls)
+        timings.extend(run_timings)
+        queries = max(queries, run_queries)
+    return summarize(timings, queries)
+
+
+def time_searches(client, rng, repeat):
+    """
+    Times starts.geojson with a cold and a warm search cache. Each of the
+    `repeat` runs searches new points right after invalidating the cache,
+    then searches the same points again.
+    """
+    cold, warm = [], []
+    cold_queries = warm_queries = 0
+    for _ in range(repeat):
+        invalidate_search_cache()
+        urls = search_urls(rng)
+
+        timings, queries = timed_gets(client, urls)
+        cold.extend(timings)
+        cold_queries = max(cold_queries, queries)
+
+        timings, queries = timed_gets(client, urls)
+        warm.extend(timings)
+        warm_queries = max(warm_queries, queries)
+    return summarize(cold, cold_queries), summarize(warm, warm_queries)
+
+
+def time_reminders(app, runs):
+    """ Times enqueue_scheduled_emails, making every reminder due again first. """
+    from app.email.reminder_tasks import enqueue_scheduled_emails
+
+    timings = []
+    for _ in range(runs):
+        db.session.execute('update carpools set reminder_email_sent_at = null')
+        db.session.commit()
+
+        start = time.perf_counter()
+        result = CliRunner().invoke(
+            enqueue_scheduled_emails,
+            obj=ScriptInfo(create_app=lambda info: app),
+        )
+        timings.append((time.perf_counter() - start) * 1000)
+        if result.exception:
+            raise result.exception
+    return summarize(timings)
+
+
+def search_urls(rng):
+    urls = []
+    for _ in range(SEARCH_POINTS):
+        lat, lon = data.near_metro(rng)
+        urls.append('/carpools/starts.geojson?near.lat={:.4f}&near.lon={:.4f}'
+                    .format(lat, lon))
+    return urls
+
+
+def sample_uuids(model, count, *criteria):
+    rows = db.session.query(model.uuid).\
+        filter(*criteria).\
+        order_by(db.func.random()).\
+        limit(count)
+    return [str(row.uuid) for row in rows]
+
+
+def log_in(client, person):
+    with client.session_transaction() as session:
+        session['user_id'] = str(person.uuid)
+        session['_fresh'] = True
+
+
+def run(app, repeat, reminder_runs, seed=None):
+    rng = random.Random(seed)
+    person = data.ensure_benchmark_user()
+    carpool_uuids = sample_uuids(Carpool, 10, Carpool.approved_count > 0)
+    destination_uuids = sample_uuids(Destination, 10, Destination.hidden == False)
+
+    anonymous = app.test_client()
+    logged_in = app.test_client()
+    log_in(logged_in, person)
+
+    results = {}
+    # Searches are cached per tile, so they're timed both ways
+    for name, client in (('anonymous', anonymous), ('logged_in', logged_in)):
+        cold, warm = time_searches(client, rng, repeat)
+        results['starts_geojson_{}_cold'.format(name)] = cold
+        results['starts_geojson_{}_warm'.format(name)] = warm
+
+    results.update({
+        'carpools_mine': time_requests(
+            logged_in, ['/carpools/mine'], repeat),
+        'carpool_details': time_requests(
+            logged_in, ['/carpools/{}'.format(u) for u in carpool_uuids], repeat),
+        'destination_details': time_requests(
+            logged_in, ['/destinations/{}'.format(u) for u in destination_uuids],
+            repeat),
+        'admin_users_csv': time_requests(
+            logged_in, ['/admin/users.csv'], 1),
+        'admin_carpools_csv': time_requests(
+            logged_in, ['/admin/carpools.csv'], 1),
+        'enqueue_scheduled_emails': time_reminders(app, reminder_runs),
+    })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--people', type=int, default=10000)
+    parser.add_argument('--no-populate', action='store_true',
+                        help="Time the dataset that's already loaded")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--reminder-runs', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--database-url',
+                        default=os.environ.get('BENCHMARK_DATABASE_URL'))
+    args = parser.parse_args()
+
+    if not args.database_url:
+        parser.error('set BENCHMARK_DATABASE_URL or pass --database-url '
+                     'with a scratch database')
+
+    app = create_app('default')
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database_url
+    app.config['QUERY_STATS_HEADERS'] = True
+    app.config['MAIL_LOG_ONLY'] = True
+    app.config['RQ_ENABLED'] = False
+    app.config['SERVER_NAME'] = app.config.get('SERVER_NAME') or 'localhost'
+
+    with app.app_context():
+        db.session.execute('create extension if not exists postgis')
+        db.session.commit()
+        db.create_all()
+
+        existing = db.session.query(db.func.count(Person.id)).scalar()
+        if not args.no_populate and existing < args.people:
+            print('Adding {} people'.format(args.people - existing))
+            data.populate(args.people - existing, args.seed)
+
+        dataset = {
+            'people': db.session.query(db.func.count(Person.id)).scalar(),
+            'destinations': db.session.query(db.func.count(Destination.id)).scalar(),
+            'carpools': db.session.query(db.func.count(Carpool.id)).scalar(),
+            'riders': db.session.execute('select count(*) from riders').scalar(),
+        }
+        results = run(app, args.repeat, args.reminder_runs, args.seed)
+
+    report = {
+        'commit': git_commit(),
+        'created_at': datetime.datetime.utcnow().isoformat() + 'Z',
+        'dataset': dataset,
+        'repeat': args.repeat,
+        'results': results,
+    }
+    with open(args.output, 'w') as out:
+        json.dump(report, out, indent=2, sort_keys=True)
+
+    print('{:<32} {:>10} {:>10} {:>10} {:>8}'.format(
+        'benchmark', 'median ms', 'p95 ms', 'max ms', 'queries'))
+    for name, result in sorted(results.items()):
+        print('{:<32} {:>10.2f} {:>10.2f} {:>10.2f} {:>8}'.format(
+            name, result['median_ms'], result['p95_ms'], result['max_ms'],
+            result['queries'] if result['queries'] is not None else '-'))
+    print('Wrote {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
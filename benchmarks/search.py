@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Measures carpool search latency as the carpools table grows.
+
+Run it against a scratch PostGIS database, never a real one. It creates
+the schema if needed and keeps adding synthetic carpools to it:
+
+    BENCHMARK_DATABASE_URL=postgresql://localhost/nomad_bench \
+        python -m benchmarks.search --sizes 1000 10000 100000 1000000
+
+With the start point index in place, the median search time should stay
+roughly flat from one table size to the next.
+"""
+import argparse
+import os
+import random
+import statistics
+import time
+
+from app import create_app, db
+from app.carpool.search import search_carpools_near
+
+# Roughly the contiguous United States
+MIN_LAT, MAX_LAT = 25.0, 49.0
+MIN_LON, MAX_LON = -124.0, -67.0
+
+GROW_CARPOOLS = '''
+    insert into carpools (uuid, from_place, from_point, leave_time,
+                          return_time, max_riders, driver_id,
+                          destination_id, canceled)
+    select md5(random()::text || n::text)::uuid,
+           'Benchmark start ' || n,
+           ST_SetSRID(ST_MakePoint(
+               :min_lon + random() * (:max_lon - :min_lon),
+               :min_lat + random() * (:max_lat - :min_lat)), 4326),
+           now() + (random() * 60 || ' days')::interval,
+           now() + (60 + random() * 60 || ' days')::interval,
+           4, :driver_id, :destination_id, false
+    from generate_series(1, :count) as n
+'''
+
+
+def ensure_fixtures():
+    """ Returns the ids of the driver and destination benchmark carpools use. """
+    driver_id = db.session.execute('''
+        insert into people (uuid, social_id, name, email, gender)
+        values (md5(random()::text)::uuid, 'benchmark-' || random(),
+                'Benchmark Driver', 'driver@example.com', 'Female')
+        returning id
+    ''').scalar()
+    destination_id = db.session.execute('''
+        insert into destinations (uuid, name, address, hidden, point)
+        values (md5(random()::text)::uuid, 'Benchmark Destination',
+                '123 Fake Street', false,
+                ST_SetSRID(ST_MakePoint(-97.328, 38.518), 4326))
+        returning id
+    ''').scalar()
+    db.session.commit()
+    return driver_id, destination_id
+
+
+def grow_carpools(size, driver_id, destination_id):
+    """ Adds synthetic carpools until the table holds `size` rows. """
+    current = db.session.execute('select count(*) from carpools').scalar()
+    if current < size:
+        db.session.execute(GROW_CARPOOLS, {
+            'min_lat': MIN_LAT, 'max_lat': MAX_LAT,
+            'min_lon': MIN_LON, 'max_lon': MAX_LON,
+            'driver_id': driver_id,
+            'destination_id': destination_id,
+            'count': size - current,
+        })
+        db.session.commit()
+        db.session.execute('analyze carpools')
+        db.session.commit()
+
+
+def time_searches(searches):
+    """ Returns the duration in milliseconds of each of `searches` random searches. """
+    timings = []
+    for _ in range(searches):
+        lat = random.uniform(MIN_LAT, MAX_LAT)
+        lon = random.uniform(MIN_LON, MAX_LON)
+        start = time.perf_counter()
+        search_carpools_near(lat, lon)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--searches', type=int, default=50)
+    parser.add_argument('--database-url',
+                        default=os.environ.get('BENCHMARK_DATABASE_URL'))
+    args = parser.parse_args()
+
+    if not args.database_url:
+        parser.error('set BENCHMARK_DATABASE_URL or pass --database-url '
+                     'with a scratch database')
+
+    app = create_app('default')
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database_url
+
+    with app.app_context():
+        db.session.execute('create extension if not exists postgis')
+        db.session.commit()
+        db.create_all()
+        driver_id, destination_id = ensure_fixtures()
+
+        print('{:>10} {:>10} {:>10} {:>10}'.format(
+            'carpools', 'median ms', 'p95 ms', 'max ms'))
+        for size in sorted(args.sizes):
+            grow_carpools(size, driver_id, destination_id)
+            # warm up the cache and connection before measuring
+            time_searches(5)
+            timings = sorted(time_searches(args.searches))
+            print('{:>10} {:>10.2f} {:>10.2f} {:>10.2f}'.format(
+                size,
+                statistics.median(timings),
+                timings[int(len(timings) * 0.95) - 1],
+                timings[-1],
+            ))
+
+
+if __name__ == '__main__':
+    main()
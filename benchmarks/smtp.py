@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Compares sending email over a new SMTP connection per message with
+reusing one pooled connection.
+
+It starts a local aiosmtpd server that accepts and discards messages,
+so nothing is delivered anywhere. aiosmtpd isn't an app dependency:
+
+    pip install aiosmtpd
+    python -m benchmarks.smtp --messages 1000
+"""
+import argparse
+import time
+
+from flask_mail import Message
+
+from app import create_app, mail
+from app.email import PooledConnection
+
+
+class CountingHandler:
+    def __init__(self):
+        self.received = 0
+
+    async def handle_DATA(self, server, session, envelope):
+        self.received += 1
+        return '250 Message accepted for delivery'
+
+
+def make_message(n):
+    return Message(
+        recipients=['rider{}@example.com'.format(n)],
+        subject='Your carpool is coming up!',
+        body='Benchmark message {}'.format(n),
+        html='<p>Benchmark message {}</p>'.format(n),
+    )
+
+
+def send_connection_per_message(messages):
+    for message in messages:
+        with mail.connect() as conn:
+            conn.send(message)
+
+
+def send_pooled(messages):
+    pool = PooledConnection()
+    for message in messages:
+        pool.send(message)
+    pool.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--port', type=int, default=8025)
+    parser.add_argument('--max-messages-per-connection', type=int, default=100)
+    args = parser.parse_args()
+
+    try:
+        from aiosmtpd.controller import Controller
+    except ImportError:
+        parser.error('this benchmark needs aiosmtpd: pip install aiosmtpd')
+
+    handler = CountingHandler()
+    controller = Controller(handler, hostname='127.0.0.1', port=args.port)
+    controller.start()
+
+    app = create_app('default')
+    app.config.update(
+        MAIL_SERVER='127.0.0.1',
+        MAIL_PORT=args.port,
+        MAIL_USE_TLS=False,
+        MAIL_USE_SSL=False,
+        MAIL_USERNAME=None,
+        MAIL_PASSWORD=None,
+        MAIL_MAX_MESSAGES_PER_CONNECTION=args.max_messages_per_connection,
+    )
+    # Flask-Mail reads its settings when it's set up
+    mail.init_app(app)
+
+    try:
+        with app.app_context():
+            messages = [make_message(n) for n in range(args.messages)]
+
+            print('{:>24} {:>10} {:>12}'.format('', 'seconds', 'messages/s'))
+            for name, send in [('connection per message', send_connection_per_message),
+                               ('pooled connection', send_pooled)]:
+                received = handler.received
+                start = time.perf_counter()
+                send(messages)
+                elapsed = time.perf_counter() - start
+                assert handler.received - received == len(messages)
+                print('{:>24} {:>10.2f} {:>12.0f}'.format(
+                    name, elapsed, len(messages) / elapsed))
+    finally:
+        controller.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,22 @@
+import os
+import click
+from app import create_app
+from benchmarks import data
+
+app = create_app(os.environ.get('CARPOOL_ENV', 'default'))
+
+
+@app.cli.command()
+@click.option('--people', type=int, default=10000,
+              help='Number of synthetic people to add.')
+@click.option('--seed', type=int, default=None)
+@click.confirmation_option(
+    prompt='This adds synthetic people, carpools and ride requests to the '
+           'DATABASE_URL database. Continue?')
+def load_synthetic_data(people, seed):
+    """ Bulk load a synthetic dataset with COPY, for load testing. """
+    counts = data.populate(people, seed)
+    data.ensure_benchmark_user()
+
+    app.logger.info("Loaded %s", ', '.join(
+        '{} {}'.format(count, kind) for kind, count in counts.items()))
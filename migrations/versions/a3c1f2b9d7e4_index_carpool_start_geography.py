@@ -0,0 +1,28 @@
+"""index carpool start point as geography
+
+Revision ID: a3c1f2b9d7e4
+Revises: 1c16c79d5f85
+Create Date: 2026-10-18 09:12:41.204518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3c1f2b9d7e4'
+down_revision = '1c16c79d5f85'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Carpool searches filter with ST_DWithin and order with <-> on the
+    # start point cast to geography, so the index is on that expression.
+    op.create_index('ix_carpools_from_point_geography', 'carpools',
+                    [sa.text('(from_point::geography)')],
+                    unique=False, postgresql_using='gist')
+
+
+def downgrade():
+    op.drop_index('ix_carpools_from_point_geography', table_name='carpools')
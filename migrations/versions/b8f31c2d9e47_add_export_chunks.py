@@ -0,0 +1,29 @@
+"""add export chunks
+
+Revision ID: b8f31c2d9e47
+Revises: e2a7c94b1f36
+Create Date: 2026-10-18 19:42:10.512388
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8f31c2d9e47'
+down_revision = 'e2a7c94b1f36'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('export_chunks',
+    sa.Column('name', sa.String(length=80), nullable=False),
+    sa.Column('position', sa.BigInteger(), autoincrement=False, nullable=False),
+    sa.Column('data', sa.LargeBinary(), nullable=False),
+    sa.PrimaryKeyConstraint('name', 'position')
+    )
+
+
+def downgrade():
+    op.drop_table('export_chunks')
@@ -0,0 +1,38 @@
+"""add carpool approved_count
+
+Revision ID: c4e8d1a7f209
+Revises: a3c1f2b9d7e4
+Create Date: 2026-10-18 10:31:05.118264
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4e8d1a7f209'
+down_revision = 'a3c1f2b9d7e4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('carpools', sa.Column('approved_count', sa.Integer(), nullable=False, server_default='0'))
+    op.execute('''
+        update carpools set approved_count = r.approved_count
+        from (
+            select carpool_id, count(*) as approved_count
+            from riders
+            where status = 'approved'
+            group by carpool_id
+        ) r
+        where carpools.id = r.carpool_id
+    ''')
+    op.create_index('ix_carpools_leave_time_has_seats', 'carpools', ['leave_time'],
+                    unique=False,
+                    postgresql_where=sa.text('NOT canceled AND approved_count < max_riders'))
+
+
+def downgrade():
+    op.drop_index('ix_carpools_leave_time_has_seats', table_name='carpools')
+    op.drop_column('carpools', 'approved_count')
@@ -0,0 +1,23 @@
+"""index riders by carpool and status
+
+Revision ID: d91b6e3c5a70
+Revises: c4e8d1a7f209
+Create Date: 2026-10-18 11:47:22.630194
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'd91b6e3c5a70'
+down_revision = 'c4e8d1a7f209'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_riders_carpool_id_status', 'riders', ['carpool_id', 'status'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_riders_carpool_id_status', table_name='riders')
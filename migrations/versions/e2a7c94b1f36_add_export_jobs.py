@@ -0,0 +1,44 @@
+"""add export jobs
+
+Revision ID: e2a7c94b1f36
+Revises: d91b6e3c5a70
+Create Date: 2026-10-18 13:05:51.218744
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2a7c94b1f36'
+down_revision = 'd91b6e3c5a70'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('export_jobs',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('uuid', postgresql.UUID(as_uuid=True), nullable=True),
+    sa.Column('created_at', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('updated_at', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('finished_at', sa.DateTime(timezone=True), nullable=True),
+    sa.Column('requested_by_id', sa.Integer(), nullable=True),
+    sa.Column('kind', sa.String(length=24), nullable=False),
+    sa.Column('status', sa.String(length=24), nullable=False),
+    sa.Column('last_key', sa.Integer(), nullable=False),
+    sa.Column('bytes_written', sa.BigInteger(), nullable=False),
+    sa.Column('rows_written', sa.Integer(), nullable=False),
+    sa.Column('carpools_written', sa.Integer(), nullable=False),
+    sa.Column('carpools_total', sa.Integer(), nullable=True),
+    sa.Column('error', sa.Text(), nullable=True),
+    sa.ForeignKeyConstraint(['requested_by_id'], ['people.id'], ondelete='SET NULL'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_export_jobs_uuid'), 'export_jobs', ['uuid'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_export_jobs_uuid'), table_name='export_jobs')
+    op.drop_table('export_jobs')
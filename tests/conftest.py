@@ -18,6 +18,8 @@ def app():
     app.config['SQLALCHEMY_DATABASE_URI'] = test_db_uri()
     # WTF CSRF Protection and Webtest seem to disagree.
     app.config['WTF_CSRF_ENABLED']  = False
+    # Fail tests that make a view go over its @query_budget
+    app.config['QUERY_BUDGET_ENFORCE'] = True
     context = app.app_context()
     context.push()
     yield app
@@ -48,6 +50,18 @@ def db(app):
     _db.session.close()
     _db.drop_all()
 
+@pytest.fixture
+def query_counter(db):
+    """The SQL statements sent to the database while a test runs."""
+    statements = []
+
+    def count_statement(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    sqlalchemy.event.listen(db.engine, 'before_cursor_execute', count_statement)
+    yield statements
+    sqlalchemy.event.remove(db.engine, 'before_cursor_execute', count_statement)
+
 @pytest.fixture(scope='session', autouse=True)
 def create_test_db():
     def_app = create_app('default')
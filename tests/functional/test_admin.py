@@ -1,5 +1,14 @@
+import csv
+import io
+from datetime import datetime, timedelta
 from http import HTTPStatus
 
+import pytest
+import sqlalchemy
+
+from app.admin import exports
+from app.admin.export_store import DatabaseExportStore, LocalExportStore
+from app.models import ExportJob
 from . import login_person
 from ..factories import CarpoolFactory, RideRequestFactory, DestinationFactory, PersonFactory
 
@@ -42,3 +51,248 @@ class TestAdmin:
         assert rows[1]['carpool_id'] == str(carpool.id)
         assert rows[1]['driver/rider'] == 'driver'
         assert rows[1]['name'] == driver.name
+
+    def test_drivers_and_riders_pages(self, testapp, db, person, admin_role):
+        destination = DestinationFactory()
+        for _ in range(20):
+            CarpoolFactory(destination=destination)
+
+        person.roles.append(admin_role)
+        db.session.commit()
+        login_person(testapp, person)
+
+        res = testapp.get('/admin/drivers_and_riders')
+        assert len(res.html.find(id='search-results').find_all('tr')) == 15
+        assert 'Next Page' in res.html.find('a', href=lambda h: h and 'page=2' in h).text
+
+        res = testapp.get('/admin/drivers_and_riders', params={'page': 2})
+        assert len(res.html.find(id='search-results').find_all('tr')) == 5
+        assert not res.html.find('a', href=lambda h: h and 'page=3' in h)
+
+    def test_drivers_and_riders_filters(self, testapp, db, person, admin_role):
+        today = datetime.now().replace(hour=12)
+        destination = DestinationFactory(name='Kept')
+        other_destination = DestinationFactory(name='Filtered')
+        CarpoolFactory(destination=destination, leave_time=today)
+        CarpoolFactory(destination=destination, leave_time=today + timedelta(days=5))
+        CarpoolFactory(destination=other_destination, leave_time=today)
+
+        person.roles.append(admin_role)
+        db.session.commit()
+        login_person(testapp, person)
+
+        res = testapp.get('/admin/drivers_and_riders', params={
+            'destination': str(destination.uuid),
+            'leave_after': today.date().isoformat(),
+            'leave_before': today.date().isoformat(),
+        })
+        rows = res.html.find(id='search-results').find_all('tr')
+        assert len(rows) == 1
+        assert 'Kept' in rows[0].text
+
+    def test_carpool_csv_counts(self, testapp, db, person, admin_role):
+        carpool = CarpoolFactory(max_riders=4)
+        RideRequestFactory(carpool=carpool, status='approved')
+        RideRequestFactory(carpool=carpool, status='approved')
+        RideRequestFactory(carpool=carpool, status='requested')
+        CarpoolFactory()
+
+        person.roles.append(admin_role)
+        db.session.commit()
+        login_person(testapp, person)
+
+        res = testapp.get('/admin/carpools.csv')
+        assert res.status_code == HTTPStatus.OK
+        rows = list(csv.DictReader(io.StringIO(res.body.decode()).readlines()[1:]))
+        counts = sorted((row['ride requests'], row['approved riders']) for row in rows)
+        assert counts == [('0', '0'), ('3', '2')]
+
+    def test_carpool_csv_streams_from_server_side_cursor(self, app, db, person, admin_role):
+        person.roles.append(admin_role)
+        destination = DestinationFactory()
+        db.session.commit()
+        # A synthetic export of 5,000 carpools, inserted without the ORM
+        db.session.execute('''
+            insert into carpools (from_place, from_point, leave_time,
+                                  return_time, max_riders, driver_id,
+                                  destination_id, canceled)
+            select 'Start ' || n, ST_SetSRID(ST_MakePoint(-74, 40.7), 4326),
+                   now(), now() + interval '8 hours', 4, :driver_id,
+                   :destination_id, false
+            from generate_series(1, 5000) as n
+        ''', {'driver_id': person.id, 'destination_id': destination.id})
+        db.session.commit()
+
+        # psycopg2 only fetches rows in batches from a named cursor; any
+        # other cursor holds the whole result in libpq's memory
+        export_cursors = []
+
+        def note_cursor(conn, cursor, statement, *args):
+            if 'from carpools cp' in statement:
+                export_cursors.append(cursor.name)
+
+        sqlalchemy.event.listen(db.engine, 'before_cursor_execute', note_cursor)
+        try:
+            client = app.test_client()
+            client.get('/callback/mock', query_string=dict(
+                id=person.social_id, name=person.name, email=person.email))
+            res = client.get('/admin/carpools.csv', buffered=False)
+            assert res.status_code == HTTPStatus.OK
+            lines = sum(chunk.count(b'\n') for chunk in res.response)
+            res.close()
+        finally:
+            sqlalchemy.event.remove(db.engine, 'before_cursor_execute', note_cursor)
+
+        assert lines == 5002
+        assert len(export_cursors) == 1
+        assert export_cursors[0] is not None
+
+
+class TestExports:
+    def test_export_runs_and_downloads(self, testapp, db, person, admin_role):
+        carpool = CarpoolFactory()
+        RideRequestFactory(carpool=carpool, status='approved')
+        person.roles.append(admin_role)
+        db.session.commit()
+        login_person(testapp, person)
+
+        expected = testapp.get('/admin/carpools.csv').body
+
+        res = testapp.get('/admin/exports')
+        res = res.forms['export-carpools-form'].submit().follow()
+        assert 'complete' in res
+        assert '100%' in res
+
+        res = res.click('Download CSV')
+        assert res.content_type == 'text/csv'
+        assert res.body == expected
+
+    def test_export_resumes_after_failure(self, testapp, db, person, admin_role, monkeypatch):
+        for _ in range(5):
+            CarpoolFactory()
+        person.roles.append(admin_role)
+        db.session.commit()
+        login_person(testapp, person)
+
+        expected = testapp.get('/admin/carpools.csv').body
+
+        # Stop the worker part way through the third batch of two carpools
+        monkeypatch.setattr(exports, 'EXPORT_BATCH_CARPOOLS', 2)
+        format_row = exports.EXPORTS['carpools']['format_row']
+        formatted = []
+
+        def failing_format_row(row):
+            formatted.append(row)
+            if len(formatted) == 5:
+                raise RuntimeError('worker went away')
+            return format_row(row)
+
+        monkeypatch.setitem(exports.EXPORTS['carpools'], 'format_row', failing_format_row)
+        job = ExportJob(kind='carpools', requested_by=person)
+        db.session.add(job)
+        db.session.commit()
+        with pytest.raises(RuntimeError):
+            exports.run_export(str(job.uuid))
+
+        assert job.status == ExportJob.STATUS_FAILED
+        assert job.carpools_written == 4
+
+        monkeypatch.setitem(exports.EXPORTS['carpools'], 'format_row', format_row)
+        res = testapp.get('/admin/exports/{}'.format(job.uuid))
+        res = res.forms['resume-export-form'].submit().follow()
+        assert 'complete' in res
+        assert res.click('Download CSV').body == expected
+
+    def test_export_starts_over_when_file_is_lost(self, testapp, db, person, admin_role, monkeypatch):
+        for _ in range(5):
+            CarpoolFactory()
+        person.roles.append(admin_role)
+        db.session.commit()
+        login_person(testapp, person)
+
+        expected = testapp.get('/admin/carpools.csv').body
+
+        monkeypatch.setattr(exports, 'EXPORT_BATCH_CARPOOLS', 2)
+        job = ExportJob(kind='carpools', requested_by=person)
+        db.session.add(job)
+        db.session.commit()
+        exports.run_export(str(job.uuid))
+
+        # The worker's disk went away, so did the file it wrote
+        store = exports.get_export_store()
+        store.delete(job.filename)
+        job.status = ExportJob.STATUS_FAILED
+        db.session.commit()
+
+        exports.run_export(str(job.uuid))
+        assert job.status == ExportJob.STATUS_COMPLETE
+        assert job.carpools_written == 5
+        res = testapp.get('/admin/exports/{}'.format(job.uuid))
+        assert res.click('Download CSV').body == expected
+
+    def test_local_store_never_extends_a_file(self, app, tmpdir):
+        app.config['EXPORT_DIR'] = str(tmpdir)
+        store = LocalExportStore(app)
+        with store.open('short.csv', 0) as out:
+            out.write(b'a,b\n')
+
+        with pytest.raises(ValueError):
+            store.open('short.csv', 100)
+        assert store.size('short.csv') == 4
+
+    def test_database_store_truncates_on_open(self, app, db):
+        store = DatabaseExportStore(app)
+        with store.open('export.csv', 0) as out:
+            out.write(b'a,b\n')
+            out.write(b'c,d\n')
+        db.session.commit()
+        assert store.exists('export.csv')
+        assert store.size('export.csv') == 8
+
+        with store.open('export.csv', 4) as out:
+            out.write(b'e,f\n')
+        db.session.commit()
+        assert store.size('export.csv') == 8
+        with pytest.raises(ValueError):
+            store.open('export.csv', 100)
+
+        store.delete('export.csv')
+        assert not store.exists('export.csv')
+
+    def test_old_exports_are_deleted(self, app, db, person, monkeypatch):
+        monkeypatch.setattr(exports, 'EXPORT_BATCH_CARPOOLS', 2)
+        CarpoolFactory()
+        old, running = ExportJob(kind='carpools'), ExportJob(kind='users')
+        db.session.add_all([old, running])
+        db.session.commit()
+        exports.run_export(str(old.uuid))
+
+        store = exports.get_export_store()
+        assert store.exists(old.filename)
+        long_ago = datetime.utcnow() - timedelta(
+            hours=app.config['EXPORT_RETENTION_HOURS'] + 1)
+        ExportJob.query.update({'updated_at': long_ago})
+        db.session.commit()
+
+        job = exports.start_export('carpools', person)
+
+        assert ExportJob.query.filter_by(uuid=old.uuid).count() == 0
+        assert not store.exists(old.filename)
+        # Jobs that haven't finished are kept
+        assert ExportJob.query.filter_by(uuid=running.uuid).count() == 1
+        assert store.exists(job.filename)
+
+    def test_admin_can_delete_export(self, testapp, db, person, admin_role):
+        CarpoolFactory()
+        person.roles.append(admin_role)
+        db.session.commit()
+        login_person(testapp, person)
+
+        res = testapp.get('/admin/exports')
+        res = res.forms['export-carpools-form'].submit().follow()
+        job = ExportJob.query.one()
+        filename = job.filename
+
+        res = res.forms['delete-export-form'].submit().follow()
+        assert ExportJob.query.count() == 0
+        assert not exports.get_export_store().exists(filename)
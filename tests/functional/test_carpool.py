@@ -7,6 +7,8 @@ from http import HTTPStatus
 from flask import url_for
 from freezegun import freeze_time
 
+from app import cache
+from app.carpool.search import SEARCH_CACHE_VERSION_KEY, invalidate_search_cache
 from app.models import PersonRole
 from . import login_person
 from ..factories import CarpoolFactory, RideRequestFactory, RoleFactory
@@ -148,3 +150,275 @@ class TestCarpool:
         db.session.commit()
         result = request_carpool_seat(testapp, carpools[12].uuid)
         assert confirm_msg in result
+
+
+def create_carpools_near_nyc(count, **kwargs):
+    leave_time = datetime.now() + timedelta(days=1)
+    return [
+        CarpoolFactory(
+            from_point='SRID=4326;POINT(-74.0060 40.7128)',
+            leave_time=leave_time,
+            return_time=leave_time + timedelta(hours=8),
+            **kwargs
+        )
+        for _ in range(count)
+    ]
+
+
+class TestCarpoolSearch:
+    def search(self, testapp, query_counter):
+        del query_counter[:]
+        res = testapp.get('/carpools/starts.geojson', params={
+            'near.lat': '40.7128',
+            'near.lon': '-74.0060',
+        })
+        return res, len(query_counter)
+
+    def test_anonymous_search_is_one_query(self, testapp, db, query_counter):
+        create_carpools_near_nyc(3)
+        db.session.commit()
+
+        res, queries = self.search(testapp, query_counter)
+        assert res.status_code == HTTPStatus.OK
+        assert len(res.json['features']) == 3
+        assert queries == 1
+
+    def test_search_queries_do_not_grow_with_results(self, testapp, db, full_person, query_counter):
+        create_carpools_near_nyc(2)
+        db.session.commit()
+        login_person(testapp, full_person)
+
+        res, few_queries = self.search(testapp, query_counter)
+        assert len(res.json['features']) == 2
+
+        create_carpools_near_nyc(8)
+        db.session.commit()
+        invalidate_search_cache()
+
+        res, many_queries = self.search(testapp, query_counter)
+        assert len(res.json['features']) == 10
+        assert many_queries == few_queries
+
+    def test_search_properties(self, testapp, db, full_person):
+        carpool, = create_carpools_near_nyc(1, max_riders=3)
+        carpool.driver.gender = 'Female'
+        RideRequestFactory(carpool=carpool, status='approved')
+        RideRequestFactory(carpool=carpool, status='requested')
+        db.session.commit()
+        login_person(testapp, full_person)
+
+        res = testapp.get('/carpools/starts.geojson', params={
+            'near.lat': '40.7128',
+            'near.lon': '-74.0060',
+        })
+        properties = res.json['features'][0]['properties']
+        assert properties['seats_available'] == 2
+        assert properties['to_place'] == carpool.destination.name
+        assert properties['driver_gender'] == 'Female'
+        assert properties['is_approximate_location']
+        assert not properties['hidden']
+
+    def test_approximate_locations_are_stable(self, testapp, db, query_counter):
+        create_carpools_near_nyc(2)
+        db.session.commit()
+
+        first, _ = self.search(testapp, query_counter)
+        second, _ = self.search(testapp, query_counter)
+        assert all(f['properties']['is_approximate_location']
+                   for f in first.json['features'])
+        assert [f['geometry'] for f in first.json['features']] == \
+            [f['geometry'] for f in second.json['features']]
+        assert first.json['features'][0]['geometry']['coordinates'] != \
+            [-74.006, 40.7128]
+
+    def test_search_is_cached_per_tile(self, testapp, db, query_counter):
+        create_carpools_near_nyc(2)
+        db.session.commit()
+
+        res, queries = self.search(testapp, query_counter)
+        assert len(res.json['features']) == 2
+        assert queries == 1
+
+        # a nearby search in the same tile is answered from the cache
+        del query_counter[:]
+        res = testapp.get('/carpools/starts.geojson', params={
+            'near.lat': '40.7130',
+            'near.lon': '-74.0062',
+        })
+        assert len(res.json['features']) == 2
+        assert len(query_counter) == 0
+
+    def test_search_cache_invalidated_by_new_carpool(self, testapp, db, full_person, destination, query_counter):
+        login_person(testapp, full_person)
+        res, _ = self.search(testapp, query_counter)
+        assert len(res.json['features']) == 0
+
+        create_carpool_for_tomorrow(testapp, destination)
+
+        res, _ = self.search(testapp, query_counter)
+        features = res.json['features']
+        assert len(features) == 1
+        # the driver sees their own exact location
+        assert not features[0]['properties']['is_approximate_location']
+        assert features[0]['geometry']['coordinates'] == [-74.006, 40.7128]
+
+    def test_features_are_cached_per_carpool(self, testapp, db, query_counter):
+        carpool, = create_carpools_near_nyc(1)
+        db.session.commit()
+        self.search(testapp, query_counter)
+        key = 'carpool-feature:{}'.format(carpool.id)
+        assert cache.get(key)
+
+    def test_cached_features_link_to_the_requested_host(self, testapp, db):
+        carpool, = create_carpools_near_nyc(1)
+        db.session.commit()
+        params = {'near.lat': '40.7128', 'near.lon': '-74.0060'}
+
+        res = testapp.get('/carpools/starts.geojson', params=params,
+                          extra_environ={'HTTP_HOST': 'preview.example.com'})
+        assert res.json['features'][0]['id'] == \
+            'http://preview.example.com/carpools/{}'.format(carpool.uuid)
+
+        res = testapp.get('/carpools/starts.geojson', params=params,
+                          extra_environ={'HTTP_HOST': 'www.example.com',
+                                         'wsgi.url_scheme': 'https'})
+        assert res.json['features'][0]['id'] == \
+            'https://www.example.com/carpools/{}'.format(carpool.uuid)
+
+    def test_feature_cache_invalidated_by_carpool_edit(self, testapp, db, query_counter):
+        carpool, = create_carpools_near_nyc(1)
+        db.session.commit()
+        self.search(testapp, query_counter)
+        key = 'carpool-feature:{}'.format(carpool.id)
+        assert cache.get(key)
+
+        carpool.from_place = 'Library'
+        db.session.commit()
+        assert cache.get(key) is None
+
+        invalidate_search_cache()
+        res, _ = self.search(testapp, query_counter)
+        assert res.json['features'][0]['properties']['from_place'] == 'Library'
+
+    def test_feature_cache_invalidated_by_ride_request_status(self, testapp, db, query_counter):
+        carpool, = create_carpools_near_nyc(1, max_riders=2)
+        ride_request = RideRequestFactory(carpool=carpool, status='requested')
+        db.session.commit()
+        self.search(testapp, query_counter)
+        key = 'carpool-feature:{}'.format(carpool.id)
+        assert cache.get(key)
+
+        ride_request.status = 'approved'
+        db.session.commit()
+        assert cache.get(key) is None
+
+        invalidate_search_cache()
+        res, _ = self.search(testapp, query_counter)
+        assert res.json['features'][0]['properties']['seats_available'] == 1
+
+    def test_search_cache_kept_on_noop_ride_request_change(self, testapp, db, full_person):
+        carpool, = create_carpools_near_nyc(1, driver=full_person)
+        ride_request = RideRequestFactory(carpool=carpool, status='approved')
+        db.session.commit()
+        login_person(testapp, full_person)
+        url = '/carpools/{}/request/{}/{{}}'.format(carpool.uuid, ride_request.uuid)
+
+        invalidate_search_cache()
+        version = cache.get(SEARCH_CACHE_VERSION_KEY)
+        testapp.post(url.format('approve'))
+        testapp.post(url.format('cancel'))
+        assert cache.get(SEARCH_CACHE_VERSION_KEY) == version
+
+        testapp.post(url.format('deny'))
+        assert cache.get(SEARCH_CACHE_VERSION_KEY) != version
+
+    def test_search_requires_location(self, testapp, db):
+        testapp.get('/carpools/starts.geojson', status=HTTPStatus.BAD_REQUEST)
+
+
+class TestMyCarpools:
+    def my_carpools_queries(self, testapp, query_counter):
+        del query_counter[:]
+        res = testapp.get('/carpools/mine')
+        assert res.status_code == HTTPStatus.OK
+        return len(query_counter)
+
+    def test_queries_do_not_grow_with_carpools(self, testapp, db, full_person, query_counter):
+        driving = create_carpools_near_nyc(1, driver=full_person)
+        riding = create_carpools_near_nyc(1)
+        RideRequestFactory(carpool=riding[0], person=full_person, status='approved')
+        RideRequestFactory(carpool=driving[0], status='approved')
+        db.session.commit()
+        login_person(testapp, full_person)
+
+        few_queries = self.my_carpools_queries(testapp, query_counter)
+
+        driving = create_carpools_near_nyc(4, driver=full_person)
+        riding = create_carpools_near_nyc(4)
+        for carpool in riding:
+            RideRequestFactory(carpool=carpool, person=full_person, status='requested')
+        for carpool in driving:
+            RideRequestFactory(carpool=carpool, status='approved')
+        db.session.commit()
+
+        many_queries = self.my_carpools_queries(testapp, query_counter)
+        assert many_queries == few_queries
+
+
+class TestCarpoolDetails:
+    def details_queries(self, testapp, carpool, query_counter):
+        del query_counter[:]
+        # @query_budget is enforced in the tests, so going over it fails here
+        res = testapp.get('/carpools/{}'.format(carpool.uuid))
+        assert res.status_code == HTTPStatus.OK
+        return res, len(query_counter)
+
+    def test_driver_queries_do_not_grow_with_riders(self, testapp, db, full_person, query_counter):
+        carpool, = create_carpools_near_nyc(1, driver=full_person, max_riders=30)
+        RideRequestFactory(carpool=carpool, status='requested')
+        db.session.commit()
+        login_person(testapp, full_person)
+
+        _, few_queries = self.details_queries(testapp, carpool, query_counter)
+
+        riders = [RideRequestFactory(carpool=carpool, status='requested').person
+                  for _ in range(20)]
+        db.session.commit()
+
+        res, many_queries = self.details_queries(testapp, carpool, query_counter)
+        assert many_queries == few_queries
+        assert all(rider.name in res for rider in riders)
+
+    def test_rider_view_with_many_riders(self, testapp, db, full_person, query_counter):
+        carpool, = create_carpools_near_nyc(1, max_riders=30)
+        RideRequestFactory(carpool=carpool, person=full_person, status='approved')
+        for _ in range(20):
+            RideRequestFactory(carpool=carpool, status='approved')
+        db.session.commit()
+        login_person(testapp, full_person)
+
+        res, _ = self.details_queries(testapp, carpool, query_counter)
+        assert carpool.driver.name in res
+
+
+class TestDestinationChoices:
+    def destination_options(self, testapp):
+        res = testapp.get('/carpools/new')
+        return [value for value, _, _ in res.forms['new-carpool-form']['destination'].options]
+
+    def test_destinations_are_cached(self, testapp, db, full_person, destination, query_counter):
+        login_person(testapp, full_person)
+        assert str(destination.uuid) in self.destination_options(testapp)
+
+        del query_counter[:]
+        assert str(destination.uuid) in self.destination_options(testapp)
+        assert not [s for s in query_counter if 'FROM destinations' in s]
+
+    def test_hidden_destinations_are_removed(self, testapp, db, full_person, admin_role, destination):
+        full_person.roles.append(admin_role)
+        db.session.commit()
+        login_person(testapp, full_person)
+        assert str(destination.uuid) in self.destination_options(testapp)
+
+        testapp.post('/admin/destinations/{}/togglehidden'.format(destination.uuid))
+        assert str(destination.uuid) not in self.destination_options(testapp)
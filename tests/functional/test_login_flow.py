@@ -3,6 +3,11 @@ from ..factories import PersonFactory
 from http import HTTPStatus
 import urllib
 
+from itsdangerous import URLSafeTimedSerializer
+from webtest import TestApp
+
+from app import cache
+
 
 class TestLoginFlow:
     def test_redirect_on_login(self, testapp, db, person, carpool):
@@ -32,3 +37,98 @@ class TestLoginFlow:
         assert res.status_code == HTTPStatus.FOUND
         url = urllib.parse.urlparse(res.headers['Location'])
         assert url.path == '/login'
+
+
+class TestPrincipalCache:
+    def test_logged_in_person_is_cached(self, testapp, db, person, query_counter):
+        login_person(testapp, person)
+        testapp.get('/')
+
+        del query_counter[:]
+        res = testapp.get('/')
+        assert res.status_code == HTTPStatus.OK
+        assert not [s for s in query_counter if 'FROM people' in s]
+
+    def test_profile_changes_show_right_away(self, testapp, db, person):
+        login_person(testapp, person)
+
+        form = testapp.get('/profile').forms['update-profile-form']
+        form['name'] = 'New Name'
+        form['gender'] = 'Female'
+        form.submit('submit')
+
+        form = testapp.get('/profile').forms['update-profile-form']
+        assert form['name'].value == 'New Name'
+        assert form['gender'].value == 'Female'
+
+    def test_blocking_logs_out_right_away(self, app, testapp, db, person,
+                                          admin_role, blocked_role):
+        login_person(testapp, person)
+        testapp.get('/')
+
+        admin = PersonFactory()
+        admin.roles.append(admin_role)
+        db.session.commit()
+        admin_app = TestApp(app)
+        login_person(admin_app, admin)
+        admin_app.post('/admin/users/{}/togglerole'.format(person.uuid),
+                       {'role_name': 'blocked'})
+
+        res = testapp.get('/profile')
+        assert res.status_code == HTTPStatus.FOUND
+        url = urllib.parse.urlparse(res.headers['Location'])
+        assert url.path == '/login'
+
+    def test_role_revocation_applies_right_away(self, app, testapp, db,
+                                                admin_role):
+        person = PersonFactory()
+        person.roles.append(admin_role)
+        admin = PersonFactory()
+        admin.roles.append(admin_role)
+        db.session.commit()
+        login_person(testapp, person)
+        assert testapp.get('/admin/').status_code == HTTPStatus.OK
+
+        admin_app = TestApp(app)
+        login_person(admin_app, admin)
+        admin_app.post('/admin/users/{}/togglerole'.format(person.uuid),
+                       {'role_name': 'admin'})
+
+        res = testapp.get('/admin/', expect_errors=True)
+        assert res.status_code == HTTPStatus.FORBIDDEN
+
+    def test_committed_changes_drop_the_snapshot(self, testapp, db, person,
+                                                 admin_role):
+        login_person(testapp, person)
+        testapp.get('/')
+        key = 'principal:{}'.format(person.uuid)
+        assert cache.get(key)
+
+        person.roles.append(admin_role)
+        db.session.commit()
+        assert cache.get(key) is None
+
+        testapp.get('/')
+        assert cache.get(key)
+        person.name = 'New Name'
+        db.session.flush()
+        db.session.rollback()
+        assert cache.get(key)
+
+    def test_tampered_snapshot_is_ignored(self, testapp, db, person):
+        login_person(testapp, person)
+        testapp.get('/')
+
+        forged = URLSafeTimedSerializer('not the secret', salt='principal').dumps({
+            'id': person.id,
+            'uuid': str(person.uuid),
+            'name': 'Someone Else',
+            'email': person.email,
+            'gender': person.gender,
+            'roles': ['admin'],
+        })
+        cache.set('principal:{}'.format(person.uuid), forged)
+
+        res = testapp.get('/profile')
+        assert res.forms['update-profile-form']['name'].value == person.name
+        assert testapp.get('/admin/', expect_errors=True).status_code != HTTPStatus.OK
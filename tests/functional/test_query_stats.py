@@ -0,0 +1,58 @@
+import logging
+from http import HTTPStatus
+
+import pytest
+
+from app import db as _db
+from app.query_stats import QueryBudgetExceeded, query_budget
+
+
+def add_view_with_budget(app, budget, queries):
+    @query_budget(budget)
+    def chatty():
+        for _ in range(queries):
+            _db.session.execute('select 1')
+        return 'ok'
+
+    app.add_url_rule('/chatty', 'chatty', chatty)
+
+
+class TestQueryStats:
+    def test_query_headers(self, testapp, db):
+        res = testapp.get('/carpools/starts.geojson', params={
+            'near.lat': '40.7128',
+            'near.lon': '-74.0060',
+        })
+        assert res.headers['X-DB-Queries'] == '1'
+        assert float(res.headers['X-DB-Time']) >= 0
+
+    def test_slow_requests_are_logged(self, app, testapp, db, caplog):
+        app.config['SLOW_REQUEST_MS'] = 0
+        add_view_with_budget(app, 10, 3)
+
+        with caplog.at_level(logging.WARNING):
+            testapp.get('/chatty')
+
+        message, = [r.getMessage() for r in caplog.records
+                    if 'Slow request' in r.getMessage()]
+        assert 'GET /chatty' in message
+        assert '3 queries' in message
+        assert '3x' in message
+        assert 'select 1' in message
+
+    def test_query_budget_is_enforced(self, app, testapp, db):
+        app.config['PROPAGATE_EXCEPTIONS'] = True
+        add_view_with_budget(app, 2, 3)
+
+        with pytest.raises(QueryBudgetExceeded):
+            testapp.get('/chatty')
+
+    def test_query_budget_is_logged(self, app, testapp, db, caplog):
+        app.config['QUERY_BUDGET_ENFORCE'] = False
+        add_view_with_budget(app, 2, 3)
+
+        with caplog.at_level(logging.WARNING):
+            res = testapp.get('/chatty')
+
+        assert res.status_code == HTTPStatus.OK
+        assert 'chatty sent 3 queries, over its budget of 2' in caplog.text
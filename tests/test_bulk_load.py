@@ -0,0 +1,64 @@
+import datetime
+
+from app import bulk_load
+from app.models import Destination, Person
+
+from .factories import PersonFactory
+
+
+class TestBulkLoad:
+    def test_copy_rows(self, db):
+        rows = [
+            {
+                'id': 100 + n,
+                'social_id': 'copied-{}'.format(n),
+                'name': 'Tab\tand\nnewline {}'.format(n),
+                'email': None,
+                'created_at': datetime.datetime(2018, 11, 6, 8, 30),
+            }
+            for n in range(3)
+        ]
+
+        copied = bulk_load.copy_rows(Person.__table__, iter(rows))
+        db.session.commit()
+
+        assert copied == 3
+        person = Person.query.get(101)
+        assert person.name == 'Tab\tand\nnewline 1'
+        assert person.email is None
+        assert person.created_at.replace(tzinfo=None) == datetime.datetime(2018, 11, 6, 8, 30)
+
+    def test_copy_geometry(self, db):
+        bulk_load.copy_rows(Destination.__table__, [{
+            'id': 1,
+            'name': 'Copied',
+            'hidden': False,
+            'point': bulk_load.ewkb_point(40.7128, -74.006),
+        }])
+        db.session.commit()
+
+        lon, lat, srid = db.session.query(
+            db.func.ST_X(Destination.point),
+            db.func.ST_Y(Destination.point),
+            db.func.ST_SRID(Destination.point),
+        ).one()
+        assert (lon, lat, srid) == (-74.006, 40.7128, 4326)
+
+    def test_bulk_loading_rebuilds_indexes(self, db):
+        def people_indexes():
+            return {row[0] for row in db.session.execute(
+                "select indexname from pg_indexes where tablename = 'people'")}
+        assert 'ix_people_email' in people_indexes()
+
+        with bulk_load.bulk_loading(Person.__table__):
+            assert 'ix_people_email' not in people_indexes()
+            bulk_load.copy_rows(Person.__table__, [
+                {'id': 50, 'social_id': 'copied', 'name': 'Copied'},
+            ])
+
+        assert 'ix_people_email' in people_indexes()
+
+        # New rows are numbered after the copied ones
+        person = PersonFactory()
+        db.session.commit()
+        assert person.id == 51
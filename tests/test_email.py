@@ -0,0 +1,213 @@
+import smtplib
+from unittest import mock
+
+import pytest
+
+from app import email
+from app.email import fanout, send_email, send_emails, send_rendered_email_queued
+from .factories import CarpoolFactory, DestinationFactory, PersonFactory, RideRequestFactory
+
+
+@pytest.mark.usefixtures('request_context')
+class TestPrerenderedEmail:
+    def test_prerendered_message(self, app, db, monkeypatch):
+        app.config['MAIL_PRERENDER'] = True
+        mock_send_message = mock.Mock()
+        monkeypatch.setattr(email, '_send_message', mock_send_message)
+        rider = PersonFactory()
+        carpool = CarpoolFactory(from_place='from')
+        db.session.commit()
+
+        send_email('ride_denied', rider.email, 'Denied', carpool=carpool, rider=rider)
+
+        message = mock_send_message.call_args[0][0]
+        assert message.recipients == [rider.email]
+        assert message.subject == 'Denied'
+        assert 'declined your request to join the carpool from from to dest' in message.body
+        assert 'declined your request to join the carpool from from to dest' in message.html
+
+    def test_sending_prerendered_message_skips_database(self, db, monkeypatch, query_counter):
+        mock_send_message = mock.Mock()
+        monkeypatch.setattr(email, '_send_message', mock_send_message)
+
+        send_rendered_email_queued('rider@example.com', 'Hello', 'text', '<p>html</p>')
+
+        assert len(query_counter) == 0
+        message = mock_send_message.call_args[0][0]
+        assert message.body == 'text'
+        assert message.html == '<p>html</p>'
+
+    def test_send_emails(self, app, db, monkeypatch):
+        app.config['MAIL_PRERENDER'] = True
+        mock_send_message = mock.Mock()
+        monkeypatch.setattr(email, '_send_message', mock_send_message)
+        rider = PersonFactory()
+        carpool = CarpoolFactory()
+        db.session.commit()
+
+        send_emails([
+            ('ride_denied', rider.email, 'Denied', dict(carpool=carpool, rider=rider)),
+            ('driver_reminder', carpool.driver.email, 'Reminder', dict(carpool=carpool)),
+        ])
+
+        recipients = [call[0][0].recipients for call in mock_send_message.call_args_list]
+        assert recipients == [[rider.email], [carpool.driver.email]]
+
+
+class FakeConnection:
+    def __init__(self, fail_first=False):
+        self.sent = []
+        self.closed = False
+        self.fail_first = fail_first
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.closed = True
+
+    def send(self, message):
+        if self.fail_first:
+            self.fail_first = False
+            raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+        self.sent.append(message)
+
+
+class TestPooledConnection:
+    def connect_with(self, monkeypatch, connections):
+        connections = iter(connections)
+        monkeypatch.setattr(email.mail, 'connect', lambda: next(connections))
+
+    def test_connection_is_reused(self, app, monkeypatch):
+        connection = FakeConnection()
+        self.connect_with(monkeypatch, [connection])
+        pool = email.PooledConnection()
+
+        for n in range(3):
+            pool.send(n)
+
+        assert connection.sent == [0, 1, 2]
+        assert not connection.closed
+
+    def test_connection_is_replaced_after_max_messages(self, app, monkeypatch):
+        app.config['MAIL_MAX_MESSAGES_PER_CONNECTION'] = 2
+        first, second = FakeConnection(), FakeConnection()
+        self.connect_with(monkeypatch, [first, second])
+        pool = email.PooledConnection()
+
+        for n in range(3):
+            pool.send(n)
+
+        assert first.sent == [0, 1]
+        assert first.closed
+        assert second.sent == [2]
+
+    def test_connection_is_replaced_when_idle(self, app, monkeypatch):
+        app.config['MAIL_POOL_IDLE_SECONDS'] = 60
+        first, second = FakeConnection(), FakeConnection()
+        self.connect_with(monkeypatch, [first, second])
+        pool = email.PooledConnection()
+
+        pool.send(0)
+        pool.send(1)
+        assert not first.closed
+
+        pool.last_used -= 61
+        pool.send(2)
+
+        assert first.sent == [0, 1]
+        assert first.closed
+        assert second.sent == [2]
+
+    def test_reconnects_when_disconnected(self, app, monkeypatch):
+        dropped, fresh = FakeConnection(fail_first=True), FakeConnection()
+        self.connect_with(monkeypatch, [dropped, fresh])
+        pool = email.PooledConnection()
+
+        pool.send('message')
+
+        assert dropped.closed
+        assert dropped.sent == []
+        assert fresh.sent == ['message']
+
+    def test_send_messages_uses_one_connection_per_batch(self, app, monkeypatch):
+        app.config['MAIL_LOG_ONLY'] = False
+        first, second = FakeConnection(), FakeConnection()
+        self.connect_with(monkeypatch, [first, second])
+        monkeypatch.setattr(email, 'smtp_connection', email.PooledConnection())
+        messages = [email.Message(recipients=['{}@example.com'.format(n)],
+                                  subject='Hello', body='Hi')
+                    for n in range(3)]
+
+        email.send_messages(messages[:2])
+        email.send_messages(messages[2:])
+
+        assert first.sent == messages[:2]
+        assert first.closed
+        assert second.sent == messages[2:]
+        assert second.closed
+
+
+@pytest.mark.usefixtures('request_context')
+class TestFanout:
+    def sent_batches(self, monkeypatch):
+        batches = []
+        monkeypatch.setattr(fanout, 'send_messages', batches.append)
+        return batches
+
+    def test_one_job_is_queued(self, app, monkeypatch):
+        app.config['RQ_ENABLED'] = True
+        mock_job = mock.Mock()
+        monkeypatch.setattr(fanout, 'send_fanout_email_queued', mock_job)
+
+        fanout.send_fanout_email('destination_modified', destination_id=1)
+
+        mock_job.queue.assert_called_once_with(
+            'destination_modified', destination_id=1)
+
+    def test_carpool_cancelled(self, app, db, monkeypatch):
+        app.config['MAIL_FANOUT_BATCH_SIZE'] = 2
+        batches = self.sent_batches(monkeypatch)
+        carpool = CarpoolFactory()
+        approved = RideRequestFactory(carpool=carpool, status='approved').person
+        requested = RideRequestFactory(carpool=carpool, status='requested').person
+        RideRequestFactory(carpool=carpool, status='denied')
+        db.session.commit()
+        driver = carpool.driver
+
+        # Purging the driver deletes the carpool before the worker runs
+        snapshot = fanout.carpool_cancelled_snapshot(carpool, 'Rain', notify_driver=True)
+        for ride_request in carpool.ride_requests:
+            db.session.delete(ride_request)
+        db.session.delete(carpool)
+        db.session.commit()
+        fanout.send_fanout_email_queued('carpool_cancelled', **snapshot)
+
+        assert [len(batch) for batch in batches] == [2, 1]
+        sent = [message for batch in batches for message in batch]
+        recipients = sorted(message.recipients[0] for message in sent)
+        assert recipients == sorted([approved.email, requested.email, driver.email])
+        assert 'Rain' in sent[0].body
+        assert 'from {} to {}'.format(snapshot['carpool']['from_place'],
+                                      snapshot['carpool']['destination']['name']) \
+            in sent[0].body
+
+    def test_destination_deleted(self, app, db, monkeypatch):
+        batches = self.sent_batches(monkeypatch)
+        destination = DestinationFactory(name='Town Hall')
+        carpool = CarpoolFactory(destination=destination, from_place='Library')
+        rider = RideRequestFactory(carpool=carpool, status='approved').person
+        db.session.commit()
+        driver = carpool.driver
+
+        snapshot = fanout.destination_deleted_snapshot(destination)
+        db.session.delete(destination)
+        db.session.commit()
+        fanout.send_fanout_email_queued('destination_deleted', **snapshot)
+
+        messages = {message.recipients[0]: message
+                    for batch in batches for message in batch}
+        assert set(messages) == {rider.email, driver.email}
+        assert 'from Library to Town Hall has been cancelled' in messages[rider.email].body
+        assert 'You are the driver of that carpool' in messages[driver.email].body
+        assert 'You are the driver of that carpool' not in messages[rider.email].body
@@ -1,6 +1,9 @@
+import os
+import stat
 import pytest
 from .factories import PersonFactory, CarpoolFactory, RideRequestFactory, DestinationFactory
 from flask import render_template
+from app.email.rendering import init_app, render_email_template, render_time_stats
 
 
 @pytest.mark.usefixtures('request_context')
@@ -189,3 +192,60 @@ class TestEmailTemplates:
             carpool=carpool,
         )
         assert 'and their phone number is' not in rendered
+
+
+@pytest.mark.usefixtures('request_context')
+class TestEmailRendering:
+    def test_static_fragments_are_rendered_once(self, app, db):
+        rider = PersonFactory()
+        carpool = CarpoolFactory(from_place='from')
+        db.session.commit()
+        app.config['BRANDING_EMAIL_SIGNATURE'] = '-- First Team'
+
+        first = render_template('email/ride_approved.txt', carpool=carpool, rider=rider)
+        assert '-- First Team' in first
+        assert 'ride_approved.txt' in app.extensions['email_fragments']
+
+        app.config['BRANDING_EMAIL_SIGNATURE'] = '-- Second Team'
+        second = render_template('email/ride_approved.txt', carpool=carpool, rider=rider)
+        assert second == first
+
+        # An explicitly passed config is never memoized
+        rendered = render_template('email/ride_approved.txt', carpool=carpool, rider=rider,
+                                   config={'BRANDING_EMAIL_SIGNATURE': '-- Test Team'})
+        assert '-- Test Team' in rendered
+
+    def test_render_times_are_recorded(self, app, db):
+        app.config['EMAIL_RENDER_STATS_SAMPLE_RATE'] = 1
+        rider = PersonFactory()
+        carpool = CarpoolFactory(from_place='from')
+        db.session.commit()
+        before = render_time_stats('email/ride_denied.html')['renders']
+
+        render_email_template('email/ride_denied.html', carpool=carpool, rider=rider)
+        render_email_template('email/ride_denied.html', carpool=carpool, rider=rider)
+
+        stats = render_time_stats('email/ride_denied.html')
+        assert stats['renders'] == before + 2
+        assert sum(count for _, count in stats['histogram']) == stats['renders']
+        assert stats['mean_ms'] > 0
+
+    def test_render_times_are_sampled(self, app, db):
+        app.config['EMAIL_RENDER_STATS_SAMPLE_RATE'] = 0
+        rider = PersonFactory()
+        carpool = CarpoolFactory(from_place='from')
+        db.session.commit()
+        before = render_time_stats('email/ride_denied.txt')['renders']
+
+        render_email_template('email/ride_denied.txt', carpool=carpool, rider=rider)
+
+        assert render_time_stats('email/ride_denied.txt')['renders'] == before
+
+    def test_bytecode_cache_is_opt_in_and_private(self, app):
+        assert app.jinja_env.bytecode_cache is None
+
+        app.config['TEMPLATE_BYTECODE_CACHE'] = True
+        init_app(app)
+        directory = os.stat(app.jinja_env.bytecode_cache.directory)
+        assert directory.st_uid == os.getuid()
+        assert stat.S_IMODE(directory.st_mode) == 0o700
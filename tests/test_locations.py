@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""Approximate location tests."""
+import datetime as dt
+
+from app.carpool.locations import (
+    APPROXIMATE_JITTER,
+    approximate_coordinates,
+    locate_results,
+)
+from app.models import LonLat
+
+TODAY = dt.date(2018, 11, 6)
+NYC = LonLat(-74.0060, 40.7128)
+
+
+class TestApproximateCoordinates:
+    def test_close_to_the_rounded_point(self, app):
+        lon, lat = approximate_coordinates([1], [NYC], TODAY)[0]
+        assert abs(lon - -74.01) <= APPROXIMATE_JITTER
+        assert abs(lat - 40.71) <= APPROXIMATE_JITTER
+
+    def test_stable_for_a_carpool_all_day(self, app):
+        first = approximate_coordinates([1, 2], [NYC, NYC], TODAY)
+        second = approximate_coordinates([2, 1], [NYC, NYC], TODAY)
+        assert first == second[::-1]
+
+    def test_differs_between_carpools_and_days(self, app):
+        one, two = approximate_coordinates([1, 2], [NYC, NYC], TODAY)
+        assert one != two
+
+        tomorrow, = approximate_coordinates(
+            [1], [NYC], TODAY + dt.timedelta(days=1))
+        assert one != tomorrow
+
+    def test_depends_on_the_secret_key(self, app):
+        before = approximate_coordinates([1], [NYC], TODAY)
+        app.secret_key = 'another secret'
+        assert approximate_coordinates([1], [NYC], TODAY) != before
+
+
+class TestLocateResults:
+    def test_exact_only_for_given_carpools(self, app):
+        results = [
+            {'carpool_id': 1, 'from_point': NYC},
+            {'carpool_id': 2, 'from_point': NYC},
+        ]
+        (first, first_approximate), (second, second_approximate) = \
+            locate_results(results, {2}, TODAY)
+
+        assert first_approximate
+        assert first == approximate_coordinates([1], [NYC], TODAY)[0]
+        assert not second_approximate
+        assert second == NYC
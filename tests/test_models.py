@@ -1,12 +1,17 @@
 # -*- coding: utf-8 -*-
 """Model unit tests."""
 import datetime as dt
+import struct
+import threading
 
 import pytest
+from geoalchemy2.elements import WKBElement
 from geoalchemy2.shape import from_shape
-from shapely.geometry import Point
+from shapely.geometry import LineString, Point
+from sqlalchemy.orm import selectinload
 
-from app.models import Person, Role, AnonymousUser, Destination, Carpool
+from app.bulk_load import ewkb_point
+from app.models import Person, Role, AnonymousUser, Destination, Carpool, RideRequest, LonLat
 
 from .factories import CarpoolFactory, PersonFactory, RideRequestFactory, DestinationFactory
 
@@ -70,6 +75,41 @@ class TestPerson:
         person = ride_request_2.person
         assert person.get_ride_request_in_carpool(carpool) is ride_request_2
 
+    @pytest.mark.usefixtures('request_context')
+    def test_roles_are_loaded_once_per_request(self, db, query_counter):
+        person = PersonFactory()
+        person.roles.append(Role(name='admin'))
+        db.session.commit()
+
+        assert person.has_roles('admin')
+        db.session.expire(person, ['roles'])
+        del query_counter[:]
+        assert person.has_roles('admin')
+        assert not person.has_roles('admin', 'blocked')
+        assert len(query_counter) == 0
+
+    @pytest.mark.usefixtures('request_context')
+    def test_ride_requests_in_carpools(self, db, query_counter):
+        person = PersonFactory()
+        carpools = [CarpoolFactory() for _ in range(3)]
+        ride_request = RideRequestFactory(person=person, carpool=carpools[1])
+        db.session.commit()
+
+        del query_counter[:]
+        ride_requests = person.get_ride_requests_in_carpools(carpools)
+        assert ride_requests == {
+            carpools[0].id: None,
+            carpools[1].id: ride_request,
+            carpools[2].id: None,
+        }
+        assert person.get_ride_request_in_carpool(carpools[1]) is ride_request
+        assert person.get_ride_request_in_carpool(carpools[2]) is None
+        assert len(query_counter) == 1
+
+        # Committing forgets what was looked up
+        ride_request.status = 'approved'
+        db.session.commit()
+        assert person.get_ride_request_in_carpool(carpools[1]).status == 'approved'
 
     def test_is_driver(self, db):
         """Test current user is driver property when user is logged in"""
@@ -98,6 +138,12 @@ class TestAnonymousUser:
         anonymous = AnonymousUser()
         assert anonymous.get_ride_request_in_carpool(carpool) == None
 
+    def test_anonymous_user_has_no_ride_requests(self):
+        carpool = CarpoolFactory()
+        anonymous = AnonymousUser()
+        assert anonymous.get_ride_requests_in_carpools([carpool]) == {carpool.id: None}
+        assert not anonymous.has_roles('admin')
+
     def test_anonymous_user_is_not_driver(self):
         carpool = CarpoolFactory()
         anonymous = AnonymousUser()
@@ -248,6 +294,130 @@ class TestCarpool:
 
         assert carpool.seats_available == 3
 
+    def test_approved_count_follows_ride_requests(self, db):
+        """approved_count changes as ride requests are approved and removed"""
+        carpool = CarpoolFactory(max_riders = 4)
+        ride_request = RideRequestFactory(
+            carpool = carpool,
+            status = 'requested',
+        )
+        db.session.commit()
+        assert carpool.approved_count == 0
+
+        ride_request.status = 'approved'
+        db.session.commit()
+        assert carpool.approved_count == 1
+        assert carpool.seats_available == 3
+
+        ride_request.status = 'denied'
+        db.session.commit()
+        assert carpool.approved_count == 0
+
+        ride_request.status = 'approved'
+        db.session.commit()
+        db.session.delete(ride_request)
+        db.session.commit()
+        assert carpool.approved_count == 0
+
+    def test_reconcile_approved_counts(self, db):
+        carpool_1 = CarpoolFactory()
+        carpool_2 = CarpoolFactory()
+        RideRequestFactory(carpool = carpool_1, status = 'approved')
+        RideRequestFactory(carpool = carpool_1, status = 'requested')
+        RideRequestFactory(carpool = carpool_2, status = 'approved')
+        db.session.commit()
+
+        Carpool.query.filter_by(id = carpool_1.id).update(
+            {Carpool.approved_count: 3}, synchronize_session=False)
+        db.session.commit()
+
+        assert Carpool.reconcile_approved_counts() == 1
+        assert carpool_1.approved_count == 1
+        assert carpool_2.approved_count == 1
+
+    def test_approve_needs_a_free_seat(self, db):
+        carpool = CarpoolFactory(max_riders = 1)
+        ride_request_1 = RideRequestFactory(carpool = carpool, status = 'requested')
+        ride_request_2 = RideRequestFactory(carpool = carpool, status = 'requested')
+        db.session.commit()
+
+        assert ride_request_1.approve()
+        db.session.commit()
+        assert not ride_request_2.approve()
+        db.session.rollback()
+
+        assert ride_request_2.status == 'requested'
+        assert carpool.approved_count == 1
+
+    def test_concurrent_approvals_do_not_overbook(self, app, db):
+        """N simultaneous approvals against K seats approve exactly K"""
+        seats, approvals = 3, 8
+        carpool = CarpoolFactory(max_riders = seats)
+        ride_requests = [
+            RideRequestFactory(carpool = carpool, status = 'requested')
+            for _ in range(approvals)
+        ]
+        db.session.commit()
+        carpool_id = carpool.id
+        request_ids = [r.id for r in ride_requests]
+
+        # Time out instead of hanging the suite if a thread dies first
+        barrier = threading.Barrier(approvals, timeout=10)
+        results = []
+
+        def approve(request_id):
+            with app.app_context():
+                try:
+                    ride_request = RideRequest.query.get(request_id)
+                    barrier.wait()
+                    results.append(ride_request.approve())
+                    db.session.commit()
+                finally:
+                    db.session.remove()
+
+        threads = [
+            threading.Thread(target=approve, args=(request_id,))
+            for request_id in request_ids
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=10)
+        assert not any(thread.is_alive() for thread in threads)
+
+        assert results.count(True) == seats
+        db.session.expire_all()
+        assert Carpool.query.get(carpool_id).approved_count == seats
+        assert RideRequest.query.filter_by(status = 'approved').count() == seats
+
+    def test_eager_loaded_riders(self, db):
+        """riders and seats available use eager loaded ride requests"""
+        carpool = CarpoolFactory(max_riders = 4)
+        ride_request_1 = RideRequestFactory(
+            carpool = carpool,
+            status = 'approved',
+        )
+        ride_request_2 = RideRequestFactory(
+            carpool = carpool,
+            status = 'requested',
+        )
+        db.session.commit()
+        carpool_id, rider_id = carpool.id, ride_request_1.person_id
+        db.session.expunge_all()
+
+        carpool = Carpool.query.options(
+            selectinload(Carpool.ride_requests).joinedload(RideRequest.person),
+        ).get(carpool_id)
+        assert carpool.ride_requests_loaded
+        assert [p.id for p in carpool.riders] == [rider_id]
+        assert carpool.seats_available == 3
+
+    def test_lat_lng_calculation_from_database(self, db):
+        c = CarpoolFactory(from_point='SRID=4326;POINT(-97.328 38.518)')
+        db.session.commit()
+        db.session.expire(c)
+        assert c.from_lat_lng == '38.518, -97.328'
+
     def test_lat_lng_calculation(self):
         # the hex string below represents a PostGIS Geometry object)
         pt = wkb_element = from_shape(Point(-97.328, 38.518), srid=4326)
@@ -271,3 +441,40 @@ class TestDestination:
         db.session.commit()
 
         assert d not in Destination.find_all_visible().all()
+
+    def test_as_geojson(self, db):
+        d = DestinationFactory(point='SRID=4326;POINT(-74.006 40.7128)')
+        db.session.commit()
+        db.session.expire(d)
+
+        assert d.as_geojson()['geometry'] == {
+            'type': 'Point',
+            'coordinates': [-74.006, 40.7128],
+        }
+
+
+class TestLonLat:
+    """LonLat tests."""
+
+    def test_from_wkb(self):
+        element = from_shape(Point(-97.328, 38.518), srid=4326)
+        assert LonLat.from_element(element) == (-97.328, 38.518)
+
+    def test_from_ewkb_with_srid(self):
+        element = WKBElement(ewkb_point(38.518, -97.328), extended=True)
+        assert LonLat.from_element(element) == (-97.328, 38.518)
+
+    def test_from_big_endian_wkb(self):
+        data = struct.pack('>BIdd', 0, 1, -97.328, 38.518)
+        assert LonLat.from_element(WKBElement(data)) == (-97.328, 38.518)
+
+    def test_only_points(self):
+        element = from_shape(LineString([(0, 0), (1, 1)]), srid=4326)
+        with pytest.raises(ValueError):
+            LonLat.from_element(element)
+
+    def test_as_geojson(self):
+        assert LonLat(-97.328, 38.518).as_geojson() == {
+            'type': 'Point',
+            'coordinates': [-97.328, 38.518],
+        }
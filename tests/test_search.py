@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""Carpool search tests."""
+from datetime import datetime, timedelta
+
+from app.carpool.search import MAX_SEARCH_DISTANCE, search_carpools_near
+
+from .factories import CarpoolFactory
+
+NYC_LAT, NYC_LON = 40.7128, -74.0060
+# Roughly how many meters a degree of latitude spans around NYC
+METERS_PER_DEGREE_LAT = 111040
+
+
+def carpool_north_of_nyc(meters):
+    leave_time = datetime.now() + timedelta(days=1)
+    return CarpoolFactory(
+        from_point='SRID=4326;POINT({} {})'.format(
+            NYC_LON, NYC_LAT + meters / METERS_PER_DEGREE_LAT),
+        leave_time=leave_time,
+        return_time=leave_time + timedelta(hours=8),
+    )
+
+
+class TestSearchCarpoolsNear:
+    def test_closest_first(self, db):
+        far = carpool_north_of_nyc(30000)
+        near = carpool_north_of_nyc(1000)
+        middle = carpool_north_of_nyc(10000)
+        db.session.commit()
+
+        pools = search_carpools_near(NYC_LAT, NYC_LON)
+        assert [pool.id for pool in pools] == [near.id, middle.id, far.id]
+
+    def test_limited_to_the_search_radius(self, db):
+        inside = carpool_north_of_nyc(MAX_SEARCH_DISTANCE - 500)
+        outside = carpool_north_of_nyc(MAX_SEARCH_DISTANCE + 500)
+        db.session.commit()
+
+        pools = search_carpools_near(NYC_LAT, NYC_LON)
+        assert [pool.id for pool in pools] == [inside.id]
+
+    def test_limit_keeps_the_closest(self, db):
+        far = carpool_north_of_nyc(20000)
+        near = carpool_north_of_nyc(2000)
+        db.session.commit()
+
+        pools = search_carpools_near(NYC_LAT, NYC_LON, limit=1)
+        assert [pool.id for pool in pools] == [near.id]
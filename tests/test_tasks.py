@@ -7,9 +7,10 @@ from unittest import mock
 from click.testing import CliRunner
 
 from app.models import Carpool
+from app.carpool import tasks
 from app.email import reminder_tasks
 
-from .factories import CarpoolFactory
+from .factories import CarpoolFactory, RideRequestFactory
 
 class TestReminders:
     def test_email_in_range(self, monkeypatch, db):
@@ -66,3 +67,157 @@ class TestReminders:
         assert len(mock_send_email.call_args_list) == 0
         carpool = db.session.query(Carpool).first()
         assert carpool.reminder_email_sent_at is None
+
+    def test_carpools_claimed_elsewhere_are_skipped(self, monkeypatch, db):
+        mock_send_email = mock.Mock()
+        monkeypatch.setattr(reminder_tasks, 'send_email', mock_send_email)
+        leave_time = datetime.datetime.now() + datetime.timedelta(hours=12)
+        claimed = CarpoolFactory(leave_time=leave_time, reminder_email_sent_at=None)
+        unclaimed = CarpoolFactory(leave_time=leave_time, reminder_email_sent_at=None)
+        db.session.commit()
+
+        # Another scheduler is part way through reminding `claimed`
+        conn = db.engine.connect()
+        transaction = conn.begin()
+        conn.execute('select id from carpools where id = %s for update',
+                     claimed.id)
+        try:
+            runner = CliRunner()
+            result = runner.invoke(reminder_tasks.enqueue_scheduled_emails, [])
+            assert result.exit_code == 0
+        finally:
+            transaction.rollback()
+            conn.close()
+
+        mock_send_email.assert_called_once_with(
+            'driver_reminder',
+            unclaimed.driver.email,
+            'Your carpool is coming up!',
+            carpool=unclaimed,
+        )
+        db.session.expire_all()
+        assert claimed.reminder_email_sent_at is None
+        assert unclaimed.reminder_email_sent_at is not None
+
+    def test_claims_are_committed_before_sending(self, monkeypatch, db):
+        CarpoolFactory(
+            leave_time=datetime.datetime.now() + datetime.timedelta(hours=12),
+            reminder_email_sent_at=None,
+        )
+        db.session.commit()
+        monkeypatch.setattr(db.session, 'commit',
+                            mock.Mock(side_effect=ConnectionError))
+        mock_send_email = mock.Mock()
+        monkeypatch.setattr(reminder_tasks, 'send_email', mock_send_email)
+
+        # The claim can't be committed, so nothing is sent
+        runner = CliRunner()
+        result = runner.invoke(reminder_tasks.enqueue_scheduled_emails, [])
+        assert result.exit_code != 0
+        assert mock_send_email.call_count == 0
+
+        # Sending fails after the claim is committed...
+        monkeypatch.undo()
+        db.session.rollback()
+        mock_send_email = mock.Mock(side_effect=ConnectionError)
+        monkeypatch.setattr(reminder_tasks, 'send_email', mock_send_email)
+        result = runner.invoke(reminder_tasks.enqueue_scheduled_emails, [])
+        assert result.exit_code != 0
+        assert mock_send_email.call_count == 1
+
+        # ...and the next run doesn't send it again
+        mock_send_email.reset_mock(side_effect=True)
+        result = runner.invoke(reminder_tasks.enqueue_scheduled_emails, [])
+        assert result.exit_code == 0
+        assert mock_send_email.call_count == 0
+
+
+class TestBatchedReminders:
+    def test_batches_are_sent_once(self, monkeypatch, db):
+        mock_send_emails = mock.Mock()
+        monkeypatch.setattr(reminder_tasks, 'send_emails', mock_send_emails)
+        leave_time = datetime.datetime.now() + datetime.timedelta(hours=12)
+        carpools = [
+            CarpoolFactory(leave_time=leave_time, reminder_email_sent_at=None)
+            for _ in range(3)
+        ]
+        rider = RideRequestFactory(carpool=carpools[0], status='approved').person
+        RideRequestFactory(carpool=carpools[0], status='requested')
+        db.session.commit()
+
+        runner = CliRunner()
+        result = runner.invoke(reminder_tasks.enqueue_scheduled_emails,
+                               ['--batch-size', '2'])
+        assert result.exit_code == 0
+        # Two pages: two carpools, then one
+        assert mock_send_emails.call_count == 2
+        messages = [m for call in mock_send_emails.call_args_list
+                    for m in call[0][0]]
+        recipients = sorted(recipient for _, recipient, _, _ in messages)
+        assert recipients == sorted(
+            [pool.driver.email for pool in carpools] + [rider.email])
+        assert Carpool.query.filter(
+            Carpool.reminder_email_sent_at == None).count() == 0
+
+        # Running again doesn't send anything twice
+        mock_send_emails.reset_mock()
+        result = runner.invoke(reminder_tasks.enqueue_scheduled_emails,
+                               ['--batch-size', '2'])
+        assert result.exit_code == 0
+        assert mock_send_emails.call_count == 0
+
+    def test_failed_batch_is_not_sent_again(self, monkeypatch, db):
+        mock_send_emails = mock.Mock(side_effect=ConnectionError)
+        monkeypatch.setattr(reminder_tasks, 'send_emails', mock_send_emails)
+        CarpoolFactory(
+            leave_time=datetime.datetime.now() + datetime.timedelta(hours=12),
+            reminder_email_sent_at=None,
+        )
+        db.session.commit()
+
+        runner = CliRunner()
+        result = runner.invoke(reminder_tasks.enqueue_scheduled_emails,
+                               ['--batch-size', '10'])
+        assert result.exit_code != 0
+        carpool = db.session.query(Carpool).first()
+        assert carpool.reminder_email_sent_at is not None
+
+        # Reminders are sent at most once, so a re-run leaves it alone
+        mock_send_emails.reset_mock(side_effect=True)
+        result = runner.invoke(reminder_tasks.enqueue_scheduled_emails,
+                               ['--batch-size', '10'])
+        assert result.exit_code == 0
+        assert mock_send_emails.call_count == 0
+
+    def test_failed_commit_sends_nothing(self, monkeypatch, db):
+        mock_send_emails = mock.Mock()
+        monkeypatch.setattr(reminder_tasks, 'send_emails', mock_send_emails)
+        CarpoolFactory(
+            leave_time=datetime.datetime.now() + datetime.timedelta(hours=12),
+            reminder_email_sent_at=None,
+        )
+        db.session.commit()
+        monkeypatch.setattr(db.session, 'commit',
+                            mock.Mock(side_effect=ConnectionError))
+
+        runner = CliRunner()
+        result = runner.invoke(reminder_tasks.enqueue_scheduled_emails,
+                               ['--batch-size', '10'])
+        assert result.exit_code != 0
+        assert mock_send_emails.call_count == 0
+
+
+class TestReconcileApprovedCounts:
+    def test_reconcile(self, db):
+        carpool = CarpoolFactory()
+        RideRequestFactory(carpool=carpool, status='approved')
+        db.session.commit()
+        Carpool.query.filter_by(id=carpool.id).update(
+            {Carpool.approved_count: 0}, synchronize_session=False)
+        db.session.commit()
+
+        runner = CliRunner()
+        result = runner.invoke(tasks.reconcile_approved_counts, [])
+        assert result.exit_code == 0
+        carpool = db.session.query(Carpool).first()
+        assert carpool.approved_count == 1